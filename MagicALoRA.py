@@ -1,859 +1,3544 @@
-import os
-import json
-import logging
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from datetime import datetime
-import threading
-import fitz  # PyMuPDF
-from pptx import Presentation
-from moviepy.editor import VideoFileClip
-import speech_recognition as sr
-from pydub import AudioSegment
-import csv
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
-import xml.etree.ElementTree as ET
-import zipfile
-import pandas as pd
-from pydub.silence import split_on_silence
-from pytube import YouTube
-import vlc
-from docx import Document
-import re
-from difflib import SequenceMatcher
-from tkinterdnd2 import TkinterDnD
-
-# Temporary directory
-temp_dir = 'temp'
-if not os.path.exists(temp_dir):
-    os.makedirs(temp_dir)
-
-# Logger configuration
-def configure_logger(log_name):
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    log_file = os.path.join(temp_dir, f'{log_name}-{timestamp}.log')
-    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    return log_file
-
-# Global variable for language
-lang = {}
-
-# Load language translations from XML file
-def load_language(language_code):
-    global lang
-    try:
-        tree = ET.parse(f'{language_code}.xml')
-        root = tree.getroot()
-        lang = {}
-        for field in root.find('fields'):
-            lang[field.tag] = field.text
-        update_language(lang)
-    except Exception as e:
-        logging.error(f"Failed to load language file: {language_code}.xml - {str(e)}")
-        messagebox.showerror("Error", f"Failed to load language file: {str(e)}")
-
-# Function to update the interface language
-def update_language(lang):
-    try:
-        tab_control.tab(0, text=lang['convert'])
-        tab_control.tab(1, text=lang['testSRT'])
-        tab_control.tab(2, text=lang['createTextFile'])
-        tab_control.tab(3, text=lang['createJson'])
-        tab_control.tab(4, text=lang['setup'])
-        url_label.config(text=lang['orEnterUrl'])
-        browse_button.config(text=lang['browseVideo'])
-        start_button.config(text=lang['startProcessing'])
-        download_audio_only_checkbox.config(text=lang['downloadAudioOnly'])
-        url_label_video.config(text=lang['orEnterUrlVideo'])
-        video_browse_button.config(text=lang['browseVideo'])
-        srt_browse_button.config(text=lang['browseSRTFile'])
-        load_video_button.config(text=lang['loadAndPlayVideo'])
-        create_text_file_button.config(text=lang['startCreateTextFile'])
-        create_json_button.config(text=lang['startCreateJson'])
-        chapter_keywords_label.config(text=lang['enterChapterKeywords'])
-        add_keyword_button.config(text=lang['addKeyword'])
-        remove_keyword_button.config(text=lang['removeKeyword'])
-        add_directory_button.config(text=lang['addDirectory'])
-        remove_directory_button.config(text=lang['removeDirectory'])
-        add_ignore_directory_button.config(text=lang['addIgnoreDirectory'])
-        remove_ignore_directory_button.config(text=lang['removeIgnoreDirectory'])
-        set_output_path_button.config(text=lang['setTextOutput'])
-        set_json_output_path_button.config(text=lang['setJsonOutput'])
-        process_subfolders_checkbox.config(text=lang['processSubfolders'])
-        save_config_button.config(text=lang['saveConfiguration'])
-        load_config_button.config(text=lang['loadConfiguration'])
-        limit_search_label.config(text=lang['limitSearch'])
-        limit_search_menu['values'] = [lang['noLimit'], lang['lastProducedPerType'], lang['lastProducedInFolder'], lang['lastProducedSimilarTitle']]
-    except KeyError as e:
-        logging.error(f"Missing language key: {str(e)}")
-        messagebox.showerror("Error", f"Missing language key: {str(e)}")
-
-# Functions to handle different file types
-def remove_headers_footers(text):
-    lines = text.split('\n')
-    if len(lines) > 3:
-        return '\n'.join(lines[1:-1])
-    return text
-
-def handle_text_file(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
-            text = file.read()
-        return remove_headers_footers(text), file_path
-    except Exception as e:
-        logging.error(f"Failed to read or process text file: {file_path} - {str(e)}")
-        return f"Failed to read or process text file: {str(e)}", None
-
-def handle_pdf_file(file_path):
-    try:
-        doc = fitz.open(file_path)
-        text = [page.get_text("text") for page in doc]
-        doc.close()
-        return remove_headers_footers('\n'.join(text)), file_path
-    except Exception as e:
-        logging.error(f"Failed to process PDF file: {file_path} - {str(e)}")
-        return f"Failed to process PDF file: {file_path} - {str(e)}", None
-
-def handle_word_file(file_path):
-    try:
-        doc = Document(file_path)
-        text = '\n'.join([para.text for para in doc.paragraphs])
-        return remove_headers_footers(text), file_path
-    except Exception as e:
-        logging.error(f"Failed to process Word file: {file_path} - {str(e)}")
-        return f"Failed to process Word file: {file_path} - {str(e)}", None
-
-def handle_ppt_file(file_path):
-    try:
-        ppt = Presentation(file_path)
-        text = [shape.text for slide in ppt.slides for shape in slide.shapes if hasattr(shape, "text")]
-        return remove_headers_footers('\n'.join(text)), file_path
-    except Exception as e:
-        logging.error(f"Failed to process PowerPoint file: {file_path} - {str(e)}")
-        return f"Failed to process PowerPoint file: {file_path} - {str(e)}", None
-
-def handle_excel_file(file_path):
-    try:
-        df = pd.read_excel(file_path)
-        return df.to_csv(index=False), file_path
-    except Exception as e:
-        logging.error(f"Failed to process Excel file: {file_path} - {str(e)}")
-        return f"Failed to process Excel file: {file_path} - {str(e)}", None
-
-def handle_csv_file(file_path):
-    try:
-        with open(file_path, mode='r', encoding='utf-8', newline='') as f:
-            reader = csv.reader(f)
-            data = list(reader)
-        return '\n'.join([','.join(row) for row in data]), file_path
-    except Exception as e:
-        logging.error(f"Failed to process CSV file: {file_path} - {str(e)}")
-        return f"Failed to process CSV file: {file_path} - {str(e)}", None
-
-def handle_epub_file(file_path):
-    try:
-        book = epub.read_epub(file_path)
-        text = []
-        for item in book.get_items():
-            if item.get_type() == ebooklib.ITEM_DOCUMENT:
-                soup = BeautifulSoup(item.get_content(), 'html.parser')
-                text.append(soup.get_text())
-        return remove_headers_footers('\n'.join(text)), file_path
-    except Exception as e:
-        logging.error(f"Failed to process EPUB file: {file_path} - {str(e)}")
-        return f"Failed to process EPUB file: {file_path} - {str(e)}", None
-
-def handle_xml_gan_file(file_path):
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        texts = [elem.text for elem in root.iter() if elem.text is not None]
-        return '\n'.join(texts), file_path
-    except Exception as e:
-        logging.error(f"Failed to process XML/GAN file: {file_path} - {str(e)}")
-        return f"Failed to process XML/GAN file: {file_path} - {str(e)}", None
-
-def handle_audio_file(file_path):
-    if file_path.lower().endswith('.m4a'):
-        sound = AudioSegment.from_file(file_path, format='m4a')
-        wav_path = file_path.replace('.m4a', '.wav')
-        sound.export(wav_path, format='wav')
-        file_path = wav_path
-
-    recognizer = sr.Recognizer()
-    with sr.AudioFile(file_path) as source:
-        audio_data = recognizer.record(source)
-        try:
-            return recognizer.recognize_google(audio_data, language='it-IT'), file_path
-        except sr.UnknownValueError:
-            logging.warning(f"Speech not understood in file: {file_path}")
-            return "Speech not understood", file_path
-        except sr.RequestError as e:
-            logging.error(f"Speech recognition request failed for file: {file_path} - {e}")
-            return f"Speech recognition request failed; {e}", file_path
-
-def handle_generic_video_file(file_path):
-    try:
-        audio_path = extract_audio_from_video(file_path)
-        text = transcribe_audio(audio_path)
-        os.remove(audio_path)
-        return text, file_path
-    except Exception as e:
-        logging.error(f"Failed to process video file: {file_path} - {str(e)}")
-        return f"Failed to process video file: {file_path} - {str(e)}", None
-
-def extract_audio_from_video(video_path):
-    video = VideoFileClip(video_path)
-    audio_path = os.path.join(temp_dir, "temp_audio.wav")
-    video.audio.write_audiofile(audio_path)
-    return audio_path
-
-def transcribe_audio(audio_path, language='it-IT'):
-    recognizer = sr.Recognizer()
-    with sr.AudioFile(audio_path) as source:
-        audio_data = recognizer.record(source)
-        try:
-            return recognizer.recognize_google(audio_data, language=language)
-        except sr.UnknownValueError:
-            return "Speech not understood"
-        except sr.RequestError as e:
-            return f"Could not request results; {e}"
-
-def write_to_output(content, output_dir, file_index, original_path):
-    output_file_path = os.path.join(output_dir, f'model_{file_index}.txt')
-    with open(output_file_path, 'a', encoding='utf-8') as file:
-        file.write(f"\nOriginal file path: {original_path}\nFile content:\n{content}\n")
-    return file_index + 1
-
-def handle_zip_file(zip_path):
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as z:
-            z.extractall(temp_dir)
-            extracted_files = z.namelist()
-            for file_name in extracted_files:
-                internal_path = os.path.join(temp_dir, file_name)
-                if os.path.isfile(internal_path):
-                    content, _ = handle_file(internal_path)
-                    if content and not content.startswith("Unsupported"):
-                        return f"{content} (from {file_name} in {zip_path})", zip_path
-                    os.remove(internal_path)
-        return "No supported files found or failed to process", None
-    except Exception as e:
-        logging.error(f"Failed to process ZIP file: {zip_path} - {str(e)}")
-        return f"Failed to process ZIP file: {str(e)}", None
-
-def explore_directory(directory, output_dir, ignore_dirs, process_subfolders, limit_search):
-    file_index = 1
-    for root, dirs, files in os.walk(directory):
-        dirs[:] = [d for d in dirs if os.path.join(root, d) not in ignore_dirs]
-        if not process_subfolders:
-            dirs[:] = []
-        files = limit_files_search(files, limit_search)
-        for file in files:
-            file_path = os.path.join(root, file)
-            if any(os.path.abspath(os.path.join(root, d)) in ignore_dirs for d in dirs):
-                continue
-            content, original_path = handle_file(file_path)
-            if content and not content.startswith("Unsupported"):
-                file_index = write_to_output(content, output_dir, file_index, original_path)
-            else:
-                logging.info(content)
-
-def limit_files_search(files, limit_search):
-    if limit_search == 'noLimit':
-        return files
-    if limit_search == 'lastProducedPerType':
-        file_types = {}
-        for file in files:
-            file_type = os.path.splitext(file)[1]
-            if file_type not in file_types:
-                file_types[file_type] = file
-            else:
-                if os.path.getmtime(file) > os.path.getmtime(file_types[file_type]):
-                    file_types[file_type] = file
-        return list(file_types.values())
-    elif limit_search == 'lastProducedInFolder':
-        if files:
-            return [max(files, key=os.path.getmtime)]
-    elif limit_search == 'lastProducedSimilarTitle':
-        similar_titles = {}
-        for file in files:
-            base_name = os.path.splitext(file)[0]
-            if base_name not in similar_titles:
-                similar_titles[base_name] = file
-            else:
-                similarity = SequenceMatcher(None, base_name, os.path.splitext(similar_titles[base_name])[0]).ratio()
-                if similarity > 0.9:
-                    if os.path.getmtime(file) > os.path.getmtime(similar_titles[base_name]):
-                        similar_titles[base_name] = file
-        return list(similar_titles.values())
-    return files
-
-def handle_file(file_path):
-    extension = os.path.splitext(file_path)[1].lower()
-    handler = {
-        '.txt': handle_text_file,
-        '.htm': handle_epub_file,
-        '.html': handle_epub_file,
-        '.pdf': handle_pdf_file,
-        '.docx': handle_word_file,
-        '.doc': handle_word_file,
-        '.pptx': handle_ppt_file,
-        '.ppt': handle_ppt_file,
-        '.xls': handle_excel_file,
-        '.xlsx': handle_excel_file,
-        '.xml': handle_xml_gan_file,
-        '.gan': handle_xml_gan_file,
-        '.xsd': handle_xml_gan_file,
-        '.wav': handle_audio_file,
-        '.mp3': handle_audio_file,
-        '.m4a': handle_audio_file,
-        '.mp4': handle_generic_video_file,
-        '.avi': handle_generic_video_file,
-        '.mov': handle_generic_video_file,
-        '.mkv': handle_generic_video_file,
-        '.mpeg': handle_generic_video_file,
-        '.mpg': handle_generic_video_file,
-        '.3gp': handle_generic_video_file,
-        '.csv': handle_csv_file,
-        '.epub': handle_epub_file,
-        '.zip': handle_zip_file
-    }.get(extension)
-    if handler:
-        return handler(file_path)
-    return "Unsupported file format for {}".format(file_path), None
-
-def process_text_with_keywords(text, keywords):
-    json_data = []
-    keyword_positions = []
-
-    # Trova tutte le posizioni delle keyword nel testo
-    for keyword in keywords:
-        pattern = re.compile(keyword, re.IGNORECASE)
-        matches = list(pattern.finditer(text))
-        for match in matches:
-            keyword_positions.append((match.start(), match.end(), match.group()))
-
-    # Ordina le posizioni delle keyword in base alla loro posizione nel testo
-    keyword_positions.sort()
-
-    # Aggiungi i contenuti tra le keyword al JSON
-    for i in range(len(keyword_positions)):
-        start, end, matched_keyword = keyword_positions[i]
-        next_start = keyword_positions[i + 1][0] if i + 1 < len(keyword_positions) else len(text)
-
-        content = text[end:next_start].strip()
-        json_data.append({"title": matched_keyword, "content": content})
-
-    return json_data
-
-
-
-def write_json(data, output_file):
-    try:
-        with open(output_file, 'w', encoding='utf-8') as json_file:
-            json.dump(data, json_file, indent=4, ensure_ascii=False)
-    except PermissionError:
-        logging.error(f"Permission denied: {output_file}")
-        messagebox.showerror("Error", f"Permission denied: {output_file}")
-    except Exception as e:
-        logging.error(f"Failed to write JSON file: {output_file} - {str(e)}")
-        messagebox.showerror("Error", f"Failed to write JSON file: {output_file} - {str(e)}")
-
-# Functions for GUI and video handling
-def download_youtube_video(url, download_audio_only=False):
-    if not url.strip():
-        messagebox.showerror(lang['downloadError'], lang['downloadError'])
-        return None
-    try:
-        yt = YouTube(url)
-        title = yt.title
-        title = ''.join([c for c in title if c.isalpha() or c.isdigit() or c==' ']).rstrip()
-        if download_audio_only:
-            stream = yt.streams.filter(only_audio=True).first()
-            file_path = stream.download(output_path=temp_dir, filename=f"{title}.mp3")
-        else:
-            stream = yt.streams.get_highest_resolution()
-            file_path = stream.download(output_path=temp_dir, filename=f"{title}.mp4")
-        logging.info(f"{lang['downloadSuccess']}: {file_path}")
-        return file_path
-    except Exception as e:
-        logging.error(f"{lang['downloadError']}: {e}")
-        messagebox.showerror(lang['downloadError'], str(e))
-        return None
-
-def extract_audio(video_file):
-    try:
-        video = VideoFileClip(video_file)
-        audio = video.audio
-        audio_file = os.path.join(temp_dir, "temp_audio.wav")
-        audio.write_audiofile(audio_file, codec='pcm_s16le')
-        video.close()
-        logging.info(f"Extracted audio to: {audio_file}")
-        return audio_file
-    except Exception as e:
-        logging.error(f"{lang['audioExtractionError']}: {e}")
-        messagebox.showerror(lang['audioExtractionError'], str(e))
-        return None
-
-def generate_srt(audio_file, output_file, language='it-IT'):
-    recognizer = sr.Recognizer()
-    sound = AudioSegment.from_wav(audio_file)
-    chunks = split_on_silence(sound, min_silence_len=500, silence_thresh=sound.dBFS-14, keep_silence=500)
-
-    with open(output_file, 'w') as file:
-        start = 0
-        for i, chunk in enumerate(chunks):
-            chunk_filename = os.path.join(temp_dir, f"chunk{i}.wav")
-            chunk.export(chunk_filename, format="wav")
-            with sr.AudioFile(chunk_filename) as source:
-                audio = recognizer.record(source)
-            try:
-                text = recognizer.recognize_google(audio, language=language)
-                duration = len(chunk) / 1000
-                start_time = start
-                end_time = start + duration
-                file.write(f"{i+1}\n")
-                file.write(f"{format_time(start_time)} --> {format_time(end_time)}\n")
-                file.write(f"{text.strip()}\n\n")
-                start += duration
-                logging.info(f"Generated SRT segment {i+1}")
-            except sr.UnknownValueError:
-                file.write(f"{i+1}\n")
-                file.write(f"{format_time(start_time)} --> {format_time(end_time)}\n")
-                file.write("Audio not understandable\n\n")
-                start += duration
-                logging.warning(f"Audio not understandable for segment {i+1}")
-            except sr.RequestError as e:
-                file.write(f"{i+1}\n")
-                file.write(f"{format_time(start_time)} --> {format_time(end_time)}\n")
-                file.write(f"Service error: {e}\n\n")
-                start += duration
-                logging.error(f"Service error for segment {i+1}: {e}")
-    
-    # Clean up chunk files
-    for chunk_filename in os.listdir(temp_dir):
-        if chunk_filename.startswith("chunk") and chunk_filename.endswith(".wav"):
-            os.remove(os.path.join(temp_dir, chunk_filename))
-            logging.info(f"Removed chunk file: {chunk_filename}")
-
-def format_time(seconds):
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = seconds % 60
-    return f"{hours:02}:{minutes:02}:{seconds:02},000"
-
-def process_video():
-    download_audio_only = download_audio_only_var.get()
-    if url_entry.get().strip():
-        video_file = download_youtube_video(url_entry.get().strip(), download_audio_only=download_audio_only)
-    else:
-        video_file = file_entry.get().strip()
-
-    if video_file:
-        if not download_audio_only:
-            audio_file = extract_audio(video_file)
-        else:
-            audio_file = video_file
-
-        if audio_file:
-            output_path = filedialog.asksaveasfilename(defaultextension=".srt", filetypes=[("SRT files", "*.srt")])
-            if output_path:
-                generate_srt(audio_file, output_path, transcription_lang_var.get())
-                messagebox.showinfo("Success", f"{lang['success']} {output_path}")
-                logging.info(f"SRT file generated: {output_path}")
-
-def setup_video_player(video_path, srt_path):
-    media = instance.media_new(video_path)
-    media.add_option(f'sub-file={srt_path}')
-    player.set_media(media)
-    player.play()
-
-def load_video():
-    video_path = video_entry.get().strip()
-    srt_path = srt_entry.get().strip()
-
-    if not video_path and not url_entry_video.get().strip():
-        messagebox.showerror("Error", "Please enter a URL or select a video file.")
-        return
-    if not srt_path:
-        messagebox.showerror("Error", "Please select an SRT file.")
-        return
-
-    if url_entry_video.get().strip():
-        video_path = download_youtube_video(url_entry_video.get().strip())
-
-    if video_path:
-        setup_video_player(video_path, srt_path)
-
-# Functions for Tab 3: Create text file
-def start_create_text_file():
-    directories = setup_directories
-    output_path = setup_output_path
-    ignore_dirs = setup_ignore_dirs
-    process_subfolders = setup_process_subfolders
-    limit_search = limit_search_var.get()
-    for directory in directories:
-        explore_directory(directory, output_path, ignore_dirs, process_subfolders, limit_search)
-    logging.info(f"{lang['processCompleted']}: {directories}")
-
-# Functions for Tab 4: Create Json
-def start_create_json():
-    directories = [setup_output_path]
-    keywords = [entry.get() for entry in keyword_entries]
-    combined_json_data = []
-
-    for directory in directories:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                content, original_path = handle_file(file_path)
-                if content and not content.startswith("Unsupported"):
-                    json_data = process_text_with_keywords(content, keywords)
-                    combined_json_data.append([
-                        {"title": "Original file path", "content": original_path},
-                        *json_data
-                    ])
-                else:
-                    logging.info(content)
-
-    output_path = setup_json_output_path
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-    json_output_file = os.path.join(output_path, "output.json")
-    write_json(combined_json_data, json_output_file)
-    messagebox.showinfo("Success", f"{lang['success']} {json_output_file}")
-    logging.info(f"JSON file generated: {json_output_file}")
-    
-    # Aggiorna la configurazione dopo aver creato il JSON
-    save_configuration()
-
-
-# Functions for Tab 5: Setup
-setup_directories = []
-setup_ignore_dirs = []
-setup_output_path = ""
-setup_json_output_path = ""
-setup_process_subfolders = True
-
-keyword_entries = []
-
-def add_keyword_entry():
-    entry = tk.Entry(tab4, width=50)
-    entry.pack(pady=5)
-    keyword_entries.append(entry)
-
-def remove_keyword_entry():
-    if keyword_entries:
-        entry = keyword_entries.pop()
-        entry.pack_forget()
-
-def add_directory():
-    directory = filedialog.askdirectory()
-    if directory:
-        setup_directories.append(directory)
-        directories_listbox.insert(tk.END, directory)
-
-def remove_directory():
-    selected = directories_listbox.curselection()
-    if selected:
-        index = selected[0]
-        setup_directories.pop(index)
-        directories_listbox.delete(index)
-
-def add_ignore_directory():
-    directory = filedialog.askdirectory()
-    if directory:
-        setup_ignore_dirs.append(directory)
-        ignore_directories_listbox.insert(tk.END, directory)
-
-def remove_ignore_directory():
-    selected = ignore_directories_listbox.curselection()
-    if selected:
-        index = selected[0]
-        setup_ignore_dirs.pop(index)
-        ignore_directories_listbox.delete(index)
-
-def set_output_path():
-    global setup_output_path
-    setup_output_path = filedialog.askdirectory()
-    output_path_label.config(text=setup_output_path)
-
-def set_json_output_path():
-    global setup_json_output_path
-    setup_json_output_path = filedialog.askdirectory()
-    json_output_path_label.config(text=setup_json_output_path)
-
-def set_process_subfolders():
-    global setup_process_subfolders
-    setup_process_subfolders = process_subfolders_var.get()
-
-def set_temp_dir():
-    global temp_dir
-    temp_dir = filedialog.askdirectory()
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    temp_dir_label.config(text=temp_dir)
-
-# Save widget positions
-def save_widget_positions():
-    widget_positions = {}
-    for widget in tab5.winfo_children():
-        widget_positions[str(widget)] = {"x": widget.winfo_x(), "y": widget.winfo_y()}
-    return widget_positions
-
-# Load widget positions
-def load_widget_positions(widget_positions):
-    for widget in tab5.winfo_children():
-        if str(widget) in widget_positions:
-            pos = widget_positions[str(widget)]
-            widget.place(x=pos["x"], y=pos["y"])
-
-def update_setup_ui():
-    directories_listbox.delete(0, tk.END)
-    for directory in setup_directories:
-        directories_listbox.insert(tk.END, directory)
-    ignore_directories_listbox.delete(0, tk.END)
-    for directory in setup_ignore_dirs:
-        ignore_directories_listbox.insert(tk.END, directory)
-    output_path_label.config(text=setup_output_path)
-    json_output_path_label.config(text=setup_json_output_path)
-    process_subfolders_var.set(setup_process_subfolders)
-    temp_dir_label.config(text=temp_dir)
-    limit_search_menu.set(lang[limit_search_var.get()])
-
-def save_configuration():
-    config = {
-        "directories": setup_directories,
-        "ignore_dirs": setup_ignore_dirs,
-        "output_path": setup_output_path,
-        "json_output_path": setup_json_output_path,
-        "process_subfolders": setup_process_subfolders,
-        "temp_dir": temp_dir,
-        "limit_search": limit_search_var.get(),
-        "keywords": [entry.get() for entry in keyword_entries],
-        "widget_positions": save_widget_positions()
-    }
-    config_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")])
-    if config_path:
-        with open(config_path, 'w', encoding='utf-8') as config_file:
-            json.dump(config, config_file, indent=4, ensure_ascii=False)
-        messagebox.showinfo("Success", f"{lang['success']} {config_path}")
-        logging.info(f"Configuration saved: {config_path}")
-
-def load_configuration():
-    config_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
-    if config_path:
-        with open(config_path, 'r', encoding='utf-8') as config_file:
-            config = json.load(config_file)
-            global setup_directories, setup_ignore_dirs, setup_output_path, setup_json_output_path, setup_process_subfolders, temp_dir, limit_search_var
-            setup_directories = config.get("directories", [])
-            setup_ignore_dirs = config.get("ignore_dirs", [])
-            setup_output_path = config.get("output_path", "")
-            setup_json_output_path = config.get("json_output_path", "")
-            setup_process_subfolders = config.get("process_subfolders", True)
-            temp_dir = config.get("temp_dir", "temp")
-            limit_search_var.set(config.get("limit_search", "noLimit"))
-            
-            keyword_entries.clear()
-            for keyword in config.get("keywords", []):
-                entry = tk.Entry(tab4, width=50)
-                entry.insert(0, keyword)
-                entry.pack(pady=5)
-                keyword_entries.append(entry)
-            
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            update_setup_ui()
-            load_widget_positions(config.get("widget_positions", {}))
-        messagebox.showinfo("Success", f"{lang['success']} {config_path}")
-        logging.info(f"Configuration loaded: {config_path}")
-
-# GUI
-root = TkinterDnD.Tk()
-root.title("Magic a LoRA")
-
-# Language selection
-lang_var = tk.StringVar(root)
-lang_var.set("en")  # default language
-languages = {"en": "English", "it": "Italian", "fr": "French", "de": "German", "es": "Spanish", "ro": "Romanian", "pt": "Portuguese", "pl": "Polish", "sw": "Swahili"}
-language_menu = tk.OptionMenu(root, lang_var, *languages.values(), command=lambda _: load_language(lang_var.get()))
-language_menu.pack()
-
-# Tabs
-tab_control = ttk.Notebook(root)
-tab1 = ttk.Frame(tab_control)
-tab2 = ttk.Frame(tab_control)
-tab3 = ttk.Frame(tab_control)
-tab4 = ttk.Frame(tab_control)
-tab5 = ttk.Frame(tab_control)
-tab_control.add(tab1, text='Convert')
-tab_control.add(tab2, text='Test SRT')
-tab_control.add(tab3, text='Create text file')
-tab_control.add(tab4, text='Create Json')
-tab_control.add(tab5, text='Setup')
-tab_control.pack(expand=1, fill='both')
-
-# Tab 1: Create SRT
-file_entry = tk.Entry(tab1, width=50)
-file_entry.pack(pady=10)
-browse_button = tk.Button(tab1, text=lang.get('browseVideo', 'Browse Video'), command=lambda: file_entry.insert(0, filedialog.askopenfilename()))
-browse_button.pack(pady=10)
-
-url_entry = tk.Entry(tab1, width=50)
-url_entry.pack(pady=10)
-url_label = tk.Label(tab1, text=lang.get('orEnterUrl', 'Or enter YouTube/Vimeo URL:'))
-url_label.pack(pady=10)
-
-download_audio_only_var = tk.BooleanVar()
-download_audio_only_checkbox = tk.Checkbutton(tab1, text=lang.get('downloadAudioOnly', 'Download Audio Only'), variable=download_audio_only_var)
-download_audio_only_checkbox.pack(pady=10)
-
-transcription_lang_var = tk.StringVar(root)
-transcription_lang_var.set("it-IT")
-lang_options = ["en-US", "it-IT", "fr-FR", "de-DE", "es-ES", "pt-PT", "ro-RO", "pl-PL"]
-transcription_lang_menu = tk.OptionMenu(tab1, transcription_lang_var, *lang_options)
-transcription_lang_menu.pack(pady=10)
-
-start_button = tk.Button(tab1, text=lang.get('startProcessing', 'Start Processing'), command=process_video)
-start_button.pack(pady=20)
-
-# Tab 2: Test SRT
-video_entry = tk.Entry(tab2, width=50)
-video_entry.pack(pady=10)
-video_browse_button = tk.Button(tab2, text=lang.get('browseVideo', 'Browse Video'), command=lambda: video_entry.insert(0, filedialog.askopenfilename()))
-video_browse_button.pack(pady=10)
-
-url_entry_video = tk.Entry(tab2, width=50)
-url_entry_video.pack(pady=10)
-url_label_video = tk.Label(tab2, text=lang.get('orEnterUrlVideo', 'Or enter YouTube/Vimeo URL:'))
-url_label_video.pack(pady=10)
-
-srt_entry = tk.Entry(tab2, width=50)
-srt_entry.pack(pady=10)
-srt_browse_button = tk.Button(tab2, text=lang.get('browseSRTFile', 'Browse SRT File'), command=lambda: srt_entry.insert(0, filedialog.askopenfilename()))
-srt_browse_button.pack(pady=10)
-
-load_video_button = tk.Button(tab2, text=lang.get('loadAndPlayVideo', 'Load and Play Video'), command=lambda: threading.Thread(target=load_video).start())
-load_video_button.pack(pady=20)
-
-# VLC video frame
-video_frame = ttk.Frame(tab2, height=400)
-video_frame.pack(fill='both', expand=True)
-
-# Initialize VLC player
-instance = vlc.Instance()
-player = instance.media_player_new()
-player.set_hwnd(video_frame.winfo_id())
-
-# Tab 3: Create text file
-create_text_file_log = configure_logger('Create_text_file')
-create_text_file_button = tk.Button(tab3, text=lang.get('startCreateTextFile', 'Start Create text file'), command=lambda: threading.Thread(target=start_create_text_file).start())
-create_text_file_button.pack(pady=20)
-create_text_file_log_display = tk.Text(tab3, height=15, state='disabled')
-create_text_file_log_display.pack(fill='both', expand=True)
-
-# Tab 4: Create Json
-create_json_log = configure_logger('Create_Json')
-chapter_keywords_label = tk.Label(tab4, text=lang.get('enterChapterKeywords', 'Enter chapter keywords (one per field):'))
-chapter_keywords_label.pack(pady=10)
-add_keyword_button = tk.Button(tab4, text=lang.get('addKeyword', 'Add Keyword'), command=add_keyword_entry)
-add_keyword_button.pack(pady=5)
-remove_keyword_button = tk.Button(tab4, text=lang.get('removeKeyword', 'Remove Keyword'), command=remove_keyword_entry)
-remove_keyword_button.pack(pady=5)
-create_json_button = tk.Button(tab4, text=lang.get('startCreateJson', 'Start Create Json'), command=lambda: threading.Thread(target=start_create_json).start())
-create_json_button.pack(pady=20)
-create_json_log_display = tk.Text(tab4, height=15, state='disabled')
-create_json_log_display.pack(fill='both', expand=True)
-
-# Tab 5: Setup
-directories_listbox = tk.Listbox(tab5, selectmode=tk.SINGLE)
-directories_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-add_directory_button = tk.Button(tab5, text=lang.get('addDirectory', 'Add Directory'), command=add_directory)
-add_directory_button.pack(pady=5)
-remove_directory_button = tk.Button(tab5, text=lang.get('removeDirectory', 'Remove Directory'), command=remove_directory)
-remove_directory_button.pack(pady=5)
-
-ignore_directories_listbox = tk.Listbox(tab5, selectmode=tk.SINGLE)
-ignore_directories_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-add_ignore_directory_button = tk.Button(tab5, text=lang.get('addIgnoreDirectory', 'Add Ignore Directory'), command=add_ignore_directory)
-add_ignore_directory_button.pack(pady=5)
-remove_ignore_directory_button = tk.Button(tab5, text=lang.get('removeIgnoreDirectory', 'Remove Ignore Directory'), command=remove_ignore_directory)
-remove_ignore_directory_button.pack(pady=5)
-
-output_path_label = tk.Label(tab5, text="")
-output_path_label.pack(pady=10)
-set_output_path_button = tk.Button(tab5, text=lang.get('setTextOutput', 'Set Text Output'), command=set_output_path)
-set_output_path_button.pack(pady=5)
-
-json_output_path_label = tk.Label(tab5, text="")
-json_output_path_label.pack(pady=10)
-set_json_output_path_button = tk.Button(tab5, text=lang.get('setJsonOutput', 'Set JSON Output'), command=set_json_output_path)
-set_json_output_path_button.pack(pady=5)
-
-temp_dir_label = tk.Label(tab5, text=temp_dir)
-temp_dir_label.pack(pady=10)
-set_temp_dir_button = tk.Button(tab5, text=lang.get('setTempDir', 'Set Temp Directory'), command=set_temp_dir)
-set_temp_dir_button.pack(pady=5)
-
-limit_search_var = tk.StringVar()
-limit_search_label = tk.Label(tab5, text=lang.get('limitSearch', 'Limit Search'))
-limit_search_label.pack(pady=10)
-limit_search_menu = ttk.Combobox(tab5, textvariable=limit_search_var)
-limit_search_menu['values'] = [lang.get('noLimit', 'No Limit'), lang.get('lastProducedPerType', 'Last Produced per Type'), lang.get('lastProducedInFolder', 'Last Produced in Folder'), lang.get('lastProducedSimilarTitle', 'Last Produced with Similar Title')]
-limit_search_menu.set(lang.get('noLimit', 'No Limit'))
-limit_search_menu.pack(pady=10)
-
-process_subfolders_var = tk.BooleanVar()
-process_subfolders_checkbox = tk.Checkbutton(tab5, text=lang.get('processSubfolders', 'Process Subfolders'), variable=process_subfolders_var, command=set_process_subfolders)
-process_subfolders_checkbox.pack(pady=5)
-
-save_config_button = tk.Button(tab5, text=lang.get('saveConfiguration', 'Save Configuration'), command=save_configuration)
-save_config_button.pack(pady=5)
-load_config_button = tk.Button(tab5, text=lang.get('loadConfiguration', 'Load Configuration'), command=load_configuration)
-load_config_button.pack(pady=5)
-
-# Enable dragging for the widgets in the Setup tab
-def make_draggable(widget):
-    widget.bind("<Button-1>", on_drag_start)
-    widget.bind("<B1-Motion>", on_drag_motion)
-
-def on_drag_start(event):
-    widget = event.widget
-    widget._drag_start_x = event.x
-    widget._drag_start_y = event.y
-
-def on_drag_motion(event):
-    widget = event.widget
-    x = widget.winfo_x() - widget._drag_start_x + event.x
-    y = widget.winfo_y() - widget._drag_start_y + event.y
-    widget.place(x=x, y=y)
-
-make_draggable(directories_listbox)
-make_draggable(add_directory_button)
-make_draggable(remove_directory_button)
-make_draggable(ignore_directories_listbox)
-make_draggable(add_ignore_directory_button)
-make_draggable(remove_ignore_directory_button)
-make_draggable(output_path_label)
-make_draggable(set_output_path_button)
-make_draggable(json_output_path_label)
-make_draggable(set_json_output_path_button)
-make_draggable(temp_dir_label)
-make_draggable(set_temp_dir_button)
-make_draggable(limit_search_label)
-make_draggable(limit_search_menu)
-make_draggable(process_subfolders_checkbox)
-make_draggable(save_config_button)
-make_draggable(load_config_button)
-
-def on_closing():
-    for thread in threading.enumerate():
-        if thread is not threading.main_thread():
-            thread.join(timeout=1)
-    root.destroy()
-
-root.protocol("WM_DELETE_WINDOW", on_closing)
-root.mainloop()
+import os
+import sys
+import argparse
+import json
+import logging
+import hashlib
+import tkinter as tk
+from tkinter import filedialog, messagebox, ttk
+from datetime import datetime
+import threading
+import queue
+import time
+import collections
+import contextlib
+import tempfile
+import shutil
+import subprocess
+import base64
+import codecs
+import array
+import wave
+import http.server
+import urllib.request
+import io
+import itertools
+import math
+import fnmatch
+import textwrap
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import multiprocessing.connection
+import importlib
+import importlib.util
+import csv
+import xml.etree.ElementTree as ET
+import zipfile
+import re
+import html.parser
+import mmap
+import bisect
+from difflib import SequenceMatcher
+
+# Optional libraries used by the file handlers. They are imported the first time
+# a file that needs them is processed, so a run on a text-only corpus never pays
+# for moviepy, pandas & co.
+backend_packages = {
+    "fitz": "PyMuPDF",
+    "pptx": "python-pptx",
+    "moviepy.editor": "moviepy",
+    "imageio_ffmpeg": "moviepy",
+    "speech_recognition": "SpeechRecognition",
+    "pydub": "pydub",
+    "pydub.silence": "pydub",
+    "ebooklib": "ebooklib",
+    "ebooklib.epub": "ebooklib",
+    "pandas": "pandas",
+    "openpyxl": "openpyxl",
+    "pytube": "pytube",
+    "docx": "python-docx",
+    "vosk": "vosk",
+    "psutil": "psutil",
+    "lxml.etree": "lxml",
+}
+loaded_backends = {}
+
+def load_backend(module_name):
+    module = loaded_backends.get(module_name)
+    if module is None:
+        module = importlib.import_module(module_name)
+        loaded_backends[module_name] = module
+    return module
+
+def backend_available(module_name):
+    if module_name in loaded_backends:
+        return True
+    try:
+        return importlib.util.find_spec(module_name.split('.')[0]) is not None
+    except (ImportError, ValueError):
+        return False
+
+# Temporary directory
+temp_dir = 'temp'
+if not os.path.exists(temp_dir):
+    os.makedirs(temp_dir)
+
+# Logger configuration
+def configure_logger(log_name):
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    log_file = os.path.join(temp_dir, f'{log_name}-{timestamp}.log')
+    logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    return log_file
+
+def current_log_file():
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return None
+
+# Global variable for language
+lang = {}
+
+# Load language translations from XML file
+def load_language(language_code):
+    global lang
+    try:
+        tree = ET.parse(f'{language_code}.xml')
+        root = tree.getroot()
+        lang = {}
+        for field in root.find('fields'):
+            lang[field.tag] = field.text
+        update_language(lang)
+    except Exception as e:
+        logging.error(f"Failed to load language file: {language_code}.xml - {str(e)}")
+        messagebox.showerror("Error", f"Failed to load language file: {str(e)}")
+
+# Function to update the interface language
+def update_language(lang):
+    try:
+        tab_control.tab(0, text=lang['convert'])
+        tab_control.tab(1, text=lang['testSRT'])
+        tab_control.tab(2, text=lang['createTextFile'])
+        tab_control.tab(3, text=lang['createJson'])
+        tab_control.tab(4, text=lang['setup'])
+        url_label.config(text=lang['orEnterUrl'])
+        browse_button.config(text=lang['browseVideo'])
+        start_button.config(text=lang['startProcessing'])
+        download_audio_only_checkbox.config(text=lang['downloadAudioOnly'])
+        url_label_video.config(text=lang['orEnterUrlVideo'])
+        video_browse_button.config(text=lang['browseVideo'])
+        srt_browse_button.config(text=lang['browseSRTFile'])
+        load_video_button.config(text=lang['loadAndPlayVideo'])
+        create_text_file_button.config(text=lang['startCreateTextFile'])
+        create_json_button.config(text=lang['startCreateJson'])
+        cancel_create_text_file_button.config(text=lang['cancelJob'])
+        cancel_create_json_button.config(text=lang['cancelJob'])
+        export_tokens_button.config(text=lang['exportTokens'])
+        chapter_keywords_label.config(text=lang['enterChapterKeywords'])
+        add_keyword_button.config(text=lang['addKeyword'])
+        remove_keyword_button.config(text=lang['removeKeyword'])
+        add_directory_button.config(text=lang['addDirectory'])
+        remove_directory_button.config(text=lang['removeDirectory'])
+        add_ignore_directory_button.config(text=lang['addIgnoreDirectory'])
+        remove_ignore_directory_button.config(text=lang['removeIgnoreDirectory'])
+        set_output_path_button.config(text=lang['setTextOutput'])
+        set_json_output_path_button.config(text=lang['setJsonOutput'])
+        process_subfolders_checkbox.config(text=lang['processSubfolders'])
+        save_config_button.config(text=lang['saveConfiguration'])
+        load_config_button.config(text=lang['loadConfiguration'])
+        limit_search_label.config(text=lang['limitSearch'])
+        workers_label.config(text=lang['parallelWorkers'])
+        incremental_checkbox.config(text=lang['incrementalUpdate'])
+        limit_search_menu['values'] = [lang['noLimit'], lang['lastProducedPerType'], lang['lastProducedInFolder'], lang['lastProducedSimilarTitle']]
+    except KeyError as e:
+        logging.error(f"Missing language key: {str(e)}")
+        messagebox.showerror("Error", f"Missing language key: {str(e)}")
+
+# Functions to handle different file types
+def remove_headers_footers(text):
+    lines = text.split('\n')
+    if len(lines) > 3:
+        return '\n'.join(lines[1:-1])
+    return text
+
+# Streaming handlers: the file stays open while the writer consumes the chunks.
+# An error halfway through is logged and ends the record.
+def iter_closing(chunks, resource, file_kind, file_path):
+    try:
+        yield from chunks
+    except Exception as e:
+        interrupted_streams.add(file_path)
+        logging.error(f"Failed to process {file_kind} file: {file_path} - {str(e)}")
+    finally:
+        resource.close()
+
+# Streaming version of remove_headers_footers: same result on the concatenated
+# chunks, but only the last line is ever held in memory
+def strip_headers_footers(chunks):
+    buffered = ''
+    header_dropped = False
+    for chunk in chunks:
+        buffered += chunk
+        if not header_dropped:
+            if buffered.count('\n') < 3:
+                continue
+            buffered = buffered[buffered.index('\n') + 1:]
+            header_dropped = True
+        last_newline = buffered.rfind('\n')
+        if last_newline > 0:
+            yield buffered[:last_newline]
+            buffered = buffered[last_newline:]
+    if not header_dropped:
+        yield buffered
+
+def handle_text_file(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+            text = file.read()
+        return remove_headers_footers(text), file_path
+    except Exception as e:
+        logging.error(f"Failed to read or process text file: {file_path} - {str(e)}")
+        return f"Failed to read or process text file: {str(e)}", None
+
+def handle_pdf_file(file_path):
+    try:
+        fitz = load_backend("fitz")
+        with fitz.open(file_path) as doc:
+            text = ''.join(strip_headers_footers(iter_pdf_text(doc, setup_pdf_page_range)))
+        return text, file_path
+    except Exception as e:
+        logging.error(f"Failed to process PDF file: {file_path} - {str(e)}")
+        return f"Failed to process PDF file: {file_path} - {str(e)}", None
+
+# Page by page PDF extraction: the document is never held as a single string
+def pdf_page_bounds(page_count, page_range):
+    if not page_range:
+        return 0, page_count
+    first, last = page_range
+    return max(0, (first or 1) - 1), min(page_count, last or page_count)
+
+def iter_pdf_text(doc, page_range=None):
+    first, last = pdf_page_bounds(len(doc), page_range)
+    for page_number in range(first, last):
+        text = doc[page_number].get_text("text")
+        yield text if page_number == first else '\n' + text
+
+def stream_pdf_file(file_path):
+    try:
+        doc = load_backend("fitz").open(file_path)
+    except Exception as e:
+        logging.error(f"Failed to process PDF file: {file_path} - {str(e)}")
+        return f"Failed to process PDF file: {file_path} - {str(e)}", None
+    return strip_headers_footers(iter_closing(iter_pdf_text(doc, setup_pdf_page_range), doc, "PDF", file_path)), file_path
+
+# Page batches of a single large PDF, extracted by the worker pool
+def pdf_page_count(file_path):
+    with load_backend("fitz").open(file_path) as doc:
+        return len(doc)
+
+def extract_pdf_pages(file_path, first, last):
+    with load_backend("fitz").open(file_path) as doc:
+        return '\n'.join(doc[page_number].get_text("text") for page_number in range(first, last))
+
+def stream_pdf_batches(file_path, page_count, executor, workers):
+    first, last = pdf_page_bounds(page_count, setup_pdf_page_range)
+    batches = collections.deque((start, min(start + setup_pdf_page_batch, last)) for start in range(first, last, setup_pdf_page_batch))
+    pending = collections.deque()
+    separator = ''
+    try:
+        while batches or pending:
+            while batches and len(pending) < workers:
+                start, stop = batches.popleft()
+                pending.append(executor.submit(extract_pdf_pages, file_path, start, stop))
+            yield separator + pending.popleft().result()
+            separator = '\n'
+    except Exception as e:
+        interrupted_streams.add(file_path)
+        logging.error(f"Failed to process PDF file: {file_path} - {str(e)}")
+    finally:
+        for future in pending:
+            future.cancel()
+
+def handle_word_file(file_path):
+    try:
+        doc = load_backend("docx").Document(file_path)
+        text = '\n'.join([para.text for para in doc.paragraphs])
+        return remove_headers_footers(text), file_path
+    except Exception as e:
+        logging.error(f"Failed to process Word file: {file_path} - {str(e)}")
+        return f"Failed to process Word file: {file_path} - {str(e)}", None
+
+def handle_ppt_file(file_path):
+    try:
+        ppt = load_backend("pptx").Presentation(file_path)
+        text = [shape.text for slide in ppt.slides for shape in slide.shapes if hasattr(shape, "text")]
+        return remove_headers_footers('\n'.join(text)), file_path
+    except Exception as e:
+        logging.error(f"Failed to process PowerPoint file: {file_path} - {str(e)}")
+        return f"Failed to process PowerPoint file: {file_path} - {str(e)}", None
+
+def handle_excel_file(file_path):
+    # Legacy .xls workbooks, read through pandas
+    try:
+        sheets = load_backend("pandas").read_excel(file_path, sheet_name=None, nrows=setup_max_rows_per_sheet or None)
+        text = []
+        for sheet_name, df in sheets.items():
+            if len(sheets) > 1:
+                text.append(f"Sheet: {sheet_name}\n")
+            text.append(df.to_csv(index=False))
+        return ''.join(text), file_path
+    except Exception as e:
+        logging.error(f"Failed to process Excel file: {file_path} - {str(e)}")
+        return f"Failed to process Excel file: {file_path} - {str(e)}", None
+
+# .xlsx workbooks are read row by row with openpyxl in read-only mode, all sheets
+def open_workbook(file_path):
+    return load_backend("openpyxl").load_workbook(file_path, read_only=True, data_only=True)
+
+def iter_xlsx_text(workbook):
+    multiple_sheets = len(workbook.worksheets) > 1
+    for sheet in workbook.worksheets:
+        if multiple_sheets:
+            yield f"Sheet: {sheet.title}\n"
+        rows = sheet.iter_rows(values_only=True)
+        if setup_max_rows_per_sheet:
+            rows = itertools.islice(rows, setup_max_rows_per_sheet)
+        yield from iter_csv_chunks(rows)
+
+def iter_csv_chunks(rows, rows_per_chunk=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for count, row in enumerate(rows, 1):
+        writer.writerow(['' if value is None else value for value in row])
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def handle_xlsx_file(file_path):
+    try:
+        workbook = open_workbook(file_path)
+        try:
+            text = ''.join(iter_xlsx_text(workbook))
+        finally:
+            workbook.close()
+        return text, file_path
+    except Exception as e:
+        logging.error(f"Failed to process Excel file: {file_path} - {str(e)}")
+        return f"Failed to process Excel file: {file_path} - {str(e)}", None
+
+def stream_xlsx_file(file_path):
+    try:
+        workbook = open_workbook(file_path)
+    except Exception as e:
+        logging.error(f"Failed to process Excel file: {file_path} - {str(e)}")
+        return f"Failed to process Excel file: {file_path} - {str(e)}", None
+    return iter_closing(iter_xlsx_text(workbook), workbook, "Excel", file_path), file_path
+
+def iter_csv_text(file):
+    rows = csv.reader(file)
+    if setup_max_rows_per_sheet:
+        rows = itertools.islice(rows, setup_max_rows_per_sheet)
+    separator = ''
+    while True:
+        chunk = [','.join(row) for row in itertools.islice(rows, 1000)]
+        if not chunk:
+            break
+        yield separator + '\n'.join(chunk)
+        separator = '\n'
+
+def handle_csv_file(file_path):
+    try:
+        with open(file_path, mode='r', encoding='utf-8', newline='') as f:
+            text = ''.join(iter_csv_text(f))
+        return text, file_path
+    except Exception as e:
+        logging.error(f"Failed to process CSV file: {file_path} - {str(e)}")
+        return f"Failed to process CSV file: {file_path} - {str(e)}", None
+
+def stream_csv_file(file_path):
+    try:
+        f = open(file_path, mode='r', encoding='utf-8', newline='')
+    except Exception as e:
+        logging.error(f"Failed to process CSV file: {file_path} - {str(e)}")
+        return f"Failed to process CSV file: {file_path} - {str(e)}", None
+    return iter_closing(iter_csv_text(f), f, "CSV", file_path), file_path
+
+# HTML and XHTML (web pages and the documents of an EPUB) are parsed with lxml, which ebooklib
+# already installs, or with the standard html.parser when it is missing. Scripts, styles,
+# navigation and the other elements that hold no text are left out; block elements end a line.
+html_skipped_tags = ('script', 'style', 'nav', 'noscript', 'template', 'svg')
+html_block_tags = ('address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'figcaption', 'figure', 'footer',
+                   'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'ol', 'p', 'pre', 'section', 'table',
+                   'td', 'th', 'title', 'tr', 'ul')
+
+def html_text(content):
+    # content: the bytes (or text) of an HTML or XHTML document
+    if isinstance(content, bytes):
+        encoding = html_encoding(content)
+    else:
+        encoding, content = 'utf-8', content.encode('utf-8')
+    if backend_available("lxml.etree"):
+        text = lxml_html_text(content, encoding)
+    else:
+        parser = HtmlTextParser()
+        parser.feed(content.decode(encoding, errors='replace'))
+        parser.close()
+        text = ''.join(parser.parts)
+    return '\n'.join([line for line in map(' '.join, map(str.split, text.splitlines())) if line])
+
+def html_encoding(content):
+    try:
+        content.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    match = re.search(rb'(?:charset|encoding)\s*=\s*["\']?([\w.:-]+)', content[:4096], re.IGNORECASE)
+    if match:
+        with contextlib.suppress(LookupError):
+            return codecs.lookup(match.group(1).decode('ascii')).name
+    return 'cp1252'
+
+def lxml_html_text(content, encoding):
+    # The plain lxml.etree tree: lxml.html would look up a Python class for every element
+    etree = load_backend("lxml.etree")
+    document = etree.fromstring(content, parser=etree.HTMLParser(encoding=encoding))
+    if document is None:
+        # Documents with nothing to parse (empty, only whitespace or comments)
+        return ''
+    etree.strip_elements(document, *html_skipped_tags, with_tail=False)
+    for element in document.iter(*html_block_tags):
+        element.tail = '\n' + element.tail if element.tail else '\n'
+        if element.text:
+            element.text = '\n' + element.text
+    return etree.tostring(document, method='text', encoding='unicode')
+
+class HtmlTextParser(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipped = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in html_skipped_tags:
+            self.skipped += 1
+        elif tag in html_block_tags:
+            self.parts.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in html_block_tags:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in html_skipped_tags:
+            self.skipped = max(self.skipped - 1, 0)
+        elif tag in html_block_tags:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipped:
+            self.parts.append(data)
+
+def handle_html_file(file_path):
+    try:
+        with open(file_path, 'rb') as html_file:
+            return html_text(html_file.read()), file_path
+    except Exception as e:
+        logging.error(f"Failed to process HTML file: {file_path} - {str(e)}")
+        return f"Failed to process HTML file: {file_path} - {str(e)}", None
+
+def handle_epub_file(file_path):
+    try:
+        ebooklib = load_backend("ebooklib")
+        book = load_backend("ebooklib.epub").read_epub(file_path)
+        # item.content is the document as stored, get_content() would parse and serialize it again
+        documents = [item.content for item in epub_documents(book, ebooklib)]
+        # With epub_workers the documents are parsed by threads (lxml releases the GIL while parsing)
+        if setup_epub_workers > 1 and len(documents) > 1:
+            with ThreadPoolExecutor(max_workers=setup_epub_workers) as executor:
+                text = list(executor.map(html_text, documents))
+        else:
+            text = [html_text(document) for document in documents]
+        return remove_headers_footers('\n'.join(text)), file_path
+    except Exception as e:
+        logging.error(f"Failed to process EPUB file: {file_path} - {str(e)}")
+        return f"Failed to process EPUB file: {file_path} - {str(e)}", None
+
+def epub_documents(book, ebooklib):
+    # Reading order: the spine, then the documents it does not list
+    documents = [item for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT]
+    spine = {idref: position for position, (idref, linear) in enumerate(book.spine)}
+    return sorted(documents, key=lambda item: spine.get(item.get_id(), len(spine)))
+
+def handle_xml_gan_file(file_path):
+    try:
+        tree = ET.parse(file_path)
+        root = tree.getroot()
+        texts = [elem.text for elem in root.iter() if elem.text is not None]
+        return '\n'.join(texts), file_path
+    except Exception as e:
+        logging.error(f"Failed to process XML/GAN file: {file_path} - {str(e)}")
+        return f"Failed to process XML/GAN file: {file_path} - {str(e)}", None
+
+def handle_audio_file(file_path):
+    sr = load_backend("speech_recognition")
+    try:
+        with speech_audio_file(file_path) as wav_path:
+            return transcribe_audio_file(wav_path), file_path
+    except sr.UnknownValueError:
+        logging.warning(f"Speech not understood in file: {file_path}")
+        return "Speech not understood", file_path
+    except sr.RequestError as e:
+        logging.error(f"Speech recognition request failed for file: {file_path} - {e}")
+        return f"Speech recognition request failed; {e}", None
+    except Exception as e:
+        logging.error(f"Failed to process audio file: {file_path} - {str(e)}")
+        return f"Failed to process audio file: {file_path} - {str(e)}", None
+
+@contextlib.contextmanager
+def speech_audio_file(file_path):
+    # Mono PCM WAV files are read as they are, anything else (m4a, mp3, stereo...) is
+    # converted to a private file in temp_dir, never next to the source
+    try:
+        with wave.open(file_path, 'rb') as wav:
+            usable = wav.getnchannels() == 1
+    except (wave.Error, EOFError):
+        usable = False
+    if usable:
+        yield file_path
+        return
+    audio_path = extract_audio_track(file_path)
+    try:
+        yield audio_path
+    finally:
+        os.remove(audio_path)
+
+def handle_generic_video_file(file_path):
+    sr = load_backend("speech_recognition")
+    try:
+        audio_path = extract_audio_from_video(file_path)
+        try:
+            text = transcribe_audio_file(audio_path)
+        finally:
+            os.remove(audio_path)
+        return text, file_path
+    except sr.UnknownValueError:
+        return "Speech not understood", file_path
+    except sr.RequestError as e:
+        logging.error(f"Speech recognition request failed for file: {file_path} - {e}")
+        return f"Could not request results; {e}", None
+    except Exception as e:
+        logging.error(f"Failed to process video file: {file_path} - {str(e)}")
+        return f"Failed to process video file: {file_path} - {str(e)}", None
+
+def extract_audio_from_video(video_path):
+    return extract_audio_track(video_path)
+
+# Audio extraction: ffmpeg reads only the audio stream (the video frames are never
+# decoded) and writes the 16 kHz mono PCM the recognizer works on. Every call gets
+# its own file in temp_dir, the caller removes it.
+speech_sample_rate = 16000
+ffmpeg_path = None
+
+def ffmpeg_executable():
+    global ffmpeg_path
+    if ffmpeg_path is None:
+        ffmpeg_path = shutil.which('ffmpeg') or ''
+        if not ffmpeg_path and backend_available("imageio_ffmpeg"):
+            # The binary installed with moviepy
+            ffmpeg_path = load_backend("imageio_ffmpeg").get_ffmpeg_exe()
+    return ffmpeg_path
+
+def extract_audio_track(source_path):
+    fd, audio_path = tempfile.mkstemp(suffix='.wav', dir=temp_dir)
+    os.close(fd)
+    try:
+        ffmpeg = ffmpeg_executable()
+        if ffmpeg:
+            command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path,
+                       '-vn', '-sn', '-dn', '-ac', '1', '-ar', str(speech_sample_rate), '-acodec', 'pcm_s16le', audio_path]
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.decode('utf-8', errors='replace').strip() or f"ffmpeg exited with code {result.returncode}")
+        else:
+            clip = load_backend("moviepy.editor").AudioFileClip(source_path)
+            try:
+                clip.write_audiofile(audio_path, fps=speech_sample_rate, nbytes=2, codec='pcm_s16le', ffmpeg_params=['-ac', '1'], logger=None)
+            finally:
+                clip.close()
+    except Exception:
+        os.remove(audio_path)
+        raise
+    return audio_path
+
+def transcribe_audio(audio_path, language=None):
+    sr = load_backend("speech_recognition")
+    try:
+        return transcribe_audio_file(audio_path, language)
+    except sr.UnknownValueError:
+        return "Speech not understood"
+    except sr.RequestError as e:
+        return f"Could not request results; {e}"
+
+# Long recordings: the WAV file is read one window of transcription_window seconds at a
+# time, each window starting transcription_overlap seconds before the end of the previous
+# one, so memory does not depend on the length of the recording. The words repeated in
+# the overlap are dropped when the texts are joined.
+def transcribe_audio_file(audio_path, language=None):
+    sr = load_backend("speech_recognition")
+    words = []
+    for text in transcribe_batch(iter_audio_windows(audio_path), language):
+        if isinstance(text, sr.RequestError):
+            raise text
+        if not isinstance(text, sr.UnknownValueError):
+            append_transcript(words, text)
+    if not words:
+        raise sr.UnknownValueError()
+    return ' '.join(words)
+
+def iter_audio_windows(wav_path):
+    sr = load_backend("speech_recognition")
+    with wave.open(wav_path, 'rb') as wav:
+        frame_rate = wav.getframerate()
+        frame_size = wav.getsampwidth() * wav.getnchannels()
+        window_frames = max(1, int(setup_transcription_window * frame_rate))
+        overlap_frames = min(int(setup_transcription_overlap * frame_rate), window_frames // 2)
+        tail = b''
+        while True:
+            wanted = window_frames - len(tail) // frame_size
+            frames = wav.readframes(wanted)
+            if not frames:
+                break
+            data = tail + frames
+            yield sr.AudioData(data, frame_rate, wav.getsampwidth())
+            if len(frames) < wanted * frame_size:
+                break
+            tail = data[len(data) - overlap_frames * frame_size:] if overlap_frames else b''
+
+def append_transcript(words, text, max_overlap_words=20):
+    new_words = text.split()
+    longest = min(len(words), len(new_words), max_overlap_words)
+    for size in range(longest, 0, -1):
+        if [w.lower() for w in words[-size:]] == [w.lower() for w in new_words[:size]]:
+            new_words = new_words[size:]
+            break
+    words.extend(new_words)
+
+# Speech recognition backends. "transcribe" gets one sr.AudioData and a language code
+# and raises sr.UnknownValueError / sr.RequestError like the recognize_* methods of
+# SpeechRecognition. "max_concurrency" caps the segments sent to the backend at the
+# same time; "transcribe_batch", when given, takes a list of segments and returns a
+# list with the text or the exception of each one.
+transcription_backends = {}
+
+def register_transcription_backend(name, transcribe, max_concurrency=1, transcribe_batch=None, batch_size=16):
+    transcription_backends[name] = {
+        "name": name,
+        "transcribe": transcribe,
+        "max_concurrency": max_concurrency,
+        "transcribe_batch": transcribe_batch,
+        "batch_size": batch_size
+    }
+
+def transcription_backend():
+    backend = transcription_backends.get(setup_transcription_backend)
+    if backend is None:
+        raise ValueError(f"Unknown transcription backend: {setup_transcription_backend}")
+    return backend
+
+def transcribe(audio, language=None):
+    return transcribe_segment(transcription_backend(), audio, language or setup_transcription_language, raise_errors=True)
+
+def transcribe_segment(backend, audio, language, raise_errors=False):
+    sr = load_backend("speech_recognition")
+    key = transcript_cache_key(backend, audio, language)
+    text = read_cached_text("transcript", key)
+    if text is not None:
+        return text
+    try:
+        try:
+            text = backend["transcribe"](audio, language)
+        except ImportError as e:
+            raise sr.RequestError(f"transcription backend not installed - {str(e)}")
+    except (sr.UnknownValueError, sr.RequestError) as e:
+        if raise_errors:
+            raise
+        return e
+    store_cached_text("transcript", key, text)
+    return text
+
+def transcribe_segment_batch(backend, audios, language):
+    sr = load_backend("speech_recognition")
+    keys = [transcript_cache_key(backend, audio, language) for audio in audios]
+    results = [read_cached_text("transcript", key) for key in keys]
+    missing = [i for i, text in enumerate(results) if text is None]
+    if not missing:
+        return results
+    try:
+        texts = backend["transcribe_batch"]([audios[i] for i in missing], language)
+    except (ImportError, sr.RequestError) as e:
+        texts = [e if isinstance(e, sr.RequestError) else sr.RequestError(str(e))] * len(missing)
+    for i, text in zip(missing, texts):
+        results[i] = text
+        if isinstance(text, str):
+            store_cached_text("transcript", keys[i], text)
+    return results
+
+def transcript_cache_key(backend, audio, language):
+    if not cache_enabled():
+        return None
+    return cache_key("transcript", backend["name"], setup_transcription_model, language,
+                     audio.sample_rate, audio.sample_width, hashlib.sha256(audio.frame_data).hexdigest())
+
+def transcribe_batch(audios, language=None, workers=None):
+    # Yields, in order, the text of every segment or the exception raised for it
+    backend = transcription_backend()
+    language = language or setup_transcription_language
+    workers = max(1, min(workers or setup_transcription_workers, backend["max_concurrency"]))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if backend["transcribe_batch"] is None:
+            yield from iter_ordered_results(executor, transcribe_segment, ((backend, audio, language) for audio in audios), workers * 2)
+            return
+        audios = iter(audios)
+        batches = iter(lambda: list(itertools.islice(audios, backend["batch_size"])), [])
+        for results in iter_ordered_results(executor, transcribe_segment_batch, ((backend, batch, language) for batch in batches), workers * 2):
+            yield from results
+
+def transcribe_google(audio, language):
+    return load_backend("speech_recognition").Recognizer().recognize_google(audio, language=language)
+
+def transcribe_sphinx(audio, language):
+    return load_backend("speech_recognition").Recognizer().recognize_sphinx(audio, language=language)
+
+# Vosk runs offline; "transcription_model" is the folder of an unpacked Vosk model,
+# otherwise the model for the language is downloaded by Vosk on first use
+vosk_models = {}
+vosk_models_lock = threading.Lock()
+
+def transcribe_vosk(audio, language):
+    sr = load_backend("speech_recognition")
+    vosk = load_backend("vosk")
+    model_key = setup_transcription_model or language
+    with vosk_models_lock:
+        model = vosk_models.get(model_key)
+        if model is None:
+            try:
+                if setup_transcription_model:
+                    model = vosk.Model(setup_transcription_model)
+                else:
+                    model = vosk.Model(lang=language.split('-')[0].lower())
+            except Exception as e:
+                raise sr.RequestError(f"failed to load Vosk model {model_key} - {str(e)}")
+            vosk_models[model_key] = model
+    recognizer = vosk.KaldiRecognizer(model, speech_sample_rate)
+    recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=speech_sample_rate, convert_width=2))
+    text = json.loads(recognizer.FinalResult()).get("text", "")
+    if not text:
+        raise sr.UnknownValueError()
+    return text
+
+# "http" backend: POST {"language": ..., "segments": [{"audio": <base64 WAV>}, ...]}
+# to <transcription_url>/transcribe, answer {"results": [{"text": ...} or {"error": ...}]}.
+# serve_stub_transcription() below implements it locally.
+def transcribe_http_batch(audios, language):
+    sr = load_backend("speech_recognition")
+    request_body = json.dumps({
+        "language": language,
+        "segments": [{"audio": base64.b64encode(audio.get_wav_data()).decode('ascii')} for audio in audios]
+    }).encode('utf-8')
+    request = urllib.request.Request(setup_transcription_url.rstrip('/') + '/transcribe', data=request_body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            results = json.loads(response.read().decode('utf-8'))["results"]
+    except (OSError, ValueError, KeyError) as e:
+        raise sr.RequestError(f"transcription server {setup_transcription_url} failed - {str(e)}")
+    return [result["text"] if "text" in result else sr.UnknownValueError() if result.get("error") == "not understood" else sr.RequestError(result.get("error"))
+            for result in results]
+
+def transcribe_http(audio, language):
+    result = transcribe_http_batch([audio], language)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+register_transcription_backend("google", transcribe_google, max_concurrency=4)
+register_transcription_backend("sphinx", transcribe_sphinx, max_concurrency=1)
+register_transcription_backend("vosk", transcribe_vosk, max_concurrency=os.cpu_count() or 1)
+register_transcription_backend("http", transcribe_http, max_concurrency=8, transcribe_batch=transcribe_http_batch)
+
+# Stub transcription server for tests: answers every segment that contains sound
+# with a deterministic text (language, duration and a digest of the samples)
+class StubTranscriptionHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip('/') != '/transcribe':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            results = [stub_transcript(base64.b64decode(segment["audio"]), request.get("language", "")) for segment in request["segments"]]
+        except (ValueError, KeyError, TypeError, wave.Error) as e:
+            self.send_error(400, str(e))
+            return
+        body = json.dumps({"results": results}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+def stub_transcript(wav_data, language):
+    with wave.open(io.BytesIO(wav_data)) as wav:
+        frames = wav.readframes(wav.getnframes())
+        duration = wav.getnframes() / wav.getframerate()
+        sample_width = wav.getsampwidth()
+    samples = array.array('h', frames[:len(frames) // 2 * 2]) if sample_width == 2 else array.array('b', frames)
+    if not samples or max(abs(sample) for sample in samples) < 100:
+        return {"error": "not understood"}
+    return {"text": f"[{language}] {duration:.2f}s {hashlib.sha1(frames).hexdigest()[:8]}"}
+
+def serve_stub_transcription(port=8765, host='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((host, port), StubTranscriptionHandler)
+    print(f"Stub transcription server on http://{host}:{server.server_port}")
+    return server
+
+# Output writer: the texts go to model_N.txt files. With output_shard_size (MB) every
+# model_N.txt is a shard collecting records until it reaches that size, written through
+# one buffered handle; with 0 every source gets its own model_N.txt. The files are
+# written in binary mode with the same bytes a text mode file would have, so the offsets
+# of the records are known without flushing.
+output_buffer_size = 1024 * 1024
+
+def open_output_writer(output_dir, file_index=1, shard_size=0, incremental=False, records_file=None, flush_records=False):
+    # flush_records: every record is on disk before it is handed over (fused Create Json reads it back)
+    return {"dir": output_dir, "index": file_index, "shard_size": shard_size * 1024 * 1024, "incremental": incremental,
+            "file": None, "position": 0, "unflushed": 0, "records_file": records_file, "flush_records": flush_records}
+
+def encode_output(text):
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    return text.encode('utf-8')
+
+def write_output_record(output_file, position, content, original_path):
+    header = encode_output(f"\nOriginal file path: {original_path}\nFile content:\n")
+    output_file.write(header)
+    offset = position + len(header)
+    length = 0
+    for chunk in ([content] if isinstance(content, str) else content):
+        data = encode_output(chunk)
+        output_file.write(data)
+        length += len(data)
+    output_file.write(encode_output('\n'))
+    return offset, length
+
+def write_output(writer, content, original_path, output_index=None):
+    # Returns the location of the text (output file, byte offset, length) and the index of its file
+    if not writer["shard_size"]:
+        # A modified source of an incremental run rewrites its own file
+        index = output_index or writer["index"]
+        if index == writer["index"]:
+            writer["index"] += 1
+        output_name = f'model_{index}.txt'
+        with open(os.path.join(writer["dir"], output_name), 'wb' if writer["incremental"] else 'ab') as output_file:
+            offset, length = write_output_record(output_file, output_file.tell(), content, original_path)
+        writer["unflushed"] += length
+        return {"output": output_name, "offset": offset, "length": length}, index
+    if writer["file"] is None:
+        open_output_shard(writer)
+    index = writer["index"]
+    offset, length = write_output_record(writer["file"], writer["position"], content, original_path)
+    end = offset + length + len(encode_output('\n'))
+    writer["unflushed"] += end - writer["position"]
+    writer["position"] = end
+    location = {"output": f'model_{index}.txt', "offset": offset, "length": length}
+    if writer["position"] >= writer["shard_size"]:
+        close_output_shard(writer)
+        writer["index"] += 1
+    return location, index
+
+def open_output_shard(writer):
+    # Incremental runs go on filling the last shard, the others start from an empty one
+    output_path = os.path.join(writer["dir"], f'model_{writer["index"]}.txt')
+    writer["file"] = open(output_path, 'ab' if writer["incremental"] else 'wb', buffering=output_buffer_size)
+    writer["position"] = writer["file"].tell()
+
+def close_output_shard(writer):
+    writer["file"].close()
+    writer["file"] = None
+    if writer["records_file"] is not None:
+        writer["records_file"].flush()
+    writer["unflushed"] = 0
+
+def add_record(writer, record):
+    # A record line is flushed only after the text it points to
+    if writer["records_file"] is not None:
+        writer["records_file"].write(json.dumps(record, ensure_ascii=False) + '\n')
+    if writer["flush_records"] or writer["unflushed"] >= output_buffer_size:
+        flush_output(writer)
+
+def flush_output(writer):
+    if writer["file"] is not None:
+        writer["file"].flush()
+    if writer["records_file"] is not None:
+        writer["records_file"].flush()
+    writer["unflushed"] = 0
+
+def close_output_writer(writer):
+    if writer["file"] is not None:
+        close_output_shard(writer)
+    if writer["records_file"] is not None:
+        writer["records_file"].close()
+
+def resume_shard_index(incremental, output_dir, shard_size):
+    # The shard written last, when it still has room, otherwise a new one
+    file_index = next_output_index(incremental)
+    last_shard = os.path.join(output_dir, f'model_{file_index - 1}.txt')
+    if file_index > 1 and os.path.exists(last_shard) and os.path.getsize(last_shard) < shard_size * 1024 * 1024:
+        return file_index - 1
+    return file_index
+
+# Records: for every output written, Create text file adds a line to records.jsonl in the
+# output directory with the source, the handler, the output file and the byte offset and
+# length of the text. Create Json reads the text from there instead of parsing model_N.txt.
+records_file_name = 'records.jsonl'
+
+def new_record(file_path, original_path, location):
+    entry = file_handlers.get(os.path.splitext(file_path)[1].lower())
+    return dict(source=original_path if original_path is not None else file_path, handler=entry[0].__name__ if entry else None,
+                **location, failed=original_path is None)
+
+def iter_records_file(output_dir):
+    with open(os.path.join(output_dir, records_file_name), 'r', encoding='utf-8') as records_file:
+        for line in records_file:
+            if line.strip():
+                yield json.loads(line)
+
+def read_record_text(output_dir, record):
+    with open(os.path.join(output_dir, record["output"]), 'rb') as file:
+        file.seek(record["offset"])
+        text = file.read(record["length"]).decode('utf-8', errors='replace')
+    # See encode_output
+    return text.replace(os.linesep, '\n') if os.linesep != '\n' else text
+
+def save_records(records, output_dir):
+    records_path = os.path.join(output_dir, records_file_name)
+    with open(records_path + '.tmp', 'w', encoding='utf-8') as records_file:
+        for record in records:
+            records_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(records_path + '.tmp', records_path)
+
+# ZIP archives: every member is read from the archive on its own, nested archives
+# are opened from the enclosing one. A member is addressed as "archive.zip!/dir/file.pdf"
+# (one "!/" per nesting level) and that path is written as its original file path.
+zip_member_separator = '!/'
+
+def is_zip_member(file_path):
+    return zip_member_separator in file_path
+
+def handle_zip_file(zip_path):
+    try:
+        text = []
+        for member_path in iter_zip_members(zip_path):
+            content, original_path = handle_zip_member(member_path)
+            if original_path is not None and content and not content.startswith("Unsupported"):
+                file_name = member_path[len(zip_path) + len(zip_member_separator):]
+                text.append(f"{content} (from {file_name} in {zip_path})")
+        if text:
+            return '\n'.join(text), zip_path
+        return "No supported files found or failed to process", None
+    except Exception as e:
+        logging.error(f"Failed to process ZIP file: {zip_path} - {str(e)}")
+        return f"Failed to process ZIP file: {str(e)}", None
+
+def iter_zip_members(zip_path):
+    with zipfile.ZipFile(zip_path) as archive:
+        yield from iter_archive_members(archive, zip_path, 1)
+
+def iter_archive_members(archive, archive_path, depth):
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        member_path = archive_path + zip_member_separator + info.filename
+        if not info.filename.lower().endswith('.zip'):
+            yield member_path
+            continue
+        if depth >= setup_zip_max_depth:
+            logging.warning(f"Nested archive too deep, skipped: {member_path}")
+            continue
+        if info.file_size > setup_zip_max_member_size:
+            logging.warning(f"Nested archive too large, skipped: {member_path}")
+            continue
+        try:
+            with archive.open(info) as member, zipfile.ZipFile(member) as nested:
+                yield from iter_archive_members(nested, member_path, depth + 1)
+        except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+            logging.error(f"Failed to process ZIP file: {member_path} - {str(e)}")
+
+def expand_zip_file(zip_path):
+    # Used while scanning: the members become sources of their own, so they can be
+    # spread over the worker pool. An unreadable archive is handed on as is and
+    # reported as failed by handle_zip_file.
+    try:
+        archive = zipfile.ZipFile(zip_path)
+    except (zipfile.BadZipFile, OSError) as e:
+        logging.error(f"Failed to process ZIP file: {zip_path} - {str(e)}")
+        yield zip_path
+        return
+    with archive:
+        yield from iter_archive_members(archive, zip_path, 1)
+
+@contextlib.contextmanager
+def open_zip_member(member_path):
+    names = member_path.split(zip_member_separator)
+    with contextlib.ExitStack() as stack:
+        archive = stack.enter_context(zipfile.ZipFile(names[0]))
+        for name in names[1:-1]:
+            archive = stack.enter_context(zipfile.ZipFile(stack.enter_context(archive.open(name))))
+        info = archive.getinfo(names[-1])
+        if info.file_size > setup_zip_max_member_size:
+            raise ValueError(f"member larger than {setup_zip_max_member_size} bytes")
+        yield stack.enter_context(archive.open(info))
+
+def handle_zip_member(member_path):
+    extension = os.path.splitext(member_path)[1].lower()
+    if extension not in file_handlers or extension == '.zip':
+        return "Unsupported file format for {}".format(member_path), None
+    # The handlers work on files: the member is copied to a private temporary file,
+    # so concurrent runs and workers never share a name in temp_dir
+    try:
+        fd, temp_path = tempfile.mkstemp(suffix=extension, dir=temp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file, open_zip_member(member_path) as member:
+                copied = 0
+                for block in iter(lambda: member.read(1024 * 1024), b''):
+                    copied += len(block)
+                    if copied > setup_zip_max_member_size:
+                        raise ValueError(f"member larger than {setup_zip_max_member_size} bytes")
+                    temp_file.write(block)
+            content, original_path = handle_file(temp_path)
+        finally:
+            os.remove(temp_path)
+    except Exception as e:
+        logging.error(f"Failed to process ZIP member: {member_path} - {str(e)}")
+        return f"Failed to process ZIP member: {member_path} - {str(e)}", None
+    return content, (member_path if original_path is not None else None)
+
+# Yields the record of every output written
+def explore_directory(directory, writer, ignore_dirs, process_subfolders, limit_search, summary=None, executor=None, incremental=None, metrics=None, cancel=None, quarantine=None, deduplicator=None, workers=1):
+    if summary is None:
+        summary = new_run_summary()
+    stats = {} if incremental is not None else None
+    file_paths = iter_directory_files(directory, ignore_dirs, process_subfolders, limit_search, stats)
+    if incremental is not None:
+        file_paths = iter_changed_files(file_paths, incremental, summary, stats)
+    if quarantine is not None:
+        file_paths = skip_quarantined(file_paths, quarantine, summary)
+    for file_path, (content, original_path) in handle_files(file_paths, executor, metrics, workers):
+        if cancel is not None and cancel.is_set():
+            break
+        # Streamed texts are extracted while they are written, that time counts for the file too
+        started = time.perf_counter()
+        values = collections.Counter(files=1, bytes_in=source_size(file_path) if metrics is not None else 0)
+        content = peek_chunks(content)
+        duplicate = None
+        if deduplicator is not None and original_path is not None and is_extracted(content):
+            # The whole text is needed to compare it: streams are read into a string
+            content = content if isinstance(content, str) else ''.join(content)
+            duplicate = find_duplicate(deduplicator, content, file_path)
+        if duplicate is not None:
+            summary["duplicates"] += 1
+            values["duplicates"] += 1
+            record = None
+        elif is_extracted(content):
+            if metrics is not None:
+                content = count_characters(content, values)
+            if incremental is None:
+                location, output_index = write_output(writer, content, original_path)
+                record = new_record(file_path, original_path, location)
+            else:
+                record = write_incremental_output(content, writer, original_path, file_path, incremental)
+            add_record(writer, record)
+            summary["written"] += 1
+            if original_path is None:
+                summary["failed"] += 1
+                values["failed"] += 1
+        else:
+            summary["skipped"] += 1
+            values["skipped"] += 1
+            logging.info(content)
+            record = None
+        add_metrics(metrics, file_path, seconds=time.perf_counter() - started, **values)
+        if record is not None:
+            yield record
+
+def iter_directory_files(directory, ignore_dirs, process_subfolders, limit_search, stats=None):
+    # stats, when given, receives the stat of every file yielded (popped by iter_changed_files)
+    include_rules = compile_path_patterns(setup_include_patterns)
+    exclude_rules = compile_path_patterns(setup_exclude_patterns)
+    for folder, entries in iter_directory_entries(directory, ignore_dirs, process_subfolders, include_rules, exclude_rules):
+        for entry in limit_files_search(entries, limit_search):
+            if entry.name.lower().endswith('.zip'):
+                yield from expand_zip_file(entry.path)
+                continue
+            if stats is not None:
+                with contextlib.suppress(OSError):
+                    stats[entry.path] = entry.stat()
+            yield entry.path
+
+# Directory scan with os.scandir: every entry is read once and its stat is cached on the
+# DirEntry. Ignored directories are pruned with a set lookup; include_patterns and
+# exclude_patterns are glob rules ("*.pdf", ".docx", "drafts/*") compiled once per run.
+def iter_directory_entries(directory, ignore_dirs, process_subfolders, include_rules=None, exclude_rules=None):
+    # Yields (folder, DirEntry of its files) top-down, in the same order as os.walk
+    ignored = set(os.path.normcase(os.path.abspath(d)) for d in ignore_dirs)
+    stack = [(directory, '')]
+    while stack:
+        folder, relative_folder = stack.pop()
+        files = []
+        subfolders = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    relative_path = relative_folder + entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        # Like os.walk, symbolic links to directories are not followed
+                        if (process_subfolders and not entry.is_symlink()
+                                and os.path.normcase(os.path.abspath(entry.path)) not in ignored
+                                and not path_matches(exclude_rules, entry.name, relative_path)):
+                            subfolders.append((entry.path, relative_path + '/'))
+                    elif (include_rules is None or path_matches(include_rules, entry.name, relative_path)) and not path_matches(exclude_rules, entry.name, relative_path):
+                        files.append(entry)
+        except OSError as e:
+            logging.warning(f"Failed to read directory: {folder} - {str(e)}")
+            continue
+        yield folder, files
+        stack.extend(reversed(subfolders))
+
+def compile_path_patterns(patterns):
+    # Patterns with a "/" match the path relative to the scanned directory, the others
+    # the name only; ".pdf" is short for "*.pdf". Case is ignored.
+    name_patterns = []
+    path_patterns = []
+    for pattern in patterns:
+        pattern = pattern.strip().replace('\\', '/')
+        if not pattern:
+            continue
+        if pattern.startswith('.') and not any(char in pattern for char in '*?[/'):
+            pattern = '*' + pattern
+        (path_patterns if '/' in pattern else name_patterns).append(fnmatch.translate(pattern))
+    if not name_patterns and not path_patterns:
+        return None
+    return (re.compile('|'.join(name_patterns), re.IGNORECASE) if name_patterns else None,
+            re.compile('|'.join(path_patterns), re.IGNORECASE) if path_patterns else None)
+
+def path_matches(rules, name, relative_path):
+    if rules is None:
+        return False
+    name_pattern, path_pattern = rules
+    return bool(name_pattern and name_pattern.match(name)) or bool(path_pattern and path_pattern.match(relative_path))
+
+# Parallel extraction: the handlers run in a process pool, results are handed
+# back in submission order so model_N.txt numbering does not depend on which
+# worker finishes first
+def create_worker_pool(workers):
+    if setup_file_timeout > 0 or setup_worker_memory_limit > 0:
+        return SupervisedExecutor(max(workers, 1), worker_settings(), current_log_file(), setup_file_timeout, setup_worker_memory_limit)
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(worker_settings(), current_log_file()))
+
+# Supervised workers (file_timeout / worker_memory_limit): every worker process runs one
+# task at a time and is watched by a thread of the main process. A worker that runs a
+# task longer than file_timeout seconds, grows over worker_memory_limit MB or dies is
+# killed and replaced; its task fails and its file is listed in quarantined, so that a
+# hanging or exploding input costs one file instead of the whole run.
+class SupervisedExecutor(Executor):
+    def __init__(self, max_workers, settings, log_file, file_timeout=0, memory_limit=0):
+        self.settings = settings
+        self.log_file = log_file
+        self.file_timeout = file_timeout
+        self.memory_limit = memory_limit * 1024 * 1024
+        self.tasks = collections.deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.quarantined = []
+        self.wakeup_reader, self.wakeup_writer = multiprocessing.Pipe(duplex=False)
+        self.workers = [self.start_worker() for _ in range(max_workers)]
+        self.supervisor = threading.Thread(target=self.supervise, name='supervisor', daemon=True)
+        self.supervisor.start()
+
+    def start_worker(self):
+        connection, worker_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=supervised_worker, args=(worker_connection, self.settings, self.log_file), daemon=True)
+        process.start()
+        worker_connection.close()
+        return {"process": process, "connection": connection, "task": None, "started": 0}
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self.tasks.append((future, fn, args, kwargs))
+        self.wakeup_writer.send(None)
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.lock:
+            self.closed = True
+            if cancel_futures:
+                while self.tasks:
+                    self.tasks.popleft()[0].cancel()
+        self.wakeup_writer.send(None)
+        if wait:
+            self.supervisor.join()
+
+    def supervise(self):
+        while True:
+            with self.lock:
+                if self.closed and not self.tasks and all(worker["task"] is None for worker in self.workers):
+                    break
+            self.dispatch()
+            busy = [worker for worker in self.workers if worker["task"] is not None]
+            waited = [self.wakeup_reader] + [worker["connection"] for worker in busy] + [worker["process"].sentinel for worker in busy]
+            ready = multiprocessing.connection.wait(waited, timeout=0.5)
+            while self.wakeup_reader.poll():
+                self.wakeup_reader.recv()
+            for worker in busy:
+                if worker["connection"] in ready:
+                    self.receive(worker)
+                elif worker["process"].sentinel in ready:
+                    worker["process"].join(timeout=1)
+                    self.replace(worker, f"worker process exited with code {worker['process'].exitcode}")
+            self.check_limits()
+        for worker in self.workers:
+            with contextlib.suppress(OSError):
+                worker["connection"].send(None)
+        for worker in self.workers:
+            worker["process"].join(timeout=5)
+            if worker["process"].is_alive():
+                worker["process"].kill()
+            worker["connection"].close()
+
+    def dispatch(self):
+        for worker in self.workers:
+            if worker["task"] is not None:
+                continue
+            with self.lock:
+                if not self.tasks:
+                    return
+                future, fn, args, kwargs = self.tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                worker["connection"].send((fn, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            worker["task"] = (future, args)
+            worker["started"] = time.monotonic()
+
+    def receive(self, worker):
+        future, args = worker["task"]
+        try:
+            status, value = worker["connection"].recv()
+        except (EOFError, OSError):
+            self.replace(worker, "worker process died")
+            return
+        worker["task"] = None
+        if status == "ok":
+            future.set_result(value)
+        else:
+            future.set_exception(RuntimeError(value))
+
+    def check_limits(self):
+        for worker in self.workers:
+            if worker["task"] is None:
+                continue
+            if self.file_timeout > 0 and time.monotonic() - worker["started"] > self.file_timeout:
+                self.replace(worker, f"timed out after {self.file_timeout}s")
+            elif self.memory_limit > 0 and (process_rss(worker["process"].pid) or 0) > self.memory_limit:
+                self.replace(worker, f"used more than {self.memory_limit // (1024 * 1024)} MB")
+
+    def replace(self, worker, reason):
+        future, args = worker["task"]
+        worker["process"].kill()
+        worker["process"].join(timeout=5)
+        worker["connection"].close()
+        file_path = args[0] if args and isinstance(args[0], str) else None
+        logging.error(f"Worker stopped on file: {file_path} - {reason}")
+        if file_path is not None:
+            self.quarantined.append((file_path, reason))
+        future.set_exception(RuntimeError(reason))
+        worker.update(self.start_worker())
+
+def supervised_worker(connection, settings, log_file):
+    init_worker(settings, log_file)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        function, args, kwargs = task
+        try:
+            result = ("ok", function(*args, **kwargs))
+        except Exception as e:
+            result = ("error", f"{type(e).__name__}: {str(e)}")
+        connection.send(result)
+
+def process_rss(pid):
+    # Resident memory of a worker: psutil when installed, /proc on Linux, otherwise unknown
+    if backend_available("psutil"):
+        with contextlib.suppress(Exception):
+            return load_backend("psutil").Process(pid).memory_info().rss
+        return None
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+# Quarantine: files that stopped a supervised worker are listed in quarantine.json in the
+# output folder with their size and mtime, and skipped by the next runs until they change
+quarantine_file_name = 'quarantine.json'
+
+def load_quarantine(output_dir):
+    try:
+        with open(os.path.join(output_dir, quarantine_file_name), 'r', encoding='utf-8') as quarantine_file:
+            quarantine = json.load(quarantine_file)
+        if isinstance(quarantine.get("sources"), dict):
+            return quarantine
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"sources": {}}
+
+def skip_quarantined(file_paths, quarantine, summary):
+    for file_path in file_paths:
+        key = source_key(file_path)
+        entry = quarantine["sources"].get(key)
+        if entry is not None:
+            try:
+                fingerprint = source_fingerprint(file_path)
+            except OSError:
+                fingerprint = None
+            if fingerprint is not None and entry["size"] == fingerprint["size"] and entry["mtime"] == fingerprint["mtime"]:
+                summary["quarantined"] += 1
+                logging.warning(f"Skipped quarantined file: {file_path} - {entry['reason']}")
+                continue
+            # Modified since it was quarantined: tried again
+            del quarantine["sources"][key]
+        yield file_path
+
+def add_to_quarantine(quarantine, failures):
+    for file_path, reason in failures:
+        try:
+            fingerprint = source_fingerprint(file_path)
+        except OSError:
+            continue
+        quarantine["sources"][source_key(file_path)] = dict(fingerprint, reason=reason, time=datetime.now().isoformat(timespec='seconds'))
+
+# Deduplication (deduplicate / duplicate_threshold): before a text is written it is
+# compared with the texts kept so far. Texts equal once lowercased and reduced to their
+# words are exact duplicates (content hash). Near duplicates are found with MinHash on
+# word 5-grams and LSH banding: a text is only compared with those sharing a band of its
+# signature, so the cost per text does not grow with the corpus. The first text seen is
+# kept, the others are listed in duplicates.json.
+duplicates_file_name = 'duplicates.json'
+minhash_permutations = 64
+shingle_size = 5
+
+def new_deduplicator(threshold):
+    bands, rows = lsh_bands(threshold, minhash_permutations)
+    return {"threshold": threshold, "bands": bands, "rows": rows, "hashes": {}, "buckets": collections.defaultdict(list),
+            "signatures": [], "sources": [], "duplicates": []}
+
+def lsh_bands(threshold, permutations):
+    # The widest bands that still find 99% of the pairs at the threshold
+    for rows in sorted((rows for rows in range(1, permutations + 1) if permutations % rows == 0), reverse=True):
+        bands = permutations // rows
+        if 1 - (1 - threshold ** rows) ** bands >= 0.99:
+            return bands, rows
+    return permutations, 1
+
+def text_shingles(words):
+    if len(words) < shingle_size:
+        return {hash(tuple(words))}
+    return set(map(hash, zip(*(words[i:] for i in range(shingle_size)))))
+
+def minhash_signature(shingles, permutations):
+    # One permutation hashing: every shingle goes to one bin, which keeps its smallest
+    # value; an empty bin borrows from the next filled one (densification)
+    signature = [None] * permutations
+    for shingle in shingles:
+        shingle &= 0xFFFFFFFFFFFFFFFF
+        position, value = shingle % permutations, shingle // permutations
+        if signature[position] is None or value < signature[position]:
+            signature[position] = value
+    filled = [position for position, value in enumerate(signature) if value is not None]
+    for position in range(permutations):
+        if signature[position] is None:
+            distance = next(((filled_position - position) % permutations for filled_position in filled if filled_position > position), None)
+            if distance is None:
+                distance = filled[0] + permutations - position
+            signature[position] = hash((signature[(position + distance) % permutations], distance))
+    return signature
+
+def find_duplicate(deduplicator, text, source):
+    # Returns the entry added to the report when text duplicates a kept text, None when it is kept
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return None
+    content_hash = hashlib.sha1(' '.join(words).encode('utf-8')).hexdigest()
+    kept = deduplicator["hashes"].get(content_hash)
+    duplicate = None
+    if kept is not None:
+        duplicate = {"source": source, "kept": deduplicator["sources"][kept], "kind": "exact", "similarity": 1.0}
+    elif deduplicator["threshold"] < 1:
+        signature = minhash_signature(text_shingles(words), minhash_permutations)
+        rows = deduplicator["rows"]
+        band_keys = [hash((band, *signature[band * rows:(band + 1) * rows])) for band in range(deduplicator["bands"])]
+        candidates = set(candidate for key in band_keys for candidate in deduplicator["buckets"].get(key, ()))
+        best = None
+        for candidate in candidates:
+            similarity = sum(a == b for a, b in zip(signature, deduplicator["signatures"][candidate])) / minhash_permutations
+            if similarity >= deduplicator["threshold"] and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        if best is not None:
+            duplicate = {"source": source, "kept": deduplicator["sources"][best[0]], "kind": "near", "similarity": round(best[1], 3)}
+    if duplicate is not None:
+        deduplicator["duplicates"].append(duplicate)
+        logging.info(f"Duplicate of {duplicate['kept']} ({duplicate['kind']}, {duplicate['similarity']}): {source}")
+        return duplicate
+    index = len(deduplicator["sources"])
+    deduplicator["sources"].append(source)
+    deduplicator["hashes"][content_hash] = index
+    if deduplicator["threshold"] < 1:
+        deduplicator["signatures"].append(array.array('q', signature))
+        for key in band_keys:
+            deduplicator["buckets"][key].append(index)
+    else:
+        deduplicator["signatures"].append(None)
+    return None
+
+def save_duplicates_report(deduplicator, output_dir):
+    report_path = os.path.join(output_dir, duplicates_file_name)
+    with open(report_path + '.tmp', 'w', encoding='utf-8') as report_file:
+        json.dump({"threshold": deduplicator["threshold"], "kept": len(deduplicator["sources"]), "duplicates": deduplicator["duplicates"]},
+                  report_file, indent=1, ensure_ascii=False)
+    os.replace(report_path + '.tmp', report_path)
+
+def save_quarantine(quarantine, output_dir):
+    quarantine_path = os.path.join(output_dir, quarantine_file_name)
+    if not quarantine["sources"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(quarantine_path)
+        return
+    with open(quarantine_path + '.tmp', 'w', encoding='utf-8') as quarantine_file:
+        json.dump(quarantine, quarantine_file, indent=1, ensure_ascii=False)
+    os.replace(quarantine_path + '.tmp', quarantine_path)
+
+def init_worker(settings, log_file):
+    globals().update(settings)
+    if log_file and not logging.getLogger().handlers:
+        logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    load_handler_plugins(setup_handler_plugins)
+
+# Settings the handlers read, copied into every worker process
+def worker_settings():
+    return {
+        "temp_dir": temp_dir,
+        "setup_handler_plugins": setup_handler_plugins,
+        "setup_pdf_page_range": setup_pdf_page_range,
+        "setup_max_rows_per_sheet": setup_max_rows_per_sheet,
+        "setup_epub_workers": setup_epub_workers,
+        "setup_zip_max_depth": setup_zip_max_depth,
+        "setup_zip_max_member_size": setup_zip_max_member_size,
+        "setup_transcription_workers": setup_transcription_workers,
+        "setup_transcription_backend": setup_transcription_backend,
+        "setup_transcription_language": setup_transcription_language,
+        "setup_transcription_url": setup_transcription_url,
+        "setup_transcription_model": setup_transcription_model,
+        "setup_transcription_window": setup_transcription_window,
+        "setup_transcription_overlap": setup_transcription_overlap,
+        "setup_cache_dir": setup_cache_dir,
+        "setup_cache_max_size": setup_cache_max_size,
+    }
+
+def safe_handle_file(file_path, stream=False):
+    try:
+        return handle_file(file_path, stream)
+    except Exception as e:
+        logging.error(f"Failed to process file: {file_path} - {str(e)}")
+        return f"Failed to process file: {file_path} - {str(e)}", None
+
+def is_extracted(content):
+    # Streaming handlers return an iterator of text chunks instead of a string
+    if not isinstance(content, str):
+        return True
+    return bool(content) and not content.startswith("Unsupported")
+
+def peek_chunks(content):
+    # An iterator that yields nothing is reported as empty content, like an empty string
+    if isinstance(content, str):
+        return content
+    chunks = iter(content)
+    for chunk in chunks:
+        if chunk:
+            return itertools.chain([chunk], chunks)
+    return ''
+
+def timed_handle_file(file_path):
+    # Runs in a worker: the handler time goes back with the result
+    started = time.perf_counter()
+    result = safe_handle_file(file_path)
+    return result, time.perf_counter() - started
+
+def cached_timed_handle_file(file_path):
+    # Runs in a worker: the source is hashed there, in parallel with the other files, and not
+    # read once more by the main process. A hit sends back no text, the main process reads the
+    # cache entry; a miss is extracted and stored in the cache here
+    key = extraction_cache_key(file_path)
+    if cache_lookup("extraction", key) is not None:
+        return None, 0, key
+    result, seconds = timed_handle_file(file_path)
+    return cache_extraction(key, file_path, result), seconds, key
+
+def handle_files(file_paths, executor=None, metrics=None, workers=1):
+    if executor is None:
+        for file_path in file_paths:
+            key = extraction_cache_key(file_path)
+            cached = cached_extraction(key, file_path)
+            if cached is not None:
+                add_metrics(metrics, file_path, cached=1)
+                yield file_path, cached
+            else:
+                started = time.perf_counter()
+                result = safe_handle_file(file_path, stream=True)
+                add_metrics(metrics, file_path, seconds=time.perf_counter() - started)
+                yield file_path, cache_extraction(key, file_path, result)
+        return
+    # Keep a bounded number of files in flight so a huge tree is never queued all at once
+    window = max(workers, 1) * 4
+    pending = collections.deque()
+    for file_path in file_paths:
+        page_count = large_pdf_page_count(file_path, workers)
+        if page_count:
+            # Its pages go to every worker when its turn comes, only the hashing is queued now
+            pending.append((file_path, executor.submit(extraction_cache_key, file_path) if cache_enabled() else None, page_count))
+        else:
+            pending.append((file_path, None, executor.submit(cached_timed_handle_file, file_path)))
+        set_queue_depth(metrics, len(pending))
+        if len(pending) >= window:
+            yield collect_cached_result(*pending.popleft(), executor, workers, metrics)
+    while pending:
+        set_queue_depth(metrics, len(pending))
+        yield collect_cached_result(*pending.popleft(), executor, workers, metrics)
+    set_queue_depth(metrics, 0)
+
+def collect_cached_result(file_path, key, future, executor, workers, metrics=None):
+    # key: for a PDF split in page batches, the future of its cache key
+    if isinstance(future, int):
+        try:
+            key = key.result() if key is not None else None
+        except Exception:
+            key = None
+        cached = cached_extraction(key, file_path)
+        if cached is not None:
+            add_metrics(metrics, file_path, cached=1)
+            return file_path, cached
+        file_path, result = collect_result(file_path, future, executor, workers, metrics)
+        return file_path, cache_extraction(key, file_path, result)
+    return collect_result(file_path, future, executor, workers, metrics)
+
+def large_pdf_page_count(file_path, workers):
+    # PDFs longer than one page batch are split across the workers instead of going to one of them
+    if workers <= 1 or setup_pdf_page_batch <= 0 or not file_path.lower().endswith('.pdf') or not backend_available("fitz"):
+        return 0
+    try:
+        page_count = pdf_page_count(file_path)
+    except Exception:
+        return 0
+    return page_count if page_count > setup_pdf_page_batch else 0
+
+def collect_result(file_path, future, executor, workers, metrics=None):
+    if isinstance(future, int):
+        return file_path, (strip_headers_footers(stream_pdf_batches(file_path, future, executor, workers)), file_path)
+    try:
+        result, seconds, key = future.result()
+    except Exception as e:
+        # The worker itself died (e.g. BrokenProcessPool), the file is reported as failed
+        logging.error(f"Worker failed on file: {file_path} - {str(e)}")
+        return file_path, (f"Failed to process file: {file_path} - {str(e)}", None)
+    if key is not None and result is not None:
+        # The cache statistics of the run are kept by the main process (a hit is counted when read)
+        count_cache("extraction misses")
+    if result is None:
+        cached = cached_extraction(key, file_path)
+        if cached is not None:
+            add_metrics(metrics, file_path, cached=1)
+            return file_path, cached
+        # Evicted since the worker found it
+        result = timed_handle_file(file_path)[0]
+    add_metrics(metrics, file_path, seconds=seconds)
+    return file_path, result
+
+def new_run_summary():
+    return {"written": 0, "skipped": 0, "failed": 0, "unchanged": 0, "removed": 0, "cached": 0, "quarantined": 0, "duplicates": 0, "cancelled": False, "warnings": []}
+
+# Run metrics: for every file of a Create text file run, the time spent on it, the bytes
+# read and the characters written, summed per format (extension) so the slow formats
+# stand out. The handler time is measured where the handler runs, in the worker with
+# workers > 1. The GUI shows the totals while the run goes on; at the end they are saved
+# in run_report.json in the output folder.
+report_file_name = 'run_report.json'
+metrics_lock = threading.Lock()
+
+def new_run_metrics():
+    return {"started": time.time(), "finished": None, "total": collections.Counter(), "formats": collections.defaultdict(collections.Counter),
+            "queue_depth": 0, "max_queue_depth": 0, "report": None}
+
+def add_metrics(metrics, file_path, **values):
+    if metrics is None:
+        return
+    extension = os.path.splitext(file_path)[1].lower() or '(none)'
+    with metrics_lock:
+        metrics["total"].update(values)
+        metrics["formats"][extension].update(values)
+
+def set_queue_depth(metrics, depth):
+    # Files submitted to the workers and not collected yet
+    if metrics is not None:
+        metrics["queue_depth"] = depth
+        metrics["max_queue_depth"] = max(metrics["max_queue_depth"], depth)
+
+def source_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        # ZIP members have no file of their own
+        return 0
+
+def count_characters(content, values):
+    if isinstance(content, str):
+        values["characters_out"] += len(content)
+        return content
+    return iter_counted(content, values)
+
+def iter_counted(chunks, values):
+    for chunk in chunks:
+        values["characters_out"] += len(chunk)
+        yield chunk
+
+def metrics_rates(values, seconds):
+    seconds = max(seconds, 1e-6)
+    return {"files_per_second": round(values["files"] / seconds, 3), "mb_per_second": round(values["bytes_in"] / (1024 * 1024) / seconds, 3)}
+
+def run_report(metrics, summary=None, **details):
+    # Totals are rated over the run time, formats over the time spent on their files
+    with metrics_lock:
+        elapsed = (metrics["finished"] or time.time()) - metrics["started"]
+        total = collections.Counter(metrics["total"])
+        formats = {extension: collections.Counter(values) for extension, values in metrics["formats"].items()}
+    metric_names = ["files", "failed", "skipped", "cached", "seconds", "bytes_in", "characters_out"]
+    return {
+        "started": datetime.fromtimestamp(metrics["started"]).isoformat(timespec='seconds'),
+        "elapsed": round(elapsed, 3),
+        **details,
+        "summary": summary,
+        "total": {**{name: round(total[name], 3) for name in metric_names}, **metrics_rates(total, elapsed)},
+        "max_queue_depth": metrics["max_queue_depth"],
+        "formats": {extension: {**{name: round(values[name], 3) for name in metric_names}, **metrics_rates(values, values["seconds"])}
+                    for extension, values in sorted(formats.items(), key=lambda item: -item[1]["seconds"])},
+    }
+
+def save_run_report(report, output_dir):
+    report_path = os.path.join(output_dir, report_file_name)
+    with open(report_path + '.tmp', 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=1, ensure_ascii=False)
+    os.replace(report_path + '.tmp', report_path)
+    return report_path
+
+def format_run_metrics(metrics, top_formats=10):
+    report = run_report(metrics)
+    total = report["total"]
+    lines = [f"Files: {total['files']} ({total['files_per_second']:.1f}/s) - {total['bytes_in'] / (1024 * 1024):.1f} MB ({total['mb_per_second']:.2f} MB/s)"
+             f" - {total['failed']} failed - {total['skipped']} skipped - {total['cached']} from cache - queue {metrics['queue_depth']}"
+             f" - {report['elapsed']:.0f}s"]
+    for extension, values in list(report["formats"].items())[:top_formats]:
+        lines.append(f"{extension}: {values['files']} files, {values['seconds']:.1f}s, {values['files_per_second']:.1f} files/s,"
+                     f" {values['mb_per_second']:.2f} MB/s, {values['characters_out']} characters, {values['failed']} failed")
+    if metrics["report"]:
+        lines.append(f"Run report: {metrics['report']}")
+    return '\n'.join(lines)
+
+# Incremental runs: a manifest in the output directory remembers, for every source,
+# its size/mtime (and optionally a content hash) and the model_N.txt it produced.
+# Unchanged sources are not extracted again, outputs of removed sources are deleted.
+manifest_file_name = 'manifest.json'
+
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("version") == 1:
+            return manifest
+        logging.warning(f"Unknown manifest version, starting a new one: {manifest_path}")
+    except FileNotFoundError:
+        if any(name.startswith('model_') and name.endswith('.txt') for name in os.listdir(output_dir)):
+            logging.warning(f"No manifest in {output_dir}, existing model_N.txt files may be overwritten")
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to read manifest: {manifest_path} - {str(e)}")
+    return {"version": 1, "sources": {}}
+
+def save_manifest(manifest, output_dir):
+    manifest_path = os.path.join(output_dir, manifest_file_name)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, ensure_ascii=False)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def new_incremental_state(output_dir, hash_contents=False):
+    manifest = load_manifest(output_dir)
+    # Output files at the start of the run, those left without records are deleted at the end
+    outputs = set(entry["output"] for entry in manifest["sources"].values())
+    return {"manifest": manifest, "hash_contents": hash_contents, "seen": set(), "pending": {}, "outputs": outputs}
+
+def next_output_index(incremental):
+    return max((entry["index"] for entry in incremental["manifest"]["sources"].values()), default=0) + 1
+
+def source_key(file_path):
+    if is_zip_member(file_path):
+        zip_path, member_name = file_path.split(zip_member_separator, 1)
+        return os.path.abspath(zip_path) + zip_member_separator + member_name
+    return os.path.abspath(file_path)
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with (open_zip_member(file_path) if is_zip_member(file_path) else open(file_path, 'rb')) as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_fingerprint(file_path, stat=None):
+    # Archive members take the size and mtime of the archive that contains them
+    if stat is None:
+        stat = os.stat(file_path.split(zip_member_separator, 1)[0])
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def source_changed(incremental, key, file_path, fingerprint):
+    entry = incremental["manifest"]["sources"].get(key)
+    if entry is None or entry.get("failed"):
+        return True
+    if entry["size"] == fingerprint["size"] and entry["mtime"] == fingerprint["mtime"]:
+        return False
+    if incremental["hash_contents"] and entry.get("hash") and entry["size"] == fingerprint["size"]:
+        fingerprint["hash"] = file_hash(file_path)
+        if fingerprint["hash"] == entry["hash"]:
+            # Touched but not modified
+            entry["mtime"] = fingerprint["mtime"]
+            return False
+    return True
+
+def iter_changed_files(file_paths, incremental, summary, stats=None):
+    for file_path in file_paths:
+        key = source_key(file_path)
+        incremental["seen"].add(key)
+        try:
+            # The stat taken by the directory scan, when there is one
+            fingerprint = source_fingerprint(file_path, stats.pop(file_path, None) if stats else None)
+        except OSError:
+            yield file_path
+            continue
+        if source_changed(incremental, key, file_path, fingerprint):
+            incremental["pending"][key] = fingerprint
+            yield file_path
+        else:
+            summary["unchanged"] += 1
+
+def write_incremental_output(content, writer, original_path, file_path, incremental):
+    key = source_key(file_path)
+    sources = incremental["manifest"]["sources"]
+    entry = sources.get(key)
+    # Without shards a modified source rewrites its own model_N.txt, a new one takes the next free index
+    location, output_index = write_output(writer, content, original_path, entry["index"] if entry else None)
+    record = new_record(file_path, original_path, location)
+    fingerprint = incremental["pending"].pop(key, None) or source_fingerprint(file_path)
+    if incremental["hash_contents"] and "hash" not in fingerprint:
+        fingerprint["hash"] = file_hash(file_path)
+    sources[key] = dict(fingerprint, index=output_index, output=record["output"], failed=original_path is None, record=record)
+    return record
+
+def save_incremental_records(incremental, output_dir):
+    # records.jsonl lists every output, also those of unchanged sources kept from earlier runs
+    entries = sorted(incremental["manifest"]["sources"].values(), key=lambda entry: (entry["index"], entry.get("record", {}).get("offset", 0)))
+    if all("record" in entry for entry in entries):
+        save_records([entry["record"] for entry in entries], output_dir)
+        return
+    # Outputs written before records existed: Create Json reads the model_N.txt files instead
+    logging.info(f"Some outputs in {output_dir} have no record, {records_file_name} is not written")
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(output_dir, records_file_name))
+
+def prune_manifest(incremental, output_dir, directories, summary):
+    # Sources under a directory that is missing right now (unmounted drive...) are kept
+    missing_roots = tuple(os.path.join(os.path.abspath(d), '') for d in directories if not os.path.isdir(d))
+    sources = incremental["manifest"]["sources"]
+    for key in [key for key in sources if key not in incremental["seen"]]:
+        if missing_roots and key.startswith(missing_roots):
+            continue
+        entry = sources.pop(key)
+        summary["removed"] += 1
+        logging.info(f"Removed deleted source: {key} ({entry['output']})")
+
+def compact_outputs(incremental, writer):
+    # Output files no source points to any more are deleted. With shards, the texts of
+    # modified or removed sources would stay in their shard: every shard holding more than
+    # its live records, the one being filled included, is rewritten by copying them into a new shard.
+    entries_by_output = collections.defaultdict(list)
+    for entry in incremental["manifest"]["sources"].values():
+        entries_by_output[entry["output"]].append(entry)
+    current_shard = None
+    if writer["shard_size"]:
+        current_shard = f'model_{writer["index"]}.txt'
+        if writer["file"] is not None:
+            writer["file"].flush()
+        if shard_has_dead_text(writer["dir"], current_shard, entries_by_output.get(current_shard, [])):
+            if writer["file"] is not None:
+                close_output_shard(writer)
+            writer["index"] += 1
+            current_shard = f'model_{writer["index"]}.txt'
+    for output_name in sorted(incremental["outputs"] | set(entries_by_output)):
+        if output_name == current_shard:
+            continue
+        output_path = os.path.join(writer["dir"], output_name)
+        entries = entries_by_output.get(output_name)
+        if entries:
+            if not writer["shard_size"] or not shard_has_dead_text(writer["dir"], output_name, entries):
+                continue
+            for entry in sorted(entries, key=lambda entry: entry["record"]["offset"]):
+                record = entry["record"]
+                location, output_index = write_output(writer, read_record_text(writer["dir"], record), None if record["failed"] else record["source"])
+                record.update(location)
+                entry.update(index=output_index, output=location["output"])
+            logging.info(f"Compacted {output_name}: {len(entries)} records moved")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(output_path)
+
+def shard_has_dead_text(output_dir, output_name, entries):
+    # The size of a shard holding only live records is the sum of their headers, texts and
+    # trailing newlines (see write_output_record). Outputs written before records existed are left alone.
+    if any("record" not in entry for entry in entries):
+        return False
+    try:
+        size = os.path.getsize(os.path.join(output_dir, output_name))
+    except OSError:
+        return False
+    newline = len(encode_output('\n'))
+    live = sum(len(encode_output(f"\nOriginal file path: {None if entry['record']['failed'] else entry['record']['source']}\nFile content:\n"))
+               + entry["record"]["length"] + newline for entry in entries)
+    return live != size
+
+# Result cache: extracted text, segment transcripts and the audio tracks of the Convert
+# tab are stored under cache_dir, named after a SHA-256 of the source content and of
+# everything else that changes the result (handler, backend, language, settings), so
+# identical work becomes a file read. A used entry is touched; when the cache grows over
+# cache_max_size MB the least recently used entries are removed.
+cache_version = 1
+cache_statistics = collections.Counter()
+cache_lock = threading.Lock()
+# Streams that ended on an error (logged by iter_closing), their text is not cached
+interrupted_streams = set()
+
+# Settings that change the extracted text, part of every extraction cache key
+cached_settings = ["setup_pdf_page_range", "setup_max_rows_per_sheet", "setup_transcription_backend", "setup_transcription_language",
+                   "setup_transcription_model", "setup_transcription_window", "setup_transcription_overlap"]
+# Raised when a handler changes the text it produces: its earlier extractions are not reused
+handler_versions = {"handle_epub_file": 2}
+
+def cache_enabled():
+    return setup_cache_max_size > 0
+
+def cache_directory():
+    return setup_cache_dir or os.path.join(temp_dir, 'cache')
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps([cache_version, *parts], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def cache_entry_path(key, suffix='.txt'):
+    return os.path.join(cache_directory(), key[:2], key + suffix)
+
+def count_cache(event, count=1):
+    with cache_lock:
+        cache_statistics[event] += count
+
+def cache_lookup(kind, key, suffix='.txt'):
+    # Path of the entry, or None on a miss
+    if key is None:
+        return None
+    entry_path = cache_entry_path(key, suffix)
+    try:
+        os.utime(entry_path)
+    except OSError:
+        count_cache(f"{kind} misses")
+        return None
+    count_cache(f"{kind} hits")
+    return entry_path
+
+def open_cache_entry(key, suffix='.txt', binary=False):
+    # Entries are written to a temporary name and renamed when complete, so a reader
+    # (another worker, another run) never sees half an entry
+    try:
+        entry_dir = os.path.dirname(cache_entry_path(key, suffix))
+        os.makedirs(entry_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=entry_dir)
+        return temp_path, (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8', newline=''))
+    except OSError as e:
+        logging.warning(f"Failed to write cache entry: {key} - {str(e)}")
+        return None
+
+def commit_cache_entry(kind, key, entry, suffix='.txt'):
+    temp_path, entry_file = entry
+    try:
+        entry_file.close()
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, cache_entry_path(key, suffix))
+    except OSError as e:
+        logging.warning(f"Failed to write cache entry: {key} - {str(e)}")
+        discard_cache_entry(entry)
+        return
+    count_cache(f"{kind} stores")
+    with cache_lock:
+        cache_statistics["bytes since eviction"] += size
+        evict = cache_statistics["bytes since eviction"] > setup_cache_max_size * 1024 * 1024 // 4
+        if evict:
+            cache_statistics["bytes since eviction"] = 0
+    if evict:
+        evict_cache()
+
+def discard_cache_entry(entry):
+    temp_path, entry_file = entry
+    try:
+        entry_file.close()
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+def read_cached_text(kind, key):
+    entry_path = cache_lookup(kind, key)
+    if entry_path is None:
+        return None
+    try:
+        with open(entry_path, 'r', encoding='utf-8', newline='') as entry_file:
+            return entry_file.read()
+    except OSError:
+        return None
+
+def store_cached_text(kind, key, text):
+    entry = open_cache_entry(key) if key is not None else None
+    if entry is None:
+        return
+    try:
+        entry[1].write(text)
+    except OSError as e:
+        logging.warning(f"Failed to write cache entry: {key} - {str(e)}")
+        discard_cache_entry(entry)
+        return
+    commit_cache_entry(kind, key, entry)
+
+def iter_cached_text(entry_path, block_size=1024 * 1024):
+    with open(entry_path, 'r', encoding='utf-8', newline='') as entry_file:
+        yield from iter(lambda: entry_file.read(block_size), '')
+
+def iter_caching(chunks, kind, key, file_path):
+    # The chunks are copied to the cache while the writer consumes them, a failure of
+    # the cache never stops the extraction
+    interrupted_streams.discard(file_path)
+    entry = open_cache_entry(key)
+    try:
+        for chunk in chunks:
+            if entry is not None:
+                try:
+                    entry[1].write(chunk)
+                except OSError as e:
+                    logging.warning(f"Failed to write cache entry: {key} - {str(e)}")
+                    discard_cache_entry(entry)
+                    entry = None
+            yield chunk
+        if entry is not None and file_path not in interrupted_streams:
+            commit_cache_entry(kind, key, entry)
+            entry = None
+    finally:
+        interrupted_streams.discard(file_path)
+        if entry is not None:
+            discard_cache_entry(entry)
+
+def extraction_cache_key(file_path):
+    if not cache_enabled():
+        return None
+    entry = file_handlers.get(os.path.splitext(file_path)[1].lower())
+    if entry is None:
+        return None
+    try:
+        content_hash = file_hash(file_path)
+    except Exception:
+        return None
+    handler = entry[0]
+    settings = {name: globals()[name] for name in cached_settings}
+    # The script runs as __main__, and as __mp_main__ in the workers started by spawn (Windows)
+    handler_name = f"{'__main__' if handler.__module__ == '__mp_main__' else handler.__module__}.{handler.__qualname__}"
+    if handler.__name__ in handler_versions:
+        handler_name += f"@{handler_versions[handler.__name__]}"
+    return cache_key("extraction", handler_name, content_hash, settings)
+
+def cached_extraction(key, file_path):
+    entry_path = cache_lookup("extraction", key)
+    if entry_path is None:
+        return None
+    return iter_cached_text(entry_path), file_path
+
+def cache_extraction(key, file_path, result):
+    # Only successful extractions are stored, failures are tried again next time
+    content, original_path = result
+    if key is None or original_path is None or not is_extracted(content):
+        return result
+    if isinstance(content, str):
+        store_cached_text("extraction", key, content)
+        return result
+    return iter_caching(content, "extraction", key, file_path), original_path
+
+def cached_audio_track(source_path):
+    # Convert tab: the 16 kHz WAV of a video already converted is copied from the cache
+    if not cache_enabled():
+        return extract_audio_track(source_path)
+    key = cache_key("audio", file_hash(source_path), speech_sample_rate)
+    entry_path = cache_lookup("audio", key, '.wav')
+    if entry_path is not None:
+        fd, audio_path = tempfile.mkstemp(suffix='.wav', dir=temp_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(entry_path, audio_path)
+            return audio_path
+        except OSError:
+            os.remove(audio_path)
+    audio_path = extract_audio_track(source_path)
+    entry = open_cache_entry(key, '.wav', binary=True)
+    if entry is not None:
+        try:
+            with open(audio_path, 'rb') as audio_file:
+                shutil.copyfileobj(audio_file, entry[1])
+        except OSError as e:
+            logging.warning(f"Failed to write cache entry: {key} - {str(e)}")
+            discard_cache_entry(entry)
+        else:
+            commit_cache_entry("audio", key, entry, '.wav')
+    return audio_path
+
+def evict_cache():
+    if not cache_enabled():
+        return
+    entries = []
+    total_size = 0
+    stale = datetime.now().timestamp() - 24 * 3600
+    try:
+        subdirs = [entry.path for entry in os.scandir(cache_directory()) if entry.is_dir()]
+    except OSError:
+        return
+    for subdir in subdirs:
+        for entry in os.scandir(subdir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.tmp'):
+                # Left behind by a run that was killed
+                if stat.st_mtime < stale:
+                    with contextlib.suppress(OSError):
+                        os.remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    limit = setup_cache_max_size * 1024 * 1024
+    for mtime, size, entry_path in sorted(entries):
+        if total_size <= limit:
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+        total_size -= size
+        count_cache("evicted")
+
+def log_cache_statistics():
+    if cache_enabled():
+        statistics = {event: count for event, count in sorted(cache_statistics.items()) if event != "bytes since eviction"}
+        logging.info(f"Cache statistics: {statistics}")
+
+# limit_search works on the DirEntry objects of one folder, the modification times come
+# from the stat cached by the scan
+def entry_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        return 0
+
+def limit_files_search(entries, limit_search):
+    if limit_search == 'noLimit':
+        return entries
+    if limit_search == 'lastProducedPerType':
+        file_types = {}
+        for entry in entries:
+            file_type = os.path.splitext(entry.name)[1]
+            if file_type not in file_types:
+                file_types[file_type] = entry
+            else:
+                if entry_mtime(entry) > entry_mtime(file_types[file_type]):
+                    file_types[file_type] = entry
+        return list(file_types.values())
+    elif limit_search == 'lastProducedInFolder':
+        if entries:
+            return [max(entries, key=entry_mtime)]
+    elif limit_search == 'lastProducedSimilarTitle':
+        return newest_per_similar_title(entries, setup_similar_title_threshold)
+    return entries
+
+# lastProducedSimilarTitle: files whose titles differ only a little ("Report v2.docx",
+# "report_v3.pdf") form a group and only the newest one is kept. Two titles are compared
+# only when they share one of their rarest character trigrams (prefix filtering), so a
+# folder of thousands of files is not compared all against all. The groups are the same
+# as comparing every pair.
+
+def newest_per_similar_title(entries, threshold):
+    entries_by_title = {}
+    for entry in entries:
+        entries_by_title.setdefault(title_key(entry.name), []).append(entry)
+    titles = list(entries_by_title)
+    newest = {}
+    for title, group in zip(titles, group_similar_titles(titles, threshold)):
+        for entry in entries_by_title[title]:
+            if group not in newest or entry_mtime(entry) > entry_mtime(newest[group]):
+                newest[group] = entry
+    kept = set(id(entry) for entry in newest.values())
+    return [entry for entry in entries if id(entry) in kept]
+
+def title_key(file_name):
+    return ' '.join(re.findall(r'[^\W_]+', os.path.splitext(file_name)[0].lower()))
+
+def title_trigrams(title):
+    padded = f'  {title} '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def similar_title_bounds(length, threshold):
+    # Maps every partner length that can reach threshold to the most trigrams of a title of
+    # this length the pair can break. With m matched characters (SequenceMatcher ratio is
+    # 2 * m / both lengths) every unmatched character of the title breaks at most 3 of its
+    # trigrams and every unmatched character of the partner at most 2, where it splits two
+    # matched runs that are adjacent in the title.
+    bounds = {}
+    if length == 0:
+        return {0: 0}
+    for other in range(1, math.floor(length * (2 - threshold) / threshold + 1e-9) + 2):
+        total = length + other
+        matches = math.ceil(threshold * total / 2)
+        while matches > 0 and 2.0 * (matches - 1) / total >= threshold:
+            matches -= 1
+        while 2.0 * matches / total < threshold:
+            matches += 1
+        if matches <= min(length, other):
+            bounds[other] = 3 * (length - matches) + 2 * (other - matches)
+    return bounds
+
+def group_similar_titles(titles, threshold):
+    # Returns the group of every title, the same groups as comparing every pair. Two similar
+    # titles share one of the first broken + 1 trigrams of each, taken from the rarest, where
+    # broken is the most the longest allowed partner can break. Titles with no more than that
+    # many trigrams may share none with a similar one: two such titles are always compared.
+    trigrams = [title_trigrams(title) for title in titles]
+    frequency = collections.Counter(gram for grams in trigrams for gram in grams)
+    lengths = [len(title) for title in titles]
+    bounds = {}
+    parent = list(range(len(titles)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    index = collections.defaultdict(list)
+    short_titles = []
+    for i, grams in enumerate(trigrams):
+        if lengths[i] not in bounds:
+            bounds[lengths[i]] = similar_title_bounds(lengths[i], threshold)
+        broken = bounds[lengths[i]]
+        most_broken = max(broken.values())
+        prefix = sorted(grams, key=lambda gram: (frequency[gram], gram))[:most_broken + 1]
+        candidates = set()
+        for gram in prefix:
+            candidates.update(index[gram])
+            index[gram].append(i)
+        if len(grams) <= most_broken:
+            candidates.update(short_titles)
+            short_titles.append(i)
+        matcher = SequenceMatcher(None, b=titles[i])
+        for j in candidates:
+            # Cheap bounds first: partner length and shared trigram count
+            if lengths[j] not in broken or len(grams & trigrams[j]) < len(grams) - broken[lengths[j]]:
+                continue
+            if find(i) != find(j):
+                matcher.set_seq1(titles[j])
+                if matcher.quick_ratio() >= threshold and matcher.ratio() >= threshold:
+                    parent[find(i)] = find(j)
+    return [find(i) for i in range(len(titles))]
+
+# Handler registry: extension -> (handler, optional libraries it needs)
+file_handlers = {}
+missing_backends_logged = set()
+
+def register_handler(extensions, handler, backends=(), stream_handler=None):
+    # stream_handler, when given, returns an iterator of text chunks instead of a string
+    for extension in extensions:
+        extension = extension.lower()
+        if not extension.startswith('.'):
+            extension = '.' + extension
+        file_handlers[extension] = (handler, tuple(backends), stream_handler)
+
+def load_handler_plugins(module_names):
+    # A plugin is any importable module that calls register_handler() at import time.
+    # When started as a script this module is __main__, make "import MagicALoRA" find it
+    sys.modules.setdefault("MagicALoRA", sys.modules[__name__])
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            logging.error(f"Failed to load handler plugin: {module_name} - {str(e)}")
+
+def available_backends():
+    report = {}
+    for extension, (handler, backends, stream_handler) in sorted(file_handlers.items()):
+        for module_name in backends:
+            package = backend_packages.get(module_name, module_name.split('.')[0])
+            entry = report.setdefault(package, {"available": True, "extensions": []})
+            entry["available"] = entry["available"] and backend_available(module_name)
+            if extension not in entry["extensions"]:
+                entry["extensions"].append(extension)
+    return report
+
+def supported_extensions():
+    return sorted(extension for extension, (handler, backends, stream_handler) in file_handlers.items()
+                  if all(backend_available(module_name) for module_name in backends))
+
+def handle_file(file_path, stream=False):
+    if is_zip_member(file_path):
+        return handle_zip_member(file_path)
+    extension = os.path.splitext(file_path)[1].lower()
+    entry = file_handlers.get(extension)
+    if entry:
+        handler, backends, stream_handler = entry
+        if stream and stream_handler is not None:
+            handler = stream_handler
+        for module_name in backends:
+            try:
+                load_backend(module_name)
+            except ImportError as e:
+                if module_name not in missing_backends_logged:
+                    missing_backends_logged.add(module_name)
+                    logging.error(f"Missing library {backend_packages.get(module_name, module_name)} for {extension} files - {str(e)}")
+                return "Unsupported file format for {} (missing {})".format(file_path, backend_packages.get(module_name, module_name)), None
+        return handler(file_path)
+    return "Unsupported file format for {}".format(file_path), None
+
+register_handler(['.txt'], handle_text_file)
+register_handler(['.htm', '.html', '.xhtml'], handle_html_file)
+register_handler(['.epub'], handle_epub_file, ["ebooklib", "ebooklib.epub"])
+register_handler(['.pdf'], handle_pdf_file, ["fitz"], stream_pdf_file)
+register_handler(['.docx', '.doc'], handle_word_file, ["docx"])
+register_handler(['.pptx', '.ppt'], handle_ppt_file, ["pptx"])
+register_handler(['.xls'], handle_excel_file, ["pandas"])
+register_handler(['.xlsx', '.xlsm'], handle_xlsx_file, ["openpyxl"], stream_xlsx_file)
+register_handler(['.xml', '.gan', '.xsd'], handle_xml_gan_file)
+register_handler(['.wav', '.mp3', '.m4a'], handle_audio_file, ["speech_recognition"])
+register_handler(['.mp4', '.avi', '.mov', '.mkv', '.mpeg', '.mpg', '.3gp'], handle_generic_video_file, ["speech_recognition"])
+register_handler(['.csv'], handle_csv_file, stream_handler=stream_csv_file)
+register_handler(['.zip'], handle_zip_file)
+
+# Create Json: the keywords are compiled once per run into a single pattern and every
+# text is scanned once. Matches never overlap: the leftmost match wins and, when several
+# keywords match at the same position, the one listed first.
+def compile_keywords(keywords):
+    alternatives = []
+    group_count = 0
+    for keyword in keywords:
+        if not keyword.strip():
+            continue
+        try:
+            groups = re.compile(keyword, re.IGNORECASE).groups
+        except re.error as e:
+            logging.error(f"Invalid keyword pattern: {keyword} - {str(e)}")
+            continue
+        alternatives.append(scoped_keyword(keyword, group_count, len(alternatives)))
+        group_count += groups
+    if not alternatives:
+        return None
+    return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+def scoped_keyword(keyword, group_offset, number):
+    # Inside the combined pattern the numbered backreferences of a keyword are shifted by
+    # the groups of the keywords before it, its named groups and their references get the
+    # keyword number (two keywords may both use (?P<n>...)), and leading inline flags like
+    # (?m) apply to it only
+    if group_offset:
+        keyword = re.sub(r'(?<!\\)((?:\\\\)*)\\([1-9][0-9]?)', lambda m: f'{m.group(1)}\\{int(m.group(2)) + group_offset}', keyword)
+    keyword = re.sub(r'(?<!\\)((?:\\\\)*)\(\?(P<|P=|\()([^\W\d]\w*)', lambda m: f'{m.group(1)}(?{m.group(2)}_{number}_{m.group(3)}', keyword)
+    flags = ''
+    while True:
+        match = re.match(r'\(\?([aiLmsux]+)\)', keyword)
+        if not match:
+            break
+        flags += match.group(1)
+        keyword = keyword[match.end():]
+    return f'(?{flags}:{keyword})' if flags else f'(?:{keyword})'
+
+def process_text_with_keywords(text, keywords):
+    # keywords is a list of patterns or the result of compile_keywords
+    pattern = keywords if isinstance(keywords, re.Pattern) or keywords is None else compile_keywords(keywords)
+    json_data = []
+    if pattern is None:
+        return json_data
+
+    # Ogni keyword apre una sezione che arriva fino alla keyword successiva
+    previous = None
+    for match in pattern.finditer(text):
+        if previous is not None:
+            json_data.append({"title": previous.group(), "content": text[previous.end():match.start()].strip()})
+        previous = match
+    if previous is not None:
+        json_data.append({"title": previous.group(), "content": text[previous.end():].strip()})
+
+    return json_data
+
+# Create Json output: every document is written as soon as it is processed. "json" writes
+# the indented array of before, one element at a time; "jsonl" one document per line.
+# With json_shard_size (MB) the output goes to output-00001.json, output-00002.json...,
+# every shard a complete file, so an interrupted run keeps all the shards before the last.
+json_formats = {"json": ".json", "jsonl": ".jsonl"}
+
+def open_json_writer(json_output_path, json_format="json", shard_size=0):
+    if json_format not in json_formats:
+        raise ValueError(f"Unknown JSON format: {json_format}")
+    extension = json_formats[json_format]
+    # The files of a previous run would be mixed with the new ones
+    for name in os.listdir(json_output_path):
+        if re.fullmatch(r'output(-\d{5})?' + re.escape(extension), name):
+            os.remove(os.path.join(json_output_path, name))
+    return {"path": json_output_path, "format": json_format, "extension": extension, "shard_size": shard_size * 1024 * 1024,
+            "file": None, "files": [], "documents": 0, "documents_in_file": 0}
+
+def open_json_shard(writer):
+    name = f'output-{len(writer["files"]) + 1:05d}' if writer["shard_size"] else 'output'
+    output_file = os.path.join(writer["path"], name + writer["extension"])
+    writer["file"] = open(output_file, 'w', encoding='utf-8')
+    writer["files"].append(output_file)
+    writer["documents_in_file"] = 0
+    if writer["format"] == "json":
+        writer["file"].write('[')
+
+def close_json_shard(writer):
+    if writer["format"] == "json":
+        writer["file"].write('\n]' if writer["documents_in_file"] else ']')
+    writer["file"].close()
+    writer["file"] = None
+
+def write_json_document(writer, document):
+    if writer["file"] is None:
+        open_json_shard(writer)
+    json_file = writer["file"]
+    if writer["format"] == "jsonl":
+        json_file.write(json.dumps(document, ensure_ascii=False) + '\n')
+    else:
+        # Same layout as json.dump(documents, indent=4)
+        json_file.write(',\n' if writer["documents_in_file"] else '\n')
+        json_file.write(textwrap.indent(json.dumps(document, indent=4, ensure_ascii=False), '    '))
+    json_file.flush()
+    writer["documents_in_file"] += 1
+    writer["documents"] += 1
+    if writer["shard_size"] and json_file.tell() >= writer["shard_size"]:
+        close_json_shard(writer)
+
+def close_json_writer(writer):
+    # With no documents an empty output file is still written
+    if writer["file"] is None and not writer["files"]:
+        open_json_shard(writer)
+    if writer["file"] is not None:
+        close_json_shard(writer)
+
+def json_output_name(writer):
+    if len(writer["files"]) == 1:
+        return writer["files"][0]
+    return os.path.join(writer["path"], f'output-*{writer["extension"]}')
+
+# GUI jobs: the long tasks run on a small pool of threads, one job of each kind at a time
+# (a second click while Create text file runs is refused). A job receives a cancel event
+# that it checks between files. Widgets and dialogs are only touched by the Tk thread:
+# jobs hand them over with call_in_ui, the main loop polls ui_queue with after().
+# Create text file rewrites the text output folder that Create Json and Export tokens read:
+# none of them starts while a conflicting one runs.
+job_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='job')
+job_conflicts = {"text_file": {"json", "export"}, "json": {"text_file"}, "export": {"text_file"}}
+running_jobs = {}
+jobs_lock = threading.Lock()
+ui_queue = queue.Queue()
+
+def submit_job(kind, function, *args):
+    # function(cancel, *args); returns None when a job of the same kind, or one using the
+    # same output folder, is still running
+    with jobs_lock:
+        if running_job_kinds({kind} | job_conflicts.get(kind, set())):
+            return None
+        job = {"cancel": threading.Event()}
+        job["future"] = job_executor.submit(run_job, kind, function, job["cancel"], *args)
+        running_jobs[kind] = job
+    return job
+
+def run_job(kind, function, cancel, *args):
+    try:
+        return function(cancel, *args)
+    except Exception as e:
+        logging.exception(f"Job {kind} failed: {str(e)}")
+        call_in_ui(messagebox.showerror, "Error", str(e))
+
+def cancel_job(kind):
+    with jobs_lock:
+        job = running_jobs.get(kind)
+    if job is not None:
+        job["cancel"].set()
+
+def jobs_running():
+    with jobs_lock:
+        return bool(running_job_kinds(running_jobs))
+
+def running_job_kinds(kinds):
+    # Called with jobs_lock held
+    return [kind for kind in kinds if kind in running_jobs and not running_jobs[kind]["future"].done()]
+
+def call_in_ui(function, *args):
+    if threading.current_thread() is threading.main_thread():
+        function(*args)
+    else:
+        ui_queue.put((function, args))
+
+def poll_ui_queue():
+    while True:
+        try:
+            function, args = ui_queue.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            function(*args)
+        except Exception as e:
+            logging.error(f"GUI update failed: {str(e)}")
+    root.after(100, poll_ui_queue)
+
+def job_refused(kind):
+    with jobs_lock:
+        busy = running_job_kinds(job_conflicts.get(kind, set()))
+    if busy:
+        messagebox.showinfo("Magic a LoRA", lang.get('outputFolderBusy', 'Another task is using the output folder, try again when it ends'))
+    else:
+        messagebox.showinfo("Magic a LoRA", lang.get('jobRunning', 'This task is already running'))
+
+# Functions for GUI and video handling
+def download_youtube_video(url, download_audio_only=False):
+    if not url.strip():
+        call_in_ui(messagebox.showerror, lang['downloadError'], lang['downloadError'])
+        return None
+    try:
+        yt = load_backend("pytube").YouTube(url)
+        title = yt.title
+        title = ''.join([c for c in title if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+        if download_audio_only:
+            stream = yt.streams.filter(only_audio=True).first()
+            file_path = stream.download(output_path=temp_dir, filename=f"{title}.mp3")
+        else:
+            stream = yt.streams.get_highest_resolution()
+            file_path = stream.download(output_path=temp_dir, filename=f"{title}.mp4")
+        logging.info(f"{lang['downloadSuccess']}: {file_path}")
+        return file_path
+    except Exception as e:
+        logging.error(f"{lang['downloadError']}: {e}")
+        call_in_ui(messagebox.showerror, lang['downloadError'], str(e))
+        return None
+
+def extract_audio(video_file):
+    try:
+        audio_file = cached_audio_track(video_file)
+        logging.info(f"Extracted audio to: {audio_file}")
+        return audio_file
+    except Exception as e:
+        logging.error(f"{lang['audioExtractionError']}: {e}")
+        call_in_ui(messagebox.showerror, lang['audioExtractionError'], str(e))
+        return None
+
+def generate_srt(audio_file, output_file, language=None):
+    sr = load_backend("speech_recognition")
+    sound = load_backend("pydub").AudioSegment.from_wav(audio_file)
+    chunks = load_backend("pydub.silence").split_on_silence(sound, min_silence_len=500, silence_thresh=sound.dBFS-14, keep_silence=500)
+
+    # The chunks are transcribed concurrently, the subtitles are written in chunk order
+    with open(output_file, 'w') as file:
+        transcripts = transcribe_batch((chunk_audio_data(chunk) for chunk in chunks), language)
+        start = 0
+        for i, (chunk, text) in enumerate(zip(chunks, transcripts)):
+            duration = len(chunk) / 1000
+            start_time = start
+            end_time = start + duration
+            file.write(f"{i+1}\n")
+            file.write(f"{format_time(start_time)} --> {format_time(end_time)}\n")
+            if isinstance(text, sr.UnknownValueError):
+                file.write("Audio not understandable\n\n")
+                logging.warning(f"Audio not understandable for segment {i+1}")
+            elif isinstance(text, sr.RequestError):
+                file.write(f"Service error: {text}\n\n")
+                logging.error(f"Service error for segment {i+1}: {text}")
+            else:
+                file.write(f"{text.strip()}\n\n")
+                logging.info(f"Generated SRT segment {i+1}")
+            start += duration
+    evict_cache()
+    log_cache_statistics()
+
+def iter_ordered_results(executor, function, arguments, window):
+    pending = collections.deque()
+    for args in arguments:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def chunk_audio_data(chunk):
+    # The chunk goes to the recognizer as in-memory PCM, nothing is written to temp_dir
+    sr = load_backend("speech_recognition")
+    if chunk.channels > 1:
+        chunk = chunk.set_channels(1)
+    return sr.AudioData(chunk.raw_data, chunk.frame_rate, chunk.sample_width)
+
+def format_time(seconds):
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    seconds = seconds % 60
+    return f"{hours:02}:{minutes:02}:{seconds:02},000"
+
+def process_video():
+    # The widgets are read and the SRT file chosen here, the download, conversion and
+    # transcription run as a job
+    url = url_entry.get().strip()
+    video_file = file_entry.get().strip()
+    if not url and not video_file:
+        return
+    output_path = filedialog.asksaveasfilename(defaultextension=".srt", filetypes=[("SRT files", "*.srt")])
+    if not output_path:
+        return
+    if submit_job("srt", process_video_job, url, video_file, download_audio_only_var.get(), output_path, transcription_lang_var.get()) is None:
+        job_refused("srt")
+
+def process_video_job(cancel, url, video_file, download_audio_only, output_path, language):
+    if url:
+        video_file = download_youtube_video(url, download_audio_only=download_audio_only)
+    if not video_file or cancel.is_set():
+        return
+    # Audio-only downloads are converted too: generate_srt needs a WAV file
+    audio_file = extract_audio(video_file)
+    if not audio_file:
+        return
+    try:
+        if cancel.is_set():
+            return
+        generate_srt(audio_file, output_path, language)
+        call_in_ui(messagebox.showinfo, "Success", f"{lang['success']} {output_path}")
+        logging.info(f"SRT file generated: {output_path}")
+    finally:
+        os.remove(audio_file)
+
+def setup_video_player(video_path, srt_path):
+    media = instance.media_new(video_path)
+    media.add_option(f'sub-file={srt_path}')
+    player.set_media(media)
+    player.play()
+
+def load_video():
+    video_path = video_entry.get().strip()
+    srt_path = srt_entry.get().strip()
+    url = url_entry_video.get().strip()
+
+    if not video_path and not url:
+        messagebox.showerror("Error", "Please enter a URL or select a video file.")
+        return
+    if not srt_path:
+        messagebox.showerror("Error", "Please select an SRT file.")
+        return
+
+    if submit_job("video", load_video_job, video_path, srt_path, url) is None:
+        job_refused("video")
+
+def load_video_job(cancel, video_path, srt_path, url):
+    if url:
+        video_path = download_youtube_video(url)
+
+    if video_path and not cancel.is_set():
+        call_in_ui(setup_video_player, video_path, srt_path)
+
+# Functions for Tab 3: Create text file
+def create_text_files(directories, output_path, ignore_dirs, process_subfolders, limit_search, workers=1, incremental=False, hash_contents=False, shard_size=0, metrics=None, cancel=None):
+    summary = new_run_summary()
+    for record in iter_text_records(directories, output_path, ignore_dirs, process_subfolders, limit_search, workers, incremental, hash_contents, summary, shard_size, metrics=metrics, cancel=cancel):
+        pass
+    return summary
+
+# Create text file as a generator of records, consumed directly by Create Json in a fused run
+def iter_text_records(directories, output_path, ignore_dirs, process_subfolders, limit_search, workers=1, incremental=False, hash_contents=False, summary=None, shard_size=0, flush_records=False, metrics=None, cancel=None):
+    if summary is None:
+        summary = new_run_summary()
+    if metrics is None:
+        metrics = new_run_metrics()
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    incremental_state = None
+    if incremental:
+        incremental_state = new_incremental_state(output_path, hash_contents)
+        file_index = resume_shard_index(incremental_state, output_path, shard_size) if shard_size else next_output_index(incremental_state)
+        writer = open_output_writer(output_path, file_index, shard_size, incremental=True, flush_records=flush_records)
+    else:
+        # The outputs are written from scratch: the manifest of an earlier incremental run
+        # would point a later one at offsets that no longer hold its texts
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(output_path, manifest_file_name))
+        records_file = open(os.path.join(output_path, records_file_name), 'w', encoding='utf-8')
+        writer = open_output_writer(output_path, 1, shard_size, records_file=records_file, flush_records=flush_records)
+    quarantine = load_quarantine(output_path)
+    deduplicator = None
+    if setup_deduplicate:
+        if incremental:
+            # Only the sources extracted again would be compared: not supported
+            summary["warnings"].append(lang.get('deduplicateIgnored', 'Deduplicate is not applied to incremental runs: every text is written'))
+            logging.warning(summary["warnings"][-1])
+        else:
+            deduplicator = new_deduplicator(setup_duplicate_threshold)
+    executor = create_worker_pool(workers)
+    cache_hits = cache_statistics["extraction hits"]
+    try:
+        for directory in directories:
+            yield from explore_directory(directory, writer, ignore_dirs, process_subfolders, limit_search, summary, executor, incremental_state, metrics, cancel, quarantine, deduplicator, workers)
+        # A cancelled run has not seen every source: nothing is pruned
+        summary["cancelled"] = cancel is not None and cancel.is_set()
+        if incremental_state is not None and not summary["cancelled"]:
+            prune_manifest(incremental_state, output_path, directories, summary)
+            compact_outputs(incremental_state, writer)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=cancel is not None and cancel.is_set())
+            if isinstance(executor, SupervisedExecutor):
+                add_to_quarantine(quarantine, executor.quarantined)
+        save_quarantine(quarantine, output_path)
+        if deduplicator is not None:
+            save_duplicates_report(deduplicator, output_path)
+        close_output_writer(writer)
+        if incremental_state is not None:
+            save_manifest(incremental_state["manifest"], output_path)
+            save_incremental_records(incremental_state, output_path)
+        evict_cache()
+    summary["cached"] = cache_statistics["extraction hits"] - cache_hits
+    log_cache_statistics()
+    metrics["finished"] = time.time()
+    report = run_report(metrics, summary, directories=directories, workers=workers, incremental=incremental)
+    metrics["report"] = save_run_report(report, output_path)
+    logging.info(f"Run report: {metrics['report']} - {report['total']}")
+    if summary["cancelled"]:
+        logging.info(f"Create text file cancelled: {directories}")
+    else:
+        logging.info(f"{lang.get('processCompleted', 'Process completed for directories')}: {directories}")
+
+def start_create_text_file():
+    metrics = new_run_metrics()
+    job = submit_job("text_file", create_text_file_job, limit_search_key(limit_search_var.get()), metrics)
+    if job is None:
+        job_refused("text_file")
+        return
+    show_run_metrics(metrics, job)
+
+def create_text_file_job(cancel, limit_search, metrics):
+    summary = create_text_files(setup_directories, setup_output_path, setup_ignore_dirs, setup_process_subfolders, limit_search, setup_workers, setup_incremental, setup_hash_contents, setup_output_shard_size, metrics, cancel)
+    if summary["warnings"]:
+        call_in_ui(messagebox.showwarning, "Magic a LoRA", '\n'.join(summary["warnings"]))
+    return summary
+
+def show_run_metrics(metrics, job):
+    # Refreshed every second from the Tk main loop while the run goes on
+    text = format_run_metrics(metrics)
+    if job["future"].done() and job["cancel"].is_set():
+        text += '\n' + lang.get('jobCancelled', 'Cancelled')
+    create_text_file_log_display.config(state='normal')
+    create_text_file_log_display.delete('1.0', tk.END)
+    create_text_file_log_display.insert(tk.END, text)
+    create_text_file_log_display.config(state='disabled')
+    if not job["future"].done():
+        root.after(1000, show_run_metrics, metrics, job)
+
+# Functions for Tab 4: Create Json
+def create_json(input_dir, json_output_path, keywords, json_format="json", shard_size=0, records=None, cancel=None):
+    # records: the records of a Create text file run in progress (fused run), by default
+    # those saved in input_dir
+    try:
+        keyword_pattern = compile_keywords(keywords)
+    except re.error as e:
+        logging.error(f"Invalid keywords: {str(e)}")
+        return json_output_path, 0, f"Invalid keywords: {str(e)}"
+
+    if not os.path.exists(json_output_path):
+        os.makedirs(json_output_path)
+    writer = None
+    try:
+        writer = open_json_writer(json_output_path, json_format, shard_size)
+        for original_path, content in iter_json_sources(input_dir, records):
+            if cancel is not None and cancel.is_set():
+                logging.info(f"Create Json cancelled after {writer['documents']} documents")
+                break
+            json_data = process_text_with_keywords(content, keyword_pattern)
+            write_json_document(writer, [
+                {"title": "Original file path", "content": original_path},
+                *json_data
+            ])
+        close_json_writer(writer)
+    except Exception as e:
+        if isinstance(e, PermissionError):
+            error = f"Permission denied: {e.filename or json_output_path}"
+        else:
+            error = f"Failed to write JSON file: {json_output_path} - {str(e)}"
+        logging.error(error)
+        if writer is None:
+            return json_output_path, 0, error
+        # The documents written so far are kept in a well-formed file
+        with contextlib.suppress(Exception):
+            if writer["file"] is not None:
+                close_json_shard(writer)
+        return json_output_name(writer), writer["documents"], error
+    finally:
+        if hasattr(records, "close"):
+            records.close()
+    json_output_file = json_output_name(writer)
+    logging.info(f"JSON file generated: {json_output_file} ({writer['documents']} documents in {len(writer['files'])} files)")
+    return json_output_file, writer["documents"], None
+
+def iter_json_sources(input_dir, records=None):
+    # Yields (original path, text) for every document
+    if records is None and os.path.exists(os.path.join(input_dir, records_file_name)):
+        records = iter_records_file(input_dir)
+    if records is not None:
+        for record in records:
+            if record["failed"]:
+                logging.info(f"Skipping failed extraction: {record['source']}")
+            else:
+                yield record["source"], read_record_text(input_dir, record)
+        return
+    # A folder without records.jsonl (older outputs, other text files): every file goes through its handler
+    for root, dirs, files in os.walk(input_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            content, original_path = handle_file(file_path)
+            if content and not content.startswith("Unsupported"):
+                yield original_path, content
+            else:
+                logging.info(content)
+
+# Export tokens: the texts of a Create text file output (or, with keywords, their sections)
+# are tokenized and packed into binary shards that a training job memory-maps instead of
+# parsing text on every epoch. tokens-00001.bin holds the token ids as fixed-width little
+# endian integers, tokens-00001.idx the uint64 offset of every sample in it (one more than
+# the samples, the last is the end) and tokens.json describes the shards. With a chunk
+# length the texts are concatenated (separated by eos_token) and cut into samples of exactly
+# that many tokens, the last one padded.
+token_export_format = 'magicalora-tokens'
+token_manifest_name = 'tokens.json'
+token_dtypes = {'B': 'uint8', 'H': 'uint16', 'I': 'uint32'}
+
+def load_tokenizer(name):
+    # "bytes": the UTF-8 bytes of the text. "module:attribute": a callable returning token
+    # ids, or a tokenizer object with encode() (tiktoken, Hugging Face tokenizers)
+    if name == 'bytes':
+        return (lambda text: text.encode('utf-8')), 256
+    module_name, _, attribute = name.partition(':')
+    tokenizer = getattr(importlib.import_module(module_name), attribute)
+    vocab_size = getattr(tokenizer, 'n_vocab', None) or getattr(tokenizer, 'vocab_size', None)
+    if vocab_size is None and hasattr(tokenizer, 'get_vocab_size'):
+        vocab_size = tokenizer.get_vocab_size()
+    encode = tokenizer.encode if hasattr(tokenizer, 'encode') else tokenizer
+
+    def encode_ids(text):
+        tokens = encode(text)
+        return getattr(tokens, 'ids', tokens)
+    return encode_ids, vocab_size
+
+def token_typecode(vocab_size):
+    if vocab_size is None:
+        return 'I'
+    return next(typecode for typecode, limit in (('B', 2 ** 8), ('H', 2 ** 16), ('I', 2 ** 32)) if vocab_size <= limit)
+
+def iter_export_texts(text, keyword_pattern):
+    sections = process_text_with_keywords(text, keyword_pattern) if keyword_pattern is not None else None
+    if not sections:
+        yield text
+        return
+    for section in sections:
+        yield f"{section['title']}\n{section['content']}"
+
+def export_tokens(input_dir, export_path, tokenizer="bytes", chunk_length=0, shard_size=1024, keywords=None, eos_token=None, cancel=None):
+    # Returns (manifest path, samples, error)
+    try:
+        encode, vocab_size = load_tokenizer(tokenizer)
+        typecode = token_typecode(max(vocab_size, (eos_token or 0) + 1) if vocab_size else None)
+        keyword_pattern = compile_keywords(keywords) if keywords else None
+        os.makedirs(export_path, exist_ok=True)
+        for name in os.listdir(export_path):
+            if re.fullmatch(r'tokens-\d{5}\.(bin|idx)(\.tmp)?', name) or name == token_manifest_name:
+                os.remove(os.path.join(export_path, name))
+        writer = {"dir": export_path, "typecode": typecode, "shard_size": shard_size * 1024 * 1024, "file": None, "shards": []}
+        pending = array.array(typecode)
+        for source, text in iter_json_sources(input_dir):
+            if cancel is not None and cancel.is_set():
+                logging.info(f"Export tokens cancelled after {sum(shard['samples'] for shard in writer['shards'])} samples")
+                break
+            for sample in iter_export_texts(text, keyword_pattern):
+                ids = encode(sample)
+                if isinstance(ids, (bytes, bytearray)) and typecode != 'B':
+                    # array() would read bytes as the raw memory of the wider integers
+                    ids = list(ids)
+                tokens = array.array(typecode, ids)
+                if eos_token is not None:
+                    tokens.append(eos_token)
+                if not chunk_length:
+                    write_token_sample(writer, tokens)
+                    continue
+                pending.extend(tokens)
+                if len(pending) >= chunk_length:
+                    full = len(pending) - len(pending) % chunk_length
+                    for start in range(0, full, chunk_length):
+                        write_token_sample(writer, pending[start:start + chunk_length])
+                    del pending[:full]
+        if chunk_length and pending:
+            pending.extend([eos_token or 0] * (chunk_length - len(pending)))
+            write_token_sample(writer, pending)
+        if writer["file"] is not None:
+            close_token_shard(writer)
+        manifest = {"format": token_export_format, "version": 1, "tokenizer": tokenizer, "vocab_size": vocab_size, "dtype": token_dtypes[typecode],
+                    "byteorder": "little", "chunk_length": chunk_length, "eos_token": eos_token,
+                    "samples": sum(shard["samples"] for shard in writer["shards"]), "tokens": sum(shard["tokens"] for shard in writer["shards"]),
+                    "shards": writer["shards"]}
+        manifest_path = os.path.join(export_path, token_manifest_name)
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, ensure_ascii=False)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    except OverflowError as e:
+        logging.error(f"Failed to export tokens: token id out of range for {tokenizer} - {str(e)}")
+        return export_path, 0, f"Failed to export tokens: token id out of range for {tokenizer} - {str(e)}"
+    except Exception as e:
+        logging.error(f"Failed to export tokens: {export_path} - {str(e)}")
+        return export_path, 0, f"Failed to export tokens: {export_path} - {str(e)}"
+    logging.info(f"Tokens exported: {manifest_path} ({manifest['samples']} samples, {manifest['tokens']} tokens in {len(manifest['shards'])} shards)")
+    return manifest_path, manifest["samples"], None
+
+def write_token_sample(writer, tokens):
+    if writer["file"] is None:
+        number = len(writer["shards"]) + 1
+        writer["name"] = f'tokens-{number:05d}'
+        writer["file"] = open(os.path.join(writer["dir"], writer["name"] + '.bin.tmp'), 'wb', buffering=output_buffer_size)
+        writer["offsets"] = array.array('Q', [0])
+    if sys.byteorder != 'little':
+        tokens = array.array(tokens.typecode, tokens)
+        tokens.byteswap()
+    tokens.tofile(writer["file"])
+    writer["offsets"].append(writer["offsets"][-1] + len(tokens))
+    if writer["shard_size"] and writer["offsets"][-1] * tokens.itemsize >= writer["shard_size"]:
+        close_token_shard(writer)
+
+def close_token_shard(writer):
+    writer["file"].close()
+    writer["file"] = None
+    offsets = writer["offsets"]
+    writer["shards"].append({"data": writer["name"] + '.bin', "index": writer["name"] + '.idx', "samples": len(offsets) - 1, "tokens": offsets[-1]})
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    with open(os.path.join(writer["dir"], writer["name"] + '.idx.tmp'), 'wb') as index_file:
+        offsets.tofile(index_file)
+    for suffix in ('.bin', '.idx'):
+        os.replace(os.path.join(writer["dir"], writer["name"] + suffix + '.tmp'), os.path.join(writer["dir"], writer["name"] + suffix))
+
+def open_token_dataset(export_path):
+    # Maps every shard read-only; token_sample returns a memoryview of the shard, no copy
+    with open(os.path.join(export_path, token_manifest_name), 'r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    typecode = {dtype: typecode for typecode, dtype in token_dtypes.items()}[manifest["dtype"]]
+    shards = []
+    starts = [0]
+    for shard in manifest["shards"]:
+        shards.append((map_array(os.path.join(export_path, shard["data"]), typecode), map_array(os.path.join(export_path, shard["index"]), 'Q')))
+        starts.append(starts[-1] + shard["samples"])
+    return {"manifest": manifest, "shards": shards, "starts": starts}
+
+def map_array(path, typecode):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(b'').cast(typecode)
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+def token_sample(dataset, index):
+    if not 0 <= index < dataset["starts"][-1]:
+        raise IndexError(index)
+    shard = bisect.bisect_right(dataset["starts"], index) - 1
+    tokens, offsets = dataset["shards"][shard]
+    index -= dataset["starts"][shard]
+    return tokens[offsets[index]:offsets[index + 1]]
+
+def start_create_json():
+    keywords = [entry.get() for entry in keyword_entries]
+    if submit_job("json", create_json_job, keywords) is None:
+        job_refused("json")
+
+def create_json_job(cancel, keywords):
+    json_output_file, documents, error = create_json(setup_output_path, setup_json_output_path, keywords, setup_json_format, setup_json_shard_size, cancel=cancel)
+    if error:
+        call_in_ui(messagebox.showerror, "Error", error)
+        return
+    if cancel.is_set():
+        call_in_ui(messagebox.showinfo, "Magic a LoRA", f"{lang.get('jobCancelled', 'Cancelled')}: {documents} documents -> {json_output_file}")
+        return
+    call_in_ui(messagebox.showinfo, "Success", f"{lang['success']} {json_output_file}")
+
+    # Aggiorna la configurazione dopo aver creato il JSON
+    call_in_ui(save_configuration)
+
+def start_export_tokens():
+    if not setup_export_path:
+        messagebox.showerror("Error", "The configuration has no export_path")
+        return
+    keywords = [entry.get() for entry in keyword_entries] if setup_export_sections else None
+    if submit_job("export", export_tokens_job, keywords) is None:
+        job_refused("export")
+
+def export_tokens_job(cancel, keywords):
+    manifest_path, samples, error = export_tokens(setup_output_path, setup_export_path, setup_export_tokenizer, setup_export_chunk_length, setup_export_shard_size, keywords, setup_export_eos_token, cancel)
+    if error:
+        call_in_ui(messagebox.showerror, "Error", error)
+        return
+    if cancel.is_set():
+        call_in_ui(messagebox.showinfo, "Magic a LoRA", f"{lang.get('jobCancelled', 'Cancelled')}: {samples} samples -> {manifest_path}")
+        return
+    call_in_ui(messagebox.showinfo, "Success", f"{lang['success']} {manifest_path}")
+
+
+# Functions for Tab 5: Setup
+setup_directories = []
+setup_ignore_dirs = []
+setup_output_path = ""
+setup_json_output_path = ""
+setup_process_subfolders = True
+setup_limit_search = "noLimit"
+setup_keywords = []
+setup_handler_plugins = []
+setup_workers = 1
+setup_incremental = False
+setup_hash_contents = False
+setup_pdf_page_range = None
+setup_pdf_page_batch = 0
+setup_max_rows_per_sheet = 0
+setup_zip_max_depth = 3
+setup_zip_max_member_size = 512 * 1024 * 1024
+setup_transcription_workers = 4
+setup_transcription_backend = "google"
+setup_transcription_language = "it-IT"
+setup_transcription_url = "http://127.0.0.1:8765"
+setup_transcription_model = ""
+setup_transcription_window = 30
+setup_transcription_overlap = 2
+setup_cache_dir = ""
+setup_cache_max_size = 0
+setup_json_format = "json"
+setup_json_shard_size = 0
+setup_output_shard_size = 64
+setup_include_patterns = []
+setup_exclude_patterns = []
+setup_similar_title_threshold = 0.9
+setup_file_timeout = 0
+setup_worker_memory_limit = 0
+setup_deduplicate = False
+setup_duplicate_threshold = 0.8
+setup_export_path = ""
+setup_export_tokenizer = "bytes"
+setup_export_chunk_length = 0
+setup_export_shard_size = 1024
+setup_export_sections = False
+setup_export_eos_token = None
+setup_epub_workers = 1
+
+keyword_entries = []
+
+limit_search_labels = {
+    "noLimit": "No Limit",
+    "lastProducedPerType": "Last Produced per Type",
+    "lastProducedInFolder": "Last Produced in Folder",
+    "lastProducedSimilarTitle": "Last Produced with Similar Title"
+}
+
+# The combobox stores the translated label, limit_files_search expects the key
+def limit_search_key(value):
+    if value in limit_search_labels:
+        return value
+    for key, label in limit_search_labels.items():
+        if value in (label, lang.get(key)):
+            return key
+    return "noLimit"
+
+def add_keyword_entry():
+    entry = tk.Entry(tab4, width=50)
+    entry.pack(pady=5)
+    keyword_entries.append(entry)
+
+def remove_keyword_entry():
+    if keyword_entries:
+        entry = keyword_entries.pop()
+        entry.pack_forget()
+
+def add_directory():
+    directory = filedialog.askdirectory()
+    if directory:
+        setup_directories.append(directory)
+        directories_listbox.insert(tk.END, directory)
+
+def remove_directory():
+    selected = directories_listbox.curselection()
+    if selected:
+        index = selected[0]
+        setup_directories.pop(index)
+        directories_listbox.delete(index)
+
+def add_ignore_directory():
+    directory = filedialog.askdirectory()
+    if directory:
+        setup_ignore_dirs.append(directory)
+        ignore_directories_listbox.insert(tk.END, directory)
+
+def remove_ignore_directory():
+    selected = ignore_directories_listbox.curselection()
+    if selected:
+        index = selected[0]
+        setup_ignore_dirs.pop(index)
+        ignore_directories_listbox.delete(index)
+
+def set_output_path():
+    global setup_output_path
+    setup_output_path = filedialog.askdirectory()
+    output_path_label.config(text=setup_output_path)
+
+def set_json_output_path():
+    global setup_json_output_path
+    setup_json_output_path = filedialog.askdirectory()
+    json_output_path_label.config(text=setup_json_output_path)
+
+def set_process_subfolders():
+    global setup_process_subfolders
+    setup_process_subfolders = process_subfolders_var.get()
+
+def set_workers():
+    global setup_workers
+    try:
+        setup_workers = max(1, int(workers_var.get()))
+    except (ValueError, tk.TclError):
+        setup_workers = 1
+
+def set_incremental():
+    global setup_incremental
+    setup_incremental = incremental_var.get()
+
+def set_temp_dir():
+    global temp_dir
+    temp_dir = filedialog.askdirectory()
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+    temp_dir_label.config(text=temp_dir)
+
+# Save widget positions
+def save_widget_positions():
+    widget_positions = {}
+    for widget in tab5.winfo_children():
+        widget_positions[str(widget)] = {"x": widget.winfo_x(), "y": widget.winfo_y()}
+    return widget_positions
+
+# Load widget positions
+def load_widget_positions(widget_positions):
+    for widget in tab5.winfo_children():
+        if str(widget) in widget_positions:
+            pos = widget_positions[str(widget)]
+            widget.place(x=pos["x"], y=pos["y"])
+
+def update_setup_ui():
+    directories_listbox.delete(0, tk.END)
+    for directory in setup_directories:
+        directories_listbox.insert(tk.END, directory)
+    ignore_directories_listbox.delete(0, tk.END)
+    for directory in setup_ignore_dirs:
+        ignore_directories_listbox.insert(tk.END, directory)
+    output_path_label.config(text=setup_output_path)
+    json_output_path_label.config(text=setup_json_output_path)
+    process_subfolders_var.set(setup_process_subfolders)
+    temp_dir_label.config(text=temp_dir)
+    workers_var.set(setup_workers)
+    incremental_var.set(setup_incremental)
+    transcription_lang_var.set(setup_transcription_language)
+    limit_search_menu.set(lang.get(limit_search_var.get(), limit_search_labels.get(limit_search_var.get(), limit_search_var.get())))
+
+def save_configuration():
+    config = {
+        "directories": setup_directories,
+        "ignore_dirs": setup_ignore_dirs,
+        "output_path": setup_output_path,
+        "json_output_path": setup_json_output_path,
+        "process_subfolders": setup_process_subfolders,
+        "temp_dir": temp_dir,
+        "limit_search": limit_search_key(limit_search_var.get()),
+        "keywords": [entry.get() for entry in keyword_entries],
+        "handler_plugins": setup_handler_plugins,
+        "workers": setup_workers,
+        "incremental": setup_incremental,
+        "hash_contents": setup_hash_contents,
+        "pdf_page_range": setup_pdf_page_range,
+        "pdf_page_batch": setup_pdf_page_batch,
+        "max_rows_per_sheet": setup_max_rows_per_sheet,
+        "zip_max_depth": setup_zip_max_depth,
+        "zip_max_member_size": setup_zip_max_member_size,
+        "transcription_workers": setup_transcription_workers,
+        "transcription_backend": setup_transcription_backend,
+        "transcription_language": setup_transcription_language,
+        "transcription_url": setup_transcription_url,
+        "transcription_model": setup_transcription_model,
+        "transcription_window": setup_transcription_window,
+        "transcription_overlap": setup_transcription_overlap,
+        "cache_dir": setup_cache_dir,
+        "cache_max_size": setup_cache_max_size,
+        "json_format": setup_json_format,
+        "json_shard_size": setup_json_shard_size,
+        "output_shard_size": setup_output_shard_size,
+        "include_patterns": setup_include_patterns,
+        "exclude_patterns": setup_exclude_patterns,
+        "similar_title_threshold": setup_similar_title_threshold,
+        "file_timeout": setup_file_timeout,
+        "worker_memory_limit": setup_worker_memory_limit,
+        "deduplicate": setup_deduplicate,
+        "duplicate_threshold": setup_duplicate_threshold,
+        "export_path": setup_export_path,
+        "export_tokenizer": setup_export_tokenizer,
+        "export_chunk_length": setup_export_chunk_length,
+        "export_shard_size": setup_export_shard_size,
+        "export_sections": setup_export_sections,
+        "export_eos_token": setup_export_eos_token,
+        "epub_workers": setup_epub_workers,
+        "widget_positions": save_widget_positions()
+    }
+    config_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON files", "*.json")])
+    if config_path:
+        with open(config_path, 'w', encoding='utf-8') as config_file:
+            json.dump(config, config_file, indent=4, ensure_ascii=False)
+        messagebox.showinfo("Success", f"{lang['success']} {config_path}")
+        logging.info(f"Configuration saved: {config_path}")
+
+def read_configuration(config_path):
+    with open(config_path, 'r', encoding='utf-8') as config_file:
+        return json.load(config_file)
+
+def apply_configuration(config):
+    global setup_directories, setup_ignore_dirs, setup_output_path, setup_json_output_path, setup_process_subfolders, temp_dir, setup_limit_search, setup_keywords, setup_handler_plugins, setup_workers, setup_incremental, setup_hash_contents, setup_pdf_page_range, setup_pdf_page_batch, setup_max_rows_per_sheet, setup_zip_max_depth, setup_zip_max_member_size, setup_transcription_workers, setup_transcription_backend, setup_transcription_language, setup_transcription_url, setup_transcription_model, setup_transcription_window, setup_transcription_overlap, setup_cache_dir, setup_cache_max_size, setup_json_format, setup_json_shard_size, setup_output_shard_size, setup_include_patterns, setup_exclude_patterns, setup_similar_title_threshold, setup_file_timeout, setup_worker_memory_limit, setup_deduplicate, setup_duplicate_threshold, setup_export_path, setup_export_tokenizer, setup_export_chunk_length, setup_export_shard_size, setup_export_sections, setup_export_eos_token, setup_epub_workers
+    setup_directories = config.get("directories", [])
+    setup_ignore_dirs = config.get("ignore_dirs", [])
+    setup_output_path = config.get("output_path", "")
+    setup_json_output_path = config.get("json_output_path", "")
+    setup_process_subfolders = config.get("process_subfolders", True)
+    temp_dir = config.get("temp_dir", "temp")
+    setup_limit_search = limit_search_key(config.get("limit_search", "noLimit"))
+    setup_keywords = config.get("keywords", [])
+    setup_handler_plugins = config.get("handler_plugins", [])
+    setup_workers = max(1, int(config.get("workers", 1)))
+    setup_incremental = config.get("incremental", False)
+    setup_hash_contents = config.get("hash_contents", False)
+    setup_pdf_page_range = config.get("pdf_page_range")
+    setup_pdf_page_batch = int(config.get("pdf_page_batch", 0))
+    setup_max_rows_per_sheet = int(config.get("max_rows_per_sheet", 0))
+    setup_zip_max_depth = int(config.get("zip_max_depth", 3))
+    setup_zip_max_member_size = int(config.get("zip_max_member_size", 512 * 1024 * 1024))
+    setup_transcription_workers = max(1, int(config.get("transcription_workers", 4)))
+    setup_transcription_backend = config.get("transcription_backend", "google")
+    setup_transcription_language = config.get("transcription_language", "it-IT")
+    setup_transcription_url = config.get("transcription_url", "http://127.0.0.1:8765")
+    setup_transcription_model = config.get("transcription_model", "")
+    setup_transcription_window = float(config.get("transcription_window", 30))
+    setup_transcription_overlap = float(config.get("transcription_overlap", 2))
+    setup_cache_dir = config.get("cache_dir", "")
+    setup_cache_max_size = config.get("cache_max_size", 0)
+    setup_json_format = config.get("json_format", "json")
+    setup_json_shard_size = config.get("json_shard_size", 0)
+    setup_output_shard_size = config.get("output_shard_size", 64)
+    setup_include_patterns = config.get("include_patterns", [])
+    setup_exclude_patterns = config.get("exclude_patterns", [])
+    setup_similar_title_threshold = config.get("similar_title_threshold", 0.9)
+    setup_file_timeout = config.get("file_timeout", 0)
+    setup_worker_memory_limit = config.get("worker_memory_limit", 0)
+    setup_deduplicate = config.get("deduplicate", False)
+    setup_duplicate_threshold = config.get("duplicate_threshold", 0.8)
+    setup_export_path = config.get("export_path", "")
+    setup_export_tokenizer = config.get("export_tokenizer", "bytes")
+    setup_export_chunk_length = config.get("export_chunk_length", 0)
+    setup_export_shard_size = config.get("export_shard_size", 1024)
+    setup_export_sections = config.get("export_sections", False)
+    setup_export_eos_token = config.get("export_eos_token", None)
+    setup_epub_workers = config.get("epub_workers", 1)
+    load_handler_plugins(setup_handler_plugins)
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+
+def load_configuration():
+    config_path = filedialog.askopenfilename(filetypes=[("JSON files", "*.json")])
+    if config_path:
+        config = read_configuration(config_path)
+        apply_configuration(config)
+        limit_search_var.set(setup_limit_search)
+        
+        keyword_entries.clear()
+        for keyword in setup_keywords:
+            entry = tk.Entry(tab4, width=50)
+            entry.insert(0, keyword)
+            entry.pack(pady=5)
+            keyword_entries.append(entry)
+        
+        update_setup_ui()
+        load_widget_positions(config.get("widget_positions", {}))
+        messagebox.showinfo("Success", f"{lang['success']} {config_path}")
+        logging.info(f"Configuration loaded: {config_path}")
+
+# Headless batch mode: runs Create text file / Create Json from a saved configuration
+def run_headless(config_path, run_text_file=True, run_json=True, run_export=False):
+    try:
+        config = read_configuration(config_path)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read configuration: {config_path} - {str(e)}", file=sys.stderr)
+        return 2
+    apply_configuration(config)
+    log_file = configure_logger('Headless')
+    if not setup_output_path:
+        print("The configuration has no output_path", file=sys.stderr)
+        return 2
+    if run_json and not setup_json_output_path:
+        print("The configuration has no json_output_path", file=sys.stderr)
+        return 2
+    if run_export and not setup_export_path:
+        print("The configuration has no export_path", file=sys.stderr)
+        return 2
+
+    # With both steps, every document goes to Create Json as soon as its text is written
+    # (incremental runs also need the unchanged outputs, they read records.jsonl afterwards)
+    fused = run_text_file and run_json and not setup_incremental
+    exit_code = 0
+    try:
+        if run_text_file and not fused:
+            started = datetime.now()
+            summary = create_text_files(setup_directories, setup_output_path, setup_ignore_dirs, setup_process_subfolders, setup_limit_search, setup_workers, setup_incremental, setup_hash_contents, setup_output_shard_size)
+            print_text_file_summary(summary, (datetime.now() - started).total_seconds())
+            if summary["failed"]:
+                exit_code = 1
+        if run_json:
+            started = datetime.now()
+            records = None
+            if fused:
+                summary = new_run_summary()
+                records = iter_text_records(setup_directories, setup_output_path, setup_ignore_dirs, setup_process_subfolders, setup_limit_search, setup_workers, setup_incremental, setup_hash_contents, summary, setup_output_shard_size, flush_records=True)
+            json_output_file, documents, error = create_json(setup_output_path, setup_json_output_path, setup_keywords, setup_json_format, setup_json_shard_size, records)
+            elapsed = (datetime.now() - started).total_seconds()
+            if fused:
+                print_text_file_summary(summary, elapsed)
+                if summary["failed"]:
+                    exit_code = 1
+            if error:
+                print(error, file=sys.stderr)
+                return 2
+            print(f"Create Json: {documents} documents in {elapsed:.1f}s -> {json_output_file}")
+        if run_export:
+            started = datetime.now()
+            manifest_path, samples, error = export_tokens(setup_output_path, setup_export_path, setup_export_tokenizer, setup_export_chunk_length, setup_export_shard_size, setup_keywords if setup_export_sections else None, setup_export_eos_token)
+            if error:
+                print(error, file=sys.stderr)
+                return 2
+            print(f"Export tokens: {samples} samples in {(datetime.now() - started).total_seconds():.1f}s -> {manifest_path}")
+    except Exception as e:
+        logging.exception(f"Headless run failed: {str(e)}")
+        print(f"Headless run failed: {str(e)}", file=sys.stderr)
+        return 2
+    print(f"Log file: {log_file}")
+    return exit_code
+
+def print_text_file_summary(summary, elapsed):
+    print(f"Create text file: {summary['written']} written, {summary['unchanged']} unchanged, {summary['removed']} removed, {summary['cached']} from cache, {summary['skipped']} skipped, {summary['quarantined']} quarantined, {summary['duplicates']} duplicates, {summary['failed']} failed in {elapsed:.1f}s -> {setup_output_path}")
+    for warning in summary["warnings"]:
+        print(f"Warning: {warning}")
+    print(f"Run report: {os.path.join(setup_output_path, report_file_name)}")
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Magic a LoRA")
+    parser.add_argument('--config', help="run headless with this configuration file (same format as Save Configuration)")
+    parser.add_argument('--skip-text-file', action='store_true', help="do not run Create text file")
+    parser.add_argument('--skip-json', action='store_true', help="do not run Create Json")
+    parser.add_argument('--export-tokens', action='store_true', help="also export the texts as token shards to export_path")
+    parser.add_argument('--list-backends', action='store_true', help="show which optional libraries are installed and exit")
+    parser.add_argument('--serve-stub-transcription', type=int, nargs='?', const=8765, metavar='PORT', help="run the local stub server of the \"http\" transcription backend (for tests)")
+    return parser.parse_args(argv)
+
+def print_backends():
+    for package, entry in sorted(available_backends().items()):
+        status = "available" if entry["available"] else "missing"
+        print(f"{package:<20} {status:<10} {' '.join(entry['extensions'])}")
+    print(f"Supported extensions: {' '.join(supported_extensions())}")
+
+# Enable dragging for the widgets in the Setup tab
+def make_draggable(widget):
+    widget.bind("<Button-1>", on_drag_start)
+    widget.bind("<B1-Motion>", on_drag_motion)
+
+def on_drag_start(event):
+    widget = event.widget
+    widget._drag_start_x = event.x
+    widget._drag_start_y = event.y
+
+def on_drag_motion(event):
+    widget = event.widget
+    x = widget.winfo_x() - widget._drag_start_x + event.x
+    y = widget.winfo_y() - widget._drag_start_y + event.y
+    widget.place(x=x, y=y)
+
+def on_closing():
+    # The running jobs stop at their next file and close their outputs before the window goes
+    for kind in list(running_jobs):
+        cancel_job(kind)
+    close_when_idle()
+
+def close_when_idle():
+    if jobs_running():
+        root.after(200, close_when_idle)
+        return
+    job_executor.shutdown()
+    root.destroy()
+
+# GUI
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.list_backends:
+        sys.exit(print_backends())
+    if args.serve_stub_transcription is not None:
+        try:
+            serve_stub_transcription(args.serve_stub_transcription).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if args.config:
+        sys.exit(run_headless(args.config, not args.skip_text_file, not args.skip_json, args.export_tokens))
+
+    import vlc
+    from tkinterdnd2 import TkinterDnD
+
+    root = TkinterDnD.Tk()
+    root.title("Magic a LoRA")
+
+    # Language selection
+    lang_var = tk.StringVar(root)
+    lang_var.set("en")  # default language
+    languages = {"en": "English", "it": "Italian", "fr": "French", "de": "German", "es": "Spanish", "ro": "Romanian", "pt": "Portuguese", "pl": "Polish", "sw": "Swahili"}
+    language_menu = tk.OptionMenu(root, lang_var, *languages.values(), command=lambda _: load_language(lang_var.get()))
+    language_menu.pack()
+
+    # Tabs
+    tab_control = ttk.Notebook(root)
+    tab1 = ttk.Frame(tab_control)
+    tab2 = ttk.Frame(tab_control)
+    tab3 = ttk.Frame(tab_control)
+    tab4 = ttk.Frame(tab_control)
+    tab5 = ttk.Frame(tab_control)
+    tab_control.add(tab1, text='Convert')
+    tab_control.add(tab2, text='Test SRT')
+    tab_control.add(tab3, text='Create text file')
+    tab_control.add(tab4, text='Create Json')
+    tab_control.add(tab5, text='Setup')
+    tab_control.pack(expand=1, fill='both')
+
+    # Tab 1: Create SRT
+    file_entry = tk.Entry(tab1, width=50)
+    file_entry.pack(pady=10)
+    browse_button = tk.Button(tab1, text=lang.get('browseVideo', 'Browse Video'), command=lambda: file_entry.insert(0, filedialog.askopenfilename()))
+    browse_button.pack(pady=10)
+
+    url_entry = tk.Entry(tab1, width=50)
+    url_entry.pack(pady=10)
+    url_label = tk.Label(tab1, text=lang.get('orEnterUrl', 'Or enter YouTube/Vimeo URL:'))
+    url_label.pack(pady=10)
+
+    download_audio_only_var = tk.BooleanVar()
+    download_audio_only_checkbox = tk.Checkbutton(tab1, text=lang.get('downloadAudioOnly', 'Download Audio Only'), variable=download_audio_only_var)
+    download_audio_only_checkbox.pack(pady=10)
+
+    transcription_lang_var = tk.StringVar(root)
+    transcription_lang_var.set(setup_transcription_language)
+    lang_options = ["en-US", "it-IT", "fr-FR", "de-DE", "es-ES", "pt-PT", "ro-RO", "pl-PL"]
+    transcription_lang_menu = tk.OptionMenu(tab1, transcription_lang_var, *lang_options)
+    transcription_lang_menu.pack(pady=10)
+
+    start_button = tk.Button(tab1, text=lang.get('startProcessing', 'Start Processing'), command=process_video)
+    start_button.pack(pady=20)
+
+    # Tab 2: Test SRT
+    video_entry = tk.Entry(tab2, width=50)
+    video_entry.pack(pady=10)
+    video_browse_button = tk.Button(tab2, text=lang.get('browseVideo', 'Browse Video'), command=lambda: video_entry.insert(0, filedialog.askopenfilename()))
+    video_browse_button.pack(pady=10)
+
+    url_entry_video = tk.Entry(tab2, width=50)
+    url_entry_video.pack(pady=10)
+    url_label_video = tk.Label(tab2, text=lang.get('orEnterUrlVideo', 'Or enter YouTube/Vimeo URL:'))
+    url_label_video.pack(pady=10)
+
+    srt_entry = tk.Entry(tab2, width=50)
+    srt_entry.pack(pady=10)
+    srt_browse_button = tk.Button(tab2, text=lang.get('browseSRTFile', 'Browse SRT File'), command=lambda: srt_entry.insert(0, filedialog.askopenfilename()))
+    srt_browse_button.pack(pady=10)
+
+    load_video_button = tk.Button(tab2, text=lang.get('loadAndPlayVideo', 'Load and Play Video'), command=load_video)
+    load_video_button.pack(pady=20)
+
+    # VLC video frame
+    video_frame = ttk.Frame(tab2, height=400)
+    video_frame.pack(fill='both', expand=True)
+
+    # Initialize VLC player
+    instance = vlc.Instance()
+    player = instance.media_player_new()
+    player.set_hwnd(video_frame.winfo_id())
+
+    # Tab 3: Create text file
+    create_text_file_log = configure_logger('Create_text_file')
+    create_text_file_button = tk.Button(tab3, text=lang.get('startCreateTextFile', 'Start Create text file'), command=start_create_text_file)
+    create_text_file_button.pack(pady=20)
+    cancel_create_text_file_button = tk.Button(tab3, text=lang.get('cancelJob', 'Cancel'), command=lambda: cancel_job("text_file"))
+    cancel_create_text_file_button.pack(pady=5)
+    create_text_file_log_display = tk.Text(tab3, height=15, state='disabled')
+    create_text_file_log_display.pack(fill='both', expand=True)
+
+    # Tab 4: Create Json
+    create_json_log = configure_logger('Create_Json')
+    chapter_keywords_label = tk.Label(tab4, text=lang.get('enterChapterKeywords', 'Enter chapter keywords (one per field):'))
+    chapter_keywords_label.pack(pady=10)
+    add_keyword_button = tk.Button(tab4, text=lang.get('addKeyword', 'Add Keyword'), command=add_keyword_entry)
+    add_keyword_button.pack(pady=5)
+    remove_keyword_button = tk.Button(tab4, text=lang.get('removeKeyword', 'Remove Keyword'), command=remove_keyword_entry)
+    remove_keyword_button.pack(pady=5)
+    create_json_button = tk.Button(tab4, text=lang.get('startCreateJson', 'Start Create Json'), command=start_create_json)
+    create_json_button.pack(pady=20)
+    cancel_create_json_button = tk.Button(tab4, text=lang.get('cancelJob', 'Cancel'), command=lambda: cancel_job("json"))
+    cancel_create_json_button.pack(pady=5)
+    export_tokens_button = tk.Button(tab4, text=lang.get('exportTokens', 'Export tokens'), command=start_export_tokens)
+    export_tokens_button.pack(pady=5)
+    create_json_log_display = tk.Text(tab4, height=15, state='disabled')
+    create_json_log_display.pack(fill='both', expand=True)
+
+    # Tab 5: Setup
+    directories_listbox = tk.Listbox(tab5, selectmode=tk.SINGLE)
+    directories_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+    add_directory_button = tk.Button(tab5, text=lang.get('addDirectory', 'Add Directory'), command=add_directory)
+    add_directory_button.pack(pady=5)
+    remove_directory_button = tk.Button(tab5, text=lang.get('removeDirectory', 'Remove Directory'), command=remove_directory)
+    remove_directory_button.pack(pady=5)
+
+    ignore_directories_listbox = tk.Listbox(tab5, selectmode=tk.SINGLE)
+    ignore_directories_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+    add_ignore_directory_button = tk.Button(tab5, text=lang.get('addIgnoreDirectory', 'Add Ignore Directory'), command=add_ignore_directory)
+    add_ignore_directory_button.pack(pady=5)
+    remove_ignore_directory_button = tk.Button(tab5, text=lang.get('removeIgnoreDirectory', 'Remove Ignore Directory'), command=remove_ignore_directory)
+    remove_ignore_directory_button.pack(pady=5)
+
+    output_path_label = tk.Label(tab5, text="")
+    output_path_label.pack(pady=10)
+    set_output_path_button = tk.Button(tab5, text=lang.get('setTextOutput', 'Set Text Output'), command=set_output_path)
+    set_output_path_button.pack(pady=5)
+
+    json_output_path_label = tk.Label(tab5, text="")
+    json_output_path_label.pack(pady=10)
+    set_json_output_path_button = tk.Button(tab5, text=lang.get('setJsonOutput', 'Set JSON Output'), command=set_json_output_path)
+    set_json_output_path_button.pack(pady=5)
+
+    temp_dir_label = tk.Label(tab5, text=temp_dir)
+    temp_dir_label.pack(pady=10)
+    set_temp_dir_button = tk.Button(tab5, text=lang.get('setTempDir', 'Set Temp Directory'), command=set_temp_dir)
+    set_temp_dir_button.pack(pady=5)
+
+    limit_search_var = tk.StringVar()
+    limit_search_label = tk.Label(tab5, text=lang.get('limitSearch', 'Limit Search'))
+    limit_search_label.pack(pady=10)
+    limit_search_menu = ttk.Combobox(tab5, textvariable=limit_search_var)
+    limit_search_menu['values'] = [lang.get('noLimit', 'No Limit'), lang.get('lastProducedPerType', 'Last Produced per Type'), lang.get('lastProducedInFolder', 'Last Produced in Folder'), lang.get('lastProducedSimilarTitle', 'Last Produced with Similar Title')]
+    limit_search_menu.set(lang.get('noLimit', 'No Limit'))
+    limit_search_menu.pack(pady=10)
+
+    workers_var = tk.IntVar(value=setup_workers)
+    workers_label = tk.Label(tab5, text=lang.get('parallelWorkers', 'Parallel workers'))
+    workers_label.pack(pady=10)
+    workers_spinbox = tk.Spinbox(tab5, from_=1, to=os.cpu_count() or 1, textvariable=workers_var, width=5, command=set_workers)
+    workers_spinbox.bind("<FocusOut>", lambda _: set_workers())
+    workers_spinbox.pack(pady=5)
+
+    incremental_var = tk.BooleanVar(value=setup_incremental)
+    incremental_checkbox = tk.Checkbutton(tab5, text=lang.get('incrementalUpdate', 'Only process new or modified files'), variable=incremental_var, command=set_incremental)
+    incremental_checkbox.pack(pady=5)
+
+    process_subfolders_var = tk.BooleanVar()
+    process_subfolders_checkbox = tk.Checkbutton(tab5, text=lang.get('processSubfolders', 'Process Subfolders'), variable=process_subfolders_var, command=set_process_subfolders)
+    process_subfolders_checkbox.pack(pady=5)
+
+    save_config_button = tk.Button(tab5, text=lang.get('saveConfiguration', 'Save Configuration'), command=save_configuration)
+    save_config_button.pack(pady=5)
+    load_config_button = tk.Button(tab5, text=lang.get('loadConfiguration', 'Load Configuration'), command=load_configuration)
+    load_config_button.pack(pady=5)
+
+    make_draggable(directories_listbox)
+    make_draggable(add_directory_button)
+    make_draggable(remove_directory_button)
+    make_draggable(ignore_directories_listbox)
+    make_draggable(add_ignore_directory_button)
+    make_draggable(remove_ignore_directory_button)
+    make_draggable(output_path_label)
+    make_draggable(set_output_path_button)
+    make_draggable(json_output_path_label)
+    make_draggable(set_json_output_path_button)
+    make_draggable(temp_dir_label)
+    make_draggable(set_temp_dir_button)
+    make_draggable(limit_search_label)
+    make_draggable(limit_search_menu)
+    make_draggable(workers_label)
+    make_draggable(workers_spinbox)
+    make_draggable(incremental_checkbox)
+    make_draggable(process_subfolders_checkbox)
+    make_draggable(save_config_button)
+    make_draggable(load_config_button)
+
+    root.protocol("WM_DELETE_WINDOW", on_closing)
+    root.after(100, poll_ui_queue)
+    root.mainloop()
@@ -0,0 +1,598 @@
+import os
+import re
+import sys
+import time
+import io
+import collections
+import json
+import math
+import wave
+import array
+import random
+import shutil
+import zipfile
+import platform
+import argparse
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+import MagicALoRA
+
+# Benchmarks for Magic a LoRA. Usage: python benchmark.py <benchmark> [options]
+
+def timed(function, *args, repeat=1):
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+def print_table(rows, headers):
+    widths = [max(len(str(value)) for value in column) for column in zip(headers, *rows)]
+    for row in [headers] + rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+# Audio extraction: moviepy (previous implementation) against extract_audio_track
+def make_test_video(video_path, duration):
+    ffmpeg = MagicALoRA.ffmpeg_executable()
+    command = [ffmpeg, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'lavfi', '-i', f'testsrc=size=640x360:rate=25:duration={duration}',
+               '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=44100:duration={duration}',
+               '-ac', '2', '-c:v', 'mpeg4', '-q:v', '10', '-c:a', 'aac', '-shortest', video_path]
+    subprocess.run(command, check=True)
+
+def legacy_extract_audio(video_path, audio_path):
+    video = MagicALoRA.load_backend("moviepy.editor").VideoFileClip(video_path)
+    video.audio.write_audiofile(audio_path, logger=None)
+    video.close()
+    return audio_path
+
+def benchmark_audio_extraction(args, work_dir):
+    if not MagicALoRA.ffmpeg_executable():
+        print("ffmpeg is not available")
+        return 1
+    rows = []
+    for duration in args.durations:
+        video_path = os.path.join(work_dir, f'recording_{duration}s.mp4')
+        if not os.path.exists(video_path):
+            make_test_video(video_path, duration)
+        legacy_time, legacy_audio = timed(legacy_extract_audio, video_path, os.path.join(work_dir, 'legacy.wav'), repeat=args.repeat)
+        new_time, new_audio = timed(MagicALoRA.extract_audio_track, video_path, repeat=args.repeat)
+        rows.append([f'{duration}s', f'{legacy_time:.2f}s', f'{os.path.getsize(legacy_audio) / 2**20:.1f} MB',
+                     f'{new_time:.2f}s', f'{os.path.getsize(new_audio) / 2**20:.1f} MB', f'{legacy_time / new_time:.1f}x'])
+        os.remove(new_audio)
+    print_table(rows, ['recording', 'moviepy', 'wav size', 'ffmpeg 16k mono', 'wav size', 'speedup'])
+    return 0
+
+# Create Json keywords: one finditer pass per keyword (previous implementation) against
+# the single pattern of compile_keywords, on synthetic text with chapter-like headings
+filler_words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+def make_keyword_text(size, keyword_count, heading_rate=0.01, seed=1):
+    generator = random.Random(seed)
+    headings = [f"Titolo{k}" for k in range(keyword_count)]
+    parts = []
+    length = 0
+    while length < size:
+        if generator.random() < heading_rate:
+            part = f"\n{generator.choice(headings)} {generator.randint(1, 99)}\n"
+        else:
+            part = ' '.join(generator.choices(filler_words, k=12)) + '\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+def legacy_process_text_with_keywords(text, keywords):
+    keyword_positions = []
+    for keyword in keywords:
+        pattern = re.compile(keyword, re.IGNORECASE)
+        for match in pattern.finditer(text):
+            keyword_positions.append((match.start(), match.end(), match.group()))
+    keyword_positions.sort()
+    json_data = []
+    for i in range(len(keyword_positions)):
+        start, end, matched_keyword = keyword_positions[i]
+        next_start = keyword_positions[i + 1][0] if i + 1 < len(keyword_positions) else len(text)
+        json_data.append({"title": matched_keyword, "content": text[end:next_start].strip()})
+    return json_data
+
+def benchmark_keywords(args, work_dir):
+    rows = []
+    for size in args.sizes:
+        for keyword_count in args.keyword_counts:
+            text = make_keyword_text(size * 2**20, keyword_count)
+            keywords = [rf"Titolo{k} \d+" for k in range(keyword_count)]
+            legacy_time, legacy_sections = timed(legacy_process_text_with_keywords, text, keywords, repeat=args.repeat)
+            # The pattern is compiled once per run by create_json, its cost is included here
+            new_time, new_sections = timed(lambda: MagicALoRA.process_text_with_keywords(text, MagicALoRA.compile_keywords(keywords)), repeat=args.repeat)
+            rows.append([f'{size} MB', keyword_count, f'{legacy_time:.2f}s', f'{new_time:.2f}s', f'{legacy_time / new_time:.1f}x',
+                         len(new_sections), 'yes' if new_sections == legacy_sections else 'no'])
+    print_table(rows, ['text', 'keywords', 'per keyword', 'single pass', 'speedup', 'sections', 'same output'])
+    return 0
+
+# Directory scan: os.walk with list lookups (previous implementation) against the
+# os.scandir walker, on a generated tree of empty files
+def make_test_tree(root, file_count, files_per_folder=100, depth=3):
+    if os.path.isdir(root):
+        return
+    for i in range(file_count):
+        folder_number = i // files_per_folder
+        folder = os.path.join(root, *[f'folder{(folder_number // 10 ** level) % 10}' for level in range(depth)], f'leaf{folder_number}')
+        os.makedirs(folder, exist_ok=True)
+        open(os.path.join(folder, f'document{i}.txt'), 'w').close()
+
+def legacy_iter_directory_files(directory, ignore_dirs, process_subfolders):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in ignore_dirs]
+        if not process_subfolders:
+            dirs[:] = []
+        for file in files:
+            file_path = os.path.join(root, file)
+            if any(os.path.abspath(os.path.join(root, d)) in ignore_dirs for d in dirs):
+                continue
+            yield file_path
+
+def benchmark_scan(args, work_dir):
+    rows = []
+    # Ignored folders that do not exist in the tree: only the lookups are measured
+    ignore_dirs = [os.path.join(work_dir, f'ignored{i}') for i in range(args.ignore_dirs)]
+    for file_count in args.file_counts:
+        tree = os.path.join(work_dir, f'tree_{file_count}')
+        make_test_tree(tree, file_count)
+        legacy_time, legacy_files = timed(lambda: list(legacy_iter_directory_files(tree, ignore_dirs, True)), repeat=args.repeat)
+        new_time, new_files = timed(lambda: list(MagicALoRA.iter_directory_files(tree, ignore_dirs, True, 'noLimit')), repeat=args.repeat)
+        rows.append([file_count, len(ignore_dirs), f'{legacy_time:.2f}s', f'{new_time:.2f}s', f'{legacy_time / new_time:.1f}x',
+                     'yes' if legacy_files == new_files else 'no'])
+    print_table(rows, ['files', 'ignored dirs', 'os.walk', 'scandir', 'speedup', 'same files'])
+    return 0
+
+# Similar titles: every pair compared with SequenceMatcher against the trigram blocking used
+# by "Last Produced Similar Title", on generated file names with small edits ("v2", typos)
+def make_titles(count, variant_rate=0.3, seed=1):
+    rng = random.Random(seed)
+    words = ['annual', 'report', 'meeting', 'notes', 'draft', 'final', 'budget', 'plan', 'review', 'invoice',
+             'contract', 'client', 'summary', 'project', 'minutes', 'proposal', 'scan', 'letter', 'offer', 'manual']
+    titles = []
+    while len(titles) < count:
+        title = ' '.join(rng.choices(words, k=rng.randint(2, 5))) + f' {rng.randint(0, 99999)}'
+        titles.append(title)
+        if rng.random() < variant_rate:
+            position = rng.randrange(len(title))
+            titles.append(title[:position] + rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') + title[position + 1:])
+    return list(dict.fromkeys(titles[:count]))
+
+def pairwise_similar_titles(titles, threshold):
+    parent = list(range(len(titles)))
+
+    def find(i):
+        while parent[i] != i:
+            i = parent[i]
+        return i
+
+    for i in range(len(titles)):
+        for j in range(i):
+            if MagicALoRA.SequenceMatcher(None, titles[j], titles[i]).ratio() >= threshold:
+                parent[find(i)] = find(j)
+    return [find(i) for i in range(len(titles))]
+
+def same_groups(groups, other_groups):
+    return len(set(groups)) == len(set(other_groups)) == len(set(zip(groups, other_groups)))
+
+def benchmark_similar_titles(args, work_dir):
+    rows = []
+    for count in args.title_counts:
+        titles = make_titles(count)
+        new_time, groups = timed(MagicALoRA.group_similar_titles, titles, args.threshold, repeat=args.repeat)
+        if count <= args.pairwise_limit:
+            pairwise_time, pairwise_groups = timed(pairwise_similar_titles, titles, args.threshold)
+            rows.append([len(titles), f'{pairwise_time:.2f}s', f'{new_time:.2f}s', f'{pairwise_time / new_time:.1f}x',
+                         len(set(groups)), 'yes' if same_groups(groups, pairwise_groups) else 'no'])
+        else:
+            rows.append([len(titles), '-', f'{new_time:.2f}s', '-', len(set(groups)), '-'])
+    print_table(rows, ['titles', 'all pairs', 'blocked', 'speedup', 'groups', 'same groups'])
+    return 0
+
+# Deduplication: generated documents of which a share are copies with a few words changed,
+# pushed through find_duplicate one by one as Create text file does
+def make_documents(count, words=300, copy_rate=0.2, change_rate=0.01, seed=1):
+    rng = random.Random(seed)
+    vocabulary = [f'{rng.choice(filler_words)}{number}' for number in range(5000)]
+    documents = []
+    originals = []
+    for _ in range(count):
+        if originals and rng.random() < copy_rate:
+            copied = rng.choice(originals).split()
+            documents.append(' '.join(rng.choice(vocabulary) if rng.random() < change_rate else word for word in copied))
+        else:
+            originals.append(' '.join(rng.choices(vocabulary, k=words)))
+            documents.append(originals[-1])
+    return documents, len(documents) - len(originals)
+
+def deduplicate_documents(documents, threshold):
+    deduplicator = MagicALoRA.new_deduplicator(threshold)
+    for number, document in enumerate(documents):
+        MagicALoRA.find_duplicate(deduplicator, document, str(number))
+    return deduplicator["duplicates"]
+
+def benchmark_dedup(args, work_dir):
+    rows = []
+    for count in args.document_counts:
+        documents, copies = make_documents(count)
+        seconds, duplicates = timed(deduplicate_documents, documents, args.threshold, repeat=args.repeat)
+        rows.append([count, copies, len(duplicates), f'{seconds:.2f}s', f'{count / seconds:.0f}'])
+    print_table(rows, ['documents', 'copies', 'duplicates found', 'time', 'documents/s'])
+    return 0
+
+# Corpus: a reproducible folder of every supported format generated from a seed. Every
+# handler is timed on its files, then the keyword segmenter on the extracted texts and the
+# whole Create text file and Create Json pipelines. --output saves the results as JSON and
+# --compare prints each time against a saved run, so a slower step stands out.
+corpus_formats = ['.txt', '.csv', '.xlsx', '.docx', '.pptx', '.pdf', '.epub', '.html', '.xml', '.zip', '.wav']
+corpus_backends = {'.xlsx': 'openpyxl', '.docx': 'docx', '.pptx': 'pptx', '.pdf': 'fitz', '.epub': 'ebooklib'}
+corpus_keywords = [r'(?m)^Chapter \d+', r'(?m)^Section [A-Z]\b']
+
+def corpus_lines(rng, paragraphs, words=60):
+    lines = []
+    for i in range(paragraphs):
+        if i % 8 == 0:
+            lines.append(f'Chapter {i // 8 + 1}')
+        elif i % 4 == 0:
+            lines.append(f'Section {"ABCDEFGH"[i % 8]}')
+        lines.append(' '.join(rng.choices(filler_words, k=words)).capitalize() + '.')
+    return lines
+
+def write_corpus_txt(path, rng):
+    with open(path, 'w', encoding='utf-8') as text_file:
+        text_file.write('\n'.join(corpus_lines(rng, 40)))
+
+def write_corpus_csv(path, rng):
+    with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+        csv_file.write('id,name,amount,notes\n')
+        for row in range(300):
+            csv_file.write(f'{row},{rng.choice(filler_words)},{rng.randint(0, 99999)},{" ".join(rng.choices(filler_words, k=8))}\n')
+
+def write_corpus_xlsx(path, rng):
+    workbook = MagicALoRA.load_backend("openpyxl").Workbook()
+    for sheet_number in range(2):
+        sheet = workbook.active if sheet_number == 0 else workbook.create_sheet()
+        sheet.append(['id', 'name', 'amount', 'notes'])
+        for row in range(200):
+            sheet.append([row, rng.choice(filler_words), rng.randint(0, 99999), ' '.join(rng.choices(filler_words, k=8))])
+    workbook.save(path)
+
+def write_corpus_docx(path, rng):
+    document = MagicALoRA.load_backend("docx").Document()
+    for line in corpus_lines(rng, 40):
+        if line.startswith(('Chapter', 'Section')):
+            document.add_heading(line, level=1)
+        else:
+            document.add_paragraph(line)
+    document.save(path)
+
+def write_corpus_pptx(path, rng):
+    presentation = MagicALoRA.load_backend("pptx").Presentation()
+    for slide_number in range(10):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+        slide.shapes.title.text = f'Chapter {slide_number + 1}'
+        slide.placeholders[1].text = '\n'.join(corpus_lines(rng, 2, words=20))
+    presentation.save(path)
+
+def write_corpus_pdf(path, rng):
+    fitz = MagicALoRA.load_backend("fitz")
+    document = fitz.open()
+    for page_number in range(4):
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 545, 790), '\n'.join(corpus_lines(rng, 8)), fontsize=10)
+    document.save(path)
+    document.close()
+
+def write_corpus_epub(path, rng, chapter_count=3, paragraphs=12):
+    # Written with zipfile: a minimal EPUB 2 package with three chapters
+    chapters = [f'chapter{number}.xhtml' for number in range(1, chapter_count + 1)]
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                      '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        epub.writestr('OEBPS/content.opf', '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+                      '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">benchmark</dc:identifier><dc:title>Benchmark</dc:title><dc:language>en</dc:language></metadata>'
+                      '<manifest>' + ''.join(f'<item id="c{number}" href="{chapter}" media-type="application/xhtml+xml"/>' for number, chapter in enumerate(chapters)) + '</manifest>'
+                      '<spine>' + ''.join(f'<itemref idref="c{number}"/>' for number in range(len(chapters))) + '</spine></package>')
+        for chapter in chapters:
+            body = ''.join(f'<p>{line}</p>' for line in corpus_lines(rng, paragraphs))
+            epub.writestr(f'OEBPS/{chapter}', f'<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml"><head><title>{chapter}</title></head><body>{body}</body></html>')
+
+def write_corpus_html(path, rng, paragraphs=40):
+    # A web page with the usual noise around the text: styles, scripts, navigation, tables
+    body = []
+    for number, line in enumerate(corpus_lines(rng, paragraphs)):
+        if line.startswith(('Chapter', 'Section')):
+            body.append(f'<h2 id="h{number}">{line}</h2>')
+        elif number % 10 == 9:
+            body.append('<table><tr>' + ''.join(f'<td>{word}</td>' for word in rng.choices(filler_words, k=6)) + '</tr></table>')
+        else:
+            body.append(f'<div class="text"><p>{line} <a href="#h{number}">link</a> &amp; <em>more</em></p></div>')
+        if number % 20 == 0:
+            body.append('<script>window.dataLayer = window.dataLayer || []; dataLayer.push({event: "view"});</script>')
+    with open(path, 'w', encoding='utf-8') as html_file:
+        html_file.write('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Benchmark</title>'
+                        '<style>body { font-family: sans-serif; } .text p { margin: 0 }</style></head><body>'
+                        '<nav><ul>' + ''.join(f'<li><a href="/{word}">{word}</a></li>' for word in filler_words) + '</ul></nav>'
+                        + '\n'.join(body) + '</body></html>')
+
+def write_corpus_xml(path, rng):
+    root = ET.Element('project')
+    for number, line in enumerate(corpus_lines(rng, 30)):
+        ET.SubElement(root, 'task', id=str(number)).text = line
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+
+def write_corpus_zip(path, rng):
+    # Two text files and a nested archive with an XML file and a CSV file
+    inner = io.BytesIO()
+    with zipfile.ZipFile(inner, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('nested/notes.xml', f'<notes><note>{" ".join(rng.choices(filler_words, k=200))}</note></notes>')
+        archive.writestr('nested/table.csv', 'id,notes\n' + ''.join(f'{row},{" ".join(rng.choices(filler_words, k=8))}\n' for row in range(100)))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for number in range(2):
+            archive.writestr(f'docs/document{number}.txt', '\n'.join(corpus_lines(rng, 20)))
+        archive.writestr('docs/inner.zip', inner.getvalue())
+
+def write_corpus_wav(path, rng):
+    # Three seconds of 16 kHz mono tones
+    frequency = rng.choice([220, 330, 440])
+    samples = array.array('h', (int(8000 * math.sin(2 * math.pi * frequency * i / 16000)) for i in range(3 * 16000)))
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes(samples.tobytes())
+
+corpus_writers = {'.txt': write_corpus_txt, '.csv': write_corpus_csv, '.xlsx': write_corpus_xlsx, '.docx': write_corpus_docx,
+                  '.pptx': write_corpus_pptx, '.pdf': write_corpus_pdf, '.epub': write_corpus_epub, '.html': write_corpus_html, '.xml': write_corpus_xml,
+                  '.zip': write_corpus_zip, '.wav': write_corpus_wav}
+
+def available_corpus_formats(formats):
+    available = []
+    for extension in formats:
+        module_name = corpus_backends.get(extension)
+        if module_name and not MagicALoRA.backend_available(module_name):
+            print(f"Skipped {extension}: {MagicALoRA.backend_packages.get(module_name, module_name)} is not installed")
+            continue
+        available.append(extension)
+    return available
+
+def make_corpus(root, file_count, formats, seed=1, files_per_folder=50):
+    # The files are spread over the formats in turn; the same seed gives the same corpus
+    if os.path.isdir(root):
+        return
+    rng = random.Random(seed)
+    os.makedirs(root + '.tmp', exist_ok=True)
+    for i in range(file_count):
+        extension = formats[i % len(formats)]
+        folder = os.path.join(root + '.tmp', f'folder{i // files_per_folder}')
+        os.makedirs(folder, exist_ok=True)
+        corpus_writers[extension](os.path.join(folder, f'document{i}{extension}'), rng)
+    os.replace(root + '.tmp', root)
+
+def corpus_files(root):
+    files = collections.defaultdict(list)
+    for folder, dirs, file_names in os.walk(root):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            files[os.path.splitext(file_name)[1].lower()].append(os.path.join(folder, file_name))
+    return files
+
+def extract_texts(file_paths):
+    texts = []
+    for file_path in file_paths:
+        content, original_path = MagicALoRA.handle_file(file_path)
+        if not isinstance(content, str):
+            content = ''.join(content)
+        if original_path is None:
+            raise RuntimeError(f"Extraction failed: {content}")
+        texts.append(content)
+    return texts
+
+def split_texts(texts, keyword_pattern):
+    return sum(len(MagicALoRA.process_text_with_keywords(text, keyword_pattern)) for text in texts)
+
+def run_text_file_pipeline(corpus, output_path, workers):
+    shutil.rmtree(output_path, ignore_errors=True)
+    return MagicALoRA.create_text_files([corpus], output_path, [], True, 'noLimit', workers, shard_size=MagicALoRA.setup_output_shard_size)
+
+def run_json_pipeline(input_path, json_output_path):
+    shutil.rmtree(json_output_path, ignore_errors=True)
+    json_output_file, documents, error = MagicALoRA.create_json(input_path, json_output_path, corpus_keywords)
+    if error:
+        raise RuntimeError(error)
+    return documents
+
+def corpus_result(file_count, step, files, size, seconds):
+    return {"corpus": file_count, "step": step, "files": files, "mb": round(size / 2**20, 3), "seconds": round(seconds, 6)}
+
+def benchmark_corpus(args, work_dir):
+    if args.config:
+        MagicALoRA.apply_configuration(MagicALoRA.read_configuration(args.config))
+        MagicALoRA.temp_dir = work_dir
+    # The extraction cache would turn the repeated runs into file reads
+    MagicALoRA.setup_cache_max_size = 0
+    formats = available_corpus_formats(args.formats)
+    if not args.audio:
+        MagicALoRA.setup_exclude_patterns = ['*.wav']
+    results = []
+    for file_count in args.corpus_sizes:
+        corpus = os.path.join(work_dir, f'corpus_{file_count}_{args.seed}_{"".join(extension[1:] for extension in formats)}')
+        make_corpus(corpus, file_count, formats, args.seed)
+        files = corpus_files(corpus)
+        texts = []
+        for extension in formats:
+            if extension == '.wav' and not args.audio:
+                continue
+            size = sum(os.path.getsize(file_path) for file_path in files[extension])
+            seconds, extension_texts = timed(extract_texts, files[extension], repeat=args.repeat)
+            results.append(corpus_result(file_count, f'handler {extension}', len(files[extension]), size, seconds))
+            texts.extend(extension_texts)
+        keyword_pattern = MagicALoRA.compile_keywords(corpus_keywords)
+        seconds, sections = timed(split_texts, texts, keyword_pattern, repeat=args.repeat)
+        results.append(corpus_result(file_count, 'keywords', len(texts), sum(len(text.encode('utf-8')) for text in texts), seconds))
+        corpus_size = sum(os.path.getsize(file_path) for extension in files for file_path in files[extension])
+        output_path = os.path.join(work_dir, 'output')
+        seconds, summary = timed(run_text_file_pipeline, corpus, output_path, args.workers, repeat=args.repeat)
+        results.append(corpus_result(file_count, 'create text file', summary["written"], corpus_size, seconds))
+        seconds, documents = timed(run_json_pipeline, output_path, os.path.join(work_dir, 'json'), repeat=args.repeat)
+        results.append(corpus_result(file_count, 'create json', documents, sum(os.path.getsize(os.path.join(output_path, name)) for name in os.listdir(output_path)), seconds))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = {(result["corpus"], result["step"]): result for result in json.load(baseline_file)["results"]}
+    rows = []
+    regressions = 0
+    for result in results:
+        seconds = max(result["seconds"], 1e-9)
+        row = [result["corpus"], result["step"], result["files"], f'{result["mb"]:.1f}', f'{result["seconds"]:.4f}s',
+               f'{result["files"] / seconds:.1f}', f'{result["mb"] / seconds:.2f}']
+        if args.compare:
+            previous = baseline.get((result["corpus"], result["step"]))
+            if previous is None:
+                row += ['-', '-']
+            else:
+                ratio = result["seconds"] / max(previous["seconds"], 1e-9)
+                slower = ratio > 1 + args.tolerance
+                regressions += slower
+                row += [f'{previous["seconds"]:.4f}s', f'{ratio:.2f}x' + (' slower' if slower else '')]
+        rows.append(row)
+    headers = ['corpus', 'step', 'files', 'MB', 'time', 'files/s', 'MB/s']
+    print_table(rows, headers + (['baseline', 'ratio'] if args.compare else []))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({"benchmark": "corpus", "python": platform.python_version(), "platform": platform.platform(),
+                       "seed": args.seed, "workers": args.workers, "repeat": args.repeat, "results": results}, output_file, indent=1)
+        print(f"Results: {args.output}")
+    return 1 if regressions else 0
+
+# HTML: large web page dumps parsed by lxml, by the html.parser fallback and by BeautifulSoup
+# with html.parser (how EPUB documents were read before), then EPUB libraries read by the
+# previous EPUB handler and by handle_epub_file with 1 and --epub-workers threads
+def legacy_html_text(content):
+    return MagicALoRA.load_backend("bs4").BeautifulSoup(content, 'html.parser').get_text()
+
+def fallback_html_text(content):
+    lxml_available = MagicALoRA.backend_available
+    MagicALoRA.backend_available = lambda module_name: module_name != "lxml.etree" and lxml_available(module_name)
+    try:
+        return MagicALoRA.html_text(content)
+    finally:
+        MagicALoRA.backend_available = lxml_available
+
+def legacy_epub_texts(file_paths):
+    ebooklib = MagicALoRA.load_backend("ebooklib")
+    texts = []
+    for file_path in file_paths:
+        book = MagicALoRA.load_backend("ebooklib.epub").read_epub(file_path)
+        texts.append('\n'.join(legacy_html_text(item.get_content()) for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT))
+    return texts
+
+def epub_texts(file_paths, workers):
+    MagicALoRA.setup_epub_workers = workers
+    return [MagicALoRA.handle_epub_file(file_path)[0] for file_path in file_paths]
+
+def benchmark_html(args, work_dir):
+    rng = random.Random(args.seed)
+    rows = []
+    methods = [('lxml', MagicALoRA.html_text), ('html.parser', fallback_html_text)]
+    if MagicALoRA.backend_available("bs4"):
+        methods.append(('bs4 html.parser (previous)', legacy_html_text))
+    for size in args.html_sizes:
+        html_path = os.path.join(work_dir, f'dump_{size}mb.html')
+        if not os.path.exists(html_path):
+            write_corpus_html(html_path, rng, paragraphs=size * 2300)
+        with open(html_path, 'rb') as html_file:
+            content = html_file.read()
+        for method, function in methods:
+            if method == 'lxml' and not MagicALoRA.backend_available("lxml.etree"):
+                continue
+            seconds, text = timed(function, content, repeat=args.repeat)
+            rows.append([f'{size} MB page', method, f'{seconds:.3f}s', f'{len(content) / 2**20 / seconds:.1f}'])
+    if not MagicALoRA.backend_available("ebooklib"):
+        print("Skipped EPUB: ebooklib is not installed")
+    else:
+        for book_count in args.book_counts:
+            library = os.path.join(work_dir, f'library_{book_count}')
+            if not os.path.exists(library):
+                os.makedirs(library)
+                for number in range(book_count):
+                    write_corpus_epub(os.path.join(library, f'book{number}.epub'), rng, chapter_count=args.chapters, paragraphs=60)
+            file_paths = sorted(os.path.join(library, name) for name in os.listdir(library))
+            size = sum(os.path.getsize(file_path) for file_path in file_paths) / 2**20
+            steps = [('previous handler', legacy_epub_texts, file_paths)] if MagicALoRA.backend_available("bs4") else []
+            steps += [('epub_workers 1', epub_texts, file_paths, 1), (f'epub_workers {args.epub_workers}', epub_texts, file_paths, args.epub_workers)]
+            for step, function, *function_args in steps:
+                seconds, texts = timed(function, *function_args, repeat=args.repeat)
+                rows.append([f'{book_count} EPUBs', step, f'{seconds:.3f}s', f'{size / seconds:.1f}'])
+    print_table(rows, ['input', 'method', 'time', 'MB/s'])
+    return 0
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Magic a LoRA benchmarks")
+    parser.add_argument('--work-dir', help="folder for the generated test files (default: a new temporary folder)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measure, the best one is reported")
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    audio = benchmarks.add_parser('audio-extraction', help="extract the audio track of synthetic recordings")
+    audio.add_argument('--durations', type=int, nargs='+', default=[60, 600, 3600], help="recording lengths in seconds")
+    audio.set_defaults(run=benchmark_audio_extraction)
+
+    keywords = benchmarks.add_parser('keywords', help="split synthetic text on Create Json keywords")
+    keywords.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100], help="text sizes in MB")
+    keywords.add_argument('--keyword-counts', type=int, nargs='+', default=[1, 10, 50], help="numbers of keywords")
+    keywords.set_defaults(run=benchmark_keywords)
+
+    scan = benchmarks.add_parser('scan', help="walk generated directory trees")
+    scan.add_argument('--file-counts', type=int, nargs='+', default=[10000, 100000], help="files in each tree")
+    scan.add_argument('--ignore-dirs', type=int, default=50, help="entries in the ignored directories list")
+    scan.set_defaults(run=benchmark_scan)
+
+    similar_titles = benchmarks.add_parser('similar-titles', help="group generated file names by similar title")
+    similar_titles.add_argument('--title-counts', type=int, nargs='+', default=[1000, 10000, 100000], help="file names in each run")
+    similar_titles.add_argument('--threshold', type=float, default=0.9, help="similarity threshold")
+    similar_titles.add_argument('--pairwise-limit', type=int, default=2000, help="largest run also measured comparing every pair")
+    similar_titles.set_defaults(run=benchmark_similar_titles)
+
+    dedup = benchmarks.add_parser('dedup', help="find near-duplicate copies among generated documents")
+    dedup.add_argument('--document-counts', type=int, nargs='+', default=[10000, 100000], help="documents in each run")
+    dedup.add_argument('--threshold', type=float, default=0.8, help="similarity threshold")
+    dedup.set_defaults(run=benchmark_dedup)
+
+    html_benchmark = benchmarks.add_parser('html', help="extract text from generated HTML dumps and EPUB libraries")
+    html_benchmark.add_argument('--html-sizes', type=int, nargs='+', default=[10, 100], help="sizes of the HTML pages, in MB")
+    html_benchmark.add_argument('--book-counts', type=int, nargs='+', default=[100], help="number of EPUB files in each library")
+    html_benchmark.add_argument('--chapters', type=int, default=20, help="chapters in each EPUB")
+    html_benchmark.add_argument('--epub-workers', type=int, default=4, help="threads for the parallel EPUB run")
+    html_benchmark.add_argument('--seed', type=int, default=1, help="seed of the generated files")
+    html_benchmark.set_defaults(run=benchmark_html)
+
+    corpus = benchmarks.add_parser('corpus', help="time every handler and the pipelines on a generated corpus of all formats")
+    corpus.add_argument('--corpus-sizes', type=int, nargs='+', default=[100, 1000], help="files in each corpus")
+    corpus.add_argument('--formats', nargs='+', default=corpus_formats, help="extensions in the corpus")
+    corpus.add_argument('--seed', type=int, default=1, help="seed of the generated contents")
+    corpus.add_argument('--workers', type=int, default=1, help="workers of the Create text file run")
+    corpus.add_argument('--audio', action='store_true', help="also transcribe the WAV files (needs a transcription backend, see --config)")
+    corpus.add_argument('--config', help="configuration applied before the runs, e.g. for the transcription backend")
+    corpus.add_argument('--output', help="save the results to this JSON file")
+    corpus.add_argument('--compare', help="results of an earlier run (--output) to compare with")
+    corpus.add_argument('--tolerance', type=float, default=0.1, help="slowdown over the earlier run reported as a regression")
+    corpus.set_defaults(run=benchmark_corpus)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='magicalora-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    MagicALoRA.temp_dir = work_dir
+    print(f"Work folder: {work_dir}")
+    return args.run(args, work_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
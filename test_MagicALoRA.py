@@ -0,0 +1,90 @@
+import os
+import json
+import random
+import itertools
+import MagicALoRA
+
+
+def write_text_output(output_dir, texts):
+    # A Create text file output: one model_N.txt per text and its records.jsonl
+    os.makedirs(output_dir, exist_ok=True)
+    writer = MagicALoRA.open_output_writer(str(output_dir))
+    records = []
+    for number, text in enumerate(texts):
+        location, index = MagicALoRA.write_output(writer, text, f'source{number}.txt')
+        records.append(MagicALoRA.new_record(f'source{number}.txt', f'source{number}.txt', location))
+    MagicALoRA.close_output_writer(writer)
+    MagicALoRA.save_records(records, str(output_dir))
+
+
+def test_export_tokens_bytes_with_large_eos_token(tmp_path):
+    texts = ['abcd\nf', 'odd']
+    write_text_output(tmp_path / 'text', texts)
+    manifest_path, samples, error = MagicALoRA.export_tokens(str(tmp_path / 'text'), str(tmp_path / 'tokens'), eos_token=256)
+    assert error is None and samples == 2
+    dataset = MagicALoRA.open_token_dataset(str(tmp_path / 'tokens'))
+    assert dataset["manifest"]["dtype"] == 'uint16'
+    for index, text in enumerate(texts):
+        assert list(MagicALoRA.token_sample(dataset, index)) == list(text.encode('utf-8')) + [256]
+
+
+def test_full_run_resets_incremental_manifest(tmp_path):
+    source_dir = tmp_path / 'src'
+    source_dir.mkdir()
+    (source_dir / 'a.txt').write_text('AAAA one')
+    (source_dir / 'b.txt').write_text('BBBB two')
+    output_dir = str(tmp_path / 'out')
+    MagicALoRA.setup_cache_max_size = 0
+    MagicALoRA.create_text_files([str(source_dir)], output_dir, [], True, 'noLimit', incremental=True, shard_size=64)
+    (source_dir / 'b.txt').unlink()
+    MagicALoRA.create_text_files([str(source_dir)], output_dir, [], True, 'noLimit', shard_size=64)
+    (source_dir / 'c.txt').write_text('CCCC three')
+    MagicALoRA.create_text_files([str(source_dir)], output_dir, [], True, 'noLimit', incremental=True, shard_size=64)
+    texts = {os.path.basename(record["source"]): MagicALoRA.read_record_text(output_dir, record) for record in MagicALoRA.iter_records_file(output_dir)}
+    assert texts == {'a.txt': 'AAAA one', 'c.txt': 'CCCC three'}
+
+
+def pairwise_groups(titles, threshold):
+    # Groups of every similar pair as sets of titles, to compare with group_similar_titles
+    groups = {title: {title} for title in titles}
+    for i, j in itertools.combinations(range(len(titles)), 2):
+        if MagicALoRA.SequenceMatcher(None, titles[i], titles[j]).ratio() >= threshold and groups[titles[i]] is not groups[titles[j]]:
+            merged = groups[titles[i]] | groups[titles[j]]
+            for title in merged:
+                groups[title] = merged
+    return set(frozenset(group) for group in groups.values())
+
+
+def test_group_similar_titles_matches_all_pairs():
+    rng = random.Random(1)
+    cases = [['reor 2023', 'report 2023'], ['ab v2', 'zab v2']]
+    for _ in range(60):
+        alphabet = rng.choice(['ab', 'abc', 'abcdef', 'ab v2z'])
+        cases.append(list(dict.fromkeys(''.join(rng.choices(alphabet, k=rng.randint(0, 14))) for _ in range(rng.randint(2, 30)))))
+    for titles in cases:
+        for threshold in (0.5, 0.6, 0.75, 0.8, 0.9, 0.95):
+            groups = {}
+            for title, group in zip(titles, MagicALoRA.group_similar_titles(titles, threshold)):
+                groups.setdefault(group, set()).add(title)
+            assert set(frozenset(group) for group in groups.values()) == pairwise_groups(titles, threshold), (titles, threshold)
+
+
+def test_compile_keywords_with_same_group_names():
+    pattern = MagicALoRA.compile_keywords([r'(?P<n>\d+)\. Capitolo', r'(?P<n>\d+)\. Chapter (?P=n)', r'(?P<q>")x(?P=q)'])
+    sections = MagicALoRA.process_text_with_keywords('1. Capitolo uno 2. Chapter 2 due "x" tre', pattern)
+    assert sections == [{"title": '1. Capitolo', "content": 'uno'}, {"title": '2. Chapter 2', "content": 'due'}, {"title": '"x"', "content": 'tre'}]
+
+
+def test_incremental_run_reports_ignored_deduplicate(tmp_path):
+    source_dir = tmp_path / 'src'
+    source_dir.mkdir()
+    (source_dir / 'a.txt').write_text('same words here')
+    (source_dir / 'b.txt').write_text('same words here')
+    MagicALoRA.setup_cache_max_size = 0
+    MagicALoRA.setup_deduplicate = True
+    try:
+        summary = MagicALoRA.create_text_files([str(source_dir)], str(tmp_path / 'out'), [], True, 'noLimit', incremental=True)
+    finally:
+        MagicALoRA.setup_deduplicate = False
+    assert summary["written"] == 2 and summary["duplicates"] == 0
+    assert len(summary["warnings"]) == 1